@@ -1,25 +1,60 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, Response, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-from datetime import datetime
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 import os
+import json
+import hashlib
+import hmac
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
 import base64
+from instrumentation import InstrumentedConnection, init_instrumentation, metrics, summarize_plan
+from costing import recompute_product_costs
+from recipes import RecipeCycleError, rebuild_product_bom, rebuild_after_preparation_change
+from pricing import DiscountRuleCache, ProductPriceCache, apply_due_prices, price_cart
+from serialization import JSON_DATETIME_FORMAT, FastJSONProvider, dumps_bytes, init_compression
+from versioning import DataVersions, compute_etag, stock_key
+from replication import REPLICA_CONNECT_TIMEOUT, REPLICA_DATABASE_URL, ReplicaRouter
+from events import EVENT_FEED_BATCH, EVENT_TYPES, read_events, record_event
+from closing import DayClosedError, close_day, day_close_report, day_closes_between, is_day_closed_error, \
+    open_days_filter, open_intervals
+from report_cache import invalidate_reports, lookup_report, period_is_closed, report_cache_key, store_report
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key')
 
+# JSON con orjson (Decimal como texto, fechas según JSON_DATETIME_FORMAT)
+app.json = FastJSONProvider(app)
+
 # Configuración de BD
-def get_db():
-    """Obtener conexión a la BD"""
-    db_url = os.getenv('DATABASE_URL', 'postgresql://localhost:5432/illima_db')
-    return psycopg2.connect(db_url)
+# Réplica para los reportes (REPLICA_DATABASE_URL); sin definir, todo va al primario
+replica = ReplicaRouter(REPLICA_DATABASE_URL, lambda dsn: psycopg2.connect(
+    dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT, connection_factory=InstrumentedConnection))
+
+def get_db(role='primary'):
+    """Obtener conexión a la BD; role='replica' para lecturas que toleran atraso (de solo lectura,
+    al primario si la réplica no está disponible o está atrasada)"""
+    conn = replica.connect() if role == 'replica' else None
+    if conn is None:
+        db_url = os.getenv('DATABASE_URL', 'postgresql://localhost:5432/illima_db')
+        conn = psycopg2.connect(db_url, connection_factory=InstrumentedConnection)
+    if role == 'replica':
+        conn.set_session(readonly=True)
+    return conn
+
+# Medición de latencia, tiempo en BD y queries por ruta
+init_instrumentation(app)
+
+# Compresión brotli/gzip según Accept-Encoding
+init_compression(app)
 
 def login_required(f):
     """Decorador para rutas que requieren login"""
@@ -50,6 +85,440 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def bearer_token_matches(token):
+    """La petición trae Authorization: Bearer <token> (comparación en tiempo constante; sin token configurado, no)"""
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+
+# Versiones de las tablas en memoria (LISTEN data_versions), para responder 304 sin consultar la BD
+data_versions = DataVersions(lambda: psycopg2.connect(os.getenv('DATABASE_URL', 'postgresql://localhost:5432/illima_db')))
+
+def conditional_get(*tables, stock=False, admin=False):
+    """Decorador de GET condicional: ETag según la versión de las tablas (y del stock del local si stock);
+    con If-None-Match vigente responde 304 sin consultar la BD. Va antes de login_required/admin_required"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            etag = None
+            if 'user_id' in session and (not admin or session.get('role') == 'administrador'):
+                keys = list(tables)
+                variant = [request.full_path, session.get('role')]
+                if stock:
+                    location_id = current_location_id()
+                    keys.append(stock_key(location_id))
+                    variant.append(location_id)
+                versions = data_versions.versions(keys)
+                if versions is not None:
+                    etag = compute_etag(versions, *variant)
+                    if request.if_none_match.contains_weak(etag):
+                        response = app.response_class(status=304)
+                        response.set_etag(etag)
+                        return response
+            
+            response = make_response(f(*args, **kwargs))
+            if etag and response.status_code == 200:
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
+# === LOCALES Y STOCK POR LOCAL ===
+
+# Local "Principal", creado por init_db; los datos anteriores a los locales pertenecen a él
+DEFAULT_LOCATION_ID = 1
+
+def current_location_id():
+    """Local de la petición: el del usuario, o location_id en la petición si es administrador o no tiene local fijo"""
+    assigned = session.get('location_id')
+    data = request.get_json(silent=True) if request.is_json else None
+    requested = request.args.get('location_id', type=int)
+    if requested is None and isinstance(data, dict) and data.get('location_id'):
+        requested = int(data['location_id'])
+    
+    if requested and (session.get('role') == 'administrador' or not assigned):
+        return requested
+    return assigned or DEFAULT_LOCATION_ID
+
+class InsufficientStockError(Exception):
+    """Un movimiento dejaría el stock de un insumo en negativo"""
+
+class StockConflictError(Exception):
+    """El stock cambió desde que el usuario lo leyó (expected_version no coincide)"""
+    
+    def __init__(self, conflicts):
+        super().__init__('El stock cambió desde la última lectura')
+        self.conflicts = conflicts
+
+def consume_lots_fefo(cursor, location_id, quantities):
+    """Descontar {supply_id: cantidad} de los lotes abiertos, primero los que vencen antes.
+    
+    Se llama con las filas de location_stock ya bloqueadas, así que los lotes de
+    esos insumos no cambian en paralelo. La consulta recursiva avanza lote por
+    lote sobre supply_lots_fefo_idx y se detiene al cubrir la cantidad: el costo
+    depende de los lotes que se tocan, no de cuántos hay abiertos. Lo que exceda
+    los lotes sale del stock sin lote. El filtro por ANY(ARRAY(...)) hace que el
+    UPDATE busque los lotes por clave primaria en vez de recorrer la tabla.
+    """
+    if not quantities:
+        return
+    
+    cursor.execute('''
+        WITH RECURSIVE fefo AS (
+            SELECT n.supply_id, l.id, l.expiry, n.quantity AS remaining, LEAST(l.quantity, n.quantity) AS take
+            FROM unnest(%(supplies)s::integer[], %(quantities)s::numeric[]) AS n(supply_id, quantity)
+            CROSS JOIN LATERAL (
+                SELECT id, quantity, COALESCE(expires_at, 'infinity') AS expiry
+                FROM supply_lots
+                WHERE location_id = %(location_id)s AND supply_id = n.supply_id AND quantity > 0
+                ORDER BY COALESCE(expires_at, 'infinity'), id
+                LIMIT 1
+            ) l
+            UNION ALL
+            SELECT f.supply_id, l.id, l.expiry, f.remaining - f.take, LEAST(l.quantity, f.remaining - f.take)
+            FROM fefo f
+            CROSS JOIN LATERAL (
+                SELECT id, quantity, COALESCE(expires_at, 'infinity') AS expiry
+                FROM supply_lots
+                WHERE location_id = %(location_id)s AND supply_id = f.supply_id AND quantity > 0
+                  AND (COALESCE(expires_at, 'infinity'), id) > (f.expiry, f.id)
+                ORDER BY COALESCE(expires_at, 'infinity'), id
+                LIMIT 1
+            ) l
+            WHERE f.remaining > f.take
+        )
+        UPDATE supply_lots l
+        SET quantity = l.quantity - f.take
+        FROM fefo f
+        WHERE l.id = ANY(ARRAY(SELECT id FROM fefo)) AND l.id = f.id
+    ''', {'supplies': list(quantities), 'quantities': list(quantities.values()), 'location_id': location_id})
+
+def apply_stock_movements(cursor, location_id, movements, user_id=None):
+    """Aplicar movimientos [(supply_id, cambio, tipo, descripción)] al stock de un local y registrarlos en el historial.
+    Las mermas agregan un quinto elemento con el código de motivo.
+    
+    Las filas se bloquean en orden de supply_id, así dos ventas que comparten
+    insumos nunca se esperan en orden cruzado (deadlock), y el descuento es una
+    sola sentencia que no deja stock negativo. Las salidas se descuentan también
+    de los lotes en orden FEFO.
+    """
+    if not movements:
+        return
+    
+    totals = defaultdict(Decimal)
+    for supply_id, change, *_ in movements:
+        totals[supply_id] += Decimal(str(change))
+    supply_ids = sorted(totals)
+    
+    # Reposición de un insumo que el local todavía no tenía
+    incoming = [supply_id for supply_id in supply_ids if totals[supply_id] > 0]
+    if incoming:
+        cursor.execute('''
+            INSERT INTO location_stock (location_id, supply_id, min_stock)
+            SELECT %s, id, min_stock FROM supplies WHERE id = ANY(%s)
+            ON CONFLICT DO NOTHING
+        ''', (location_id, incoming))
+    
+    cursor.execute('''
+        SELECT ls.supply_id, ls.stock, s.name, s.unit
+        FROM location_stock ls
+        JOIN supplies s ON s.id = ls.supply_id
+        WHERE ls.location_id = %s AND ls.supply_id = ANY(%s)
+        ORDER BY ls.supply_id
+        FOR UPDATE OF ls
+    ''', (location_id, supply_ids))
+    current = {row['supply_id']: row for row in cursor.fetchall()}
+    
+    for supply_id in supply_ids:
+        row = current.get(supply_id)
+        available = row['stock'] if row else Decimal(0)
+        if available + totals[supply_id] < 0:
+            name = row['name'] if row else f'insumo {supply_id}'
+            unit = row['unit'] if row else ''
+            raise InsufficientStockError(f"Stock insuficiente de {name}. Disponible: {available} {unit}".strip())
+    
+    cursor.execute('''
+        UPDATE location_stock ls
+        SET stock = ls.stock + m.change, version = ls.version + 1, updated_at = CURRENT_TIMESTAMP
+        FROM unnest(%s::integer[], %s::numeric[]) AS m(supply_id, change)
+        WHERE ls.location_id = %s AND ls.supply_id = m.supply_id
+          AND ls.stock + m.change >= 0
+        RETURNING ls.supply_id, ls.stock, ls.version
+    ''', (supply_ids, [totals[supply_id] for supply_id in supply_ids], location_id))
+    
+    if cursor.rowcount != len(supply_ids):
+        raise InsufficientStockError('Stock insuficiente')
+    levels = cursor.fetchall()
+    
+    consume_lots_fefo(cursor, location_id, {supply_id: -totals[supply_id]
+                                            for supply_id in supply_ids if totals[supply_id] < 0})
+    
+    # Al historial lo pasa flush_inventory_outbox; inventory_movements ya los muestra
+    cursor.execute('''
+        INSERT INTO inventory_outbox (supply_id, location_id, quantity_change, type, description, reason, user_id)
+        SELECT m.supply_id, %s, m.change, m.type, m.description, m.reason, %s
+        FROM unnest(%s::integer[], %s::numeric[], %s::text[], %s::text[], %s::text[])
+            AS m(supply_id, change, type, description, reason)
+    ''', (location_id, user_id,
+          [m[0] for m in movements], [Decimal(str(m[1])) for m in movements],
+          [m[2] for m in movements], [m[3] for m in movements],
+          [m[4] if len(m) > 4 else None for m in movements]))
+    
+    record_event(cursor, 'stock.changed', {
+        'user_id': user_id,
+        'movements': [{'supply_id': m[0], 'change': m[1], 'type': m[2], 'description': m[3],
+                       'reason': m[4] if len(m) > 4 else None} for m in movements],
+        'levels': levels,
+    }, location_id=location_id)
+
+# Movimientos por transacción al vaciar el outbox
+INVENTORY_FLUSH_BATCH = int(os.getenv('INVENTORY_FLUSH_BATCH', '5000'))
+
+OUTBOX_BATCH_QUERY = '''
+    WITH batch AS (
+        DELETE FROM inventory_outbox
+        WHERE id = ANY(ARRAY(
+            SELECT id FROM inventory_outbox WHERE id = ANY(%(ids)s) OR %(ids)s IS NULL
+            ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED
+        ))
+        RETURNING *
+    )
+    INSERT INTO inventory_history (supply_id, location_id, quantity_change, type, description, reason,
+                                   user_id, created_at)
+    SELECT supply_id, location_id, quantity_change, type, description, reason, user_id, created_at
+    FROM batch
+    ORDER BY id
+'''
+
+def flush_inventory_outbox(cursor, batch_size=INVENTORY_FLUSH_BATCH):
+    """Pasar un lote de inventory_outbox a inventory_history en una sola sentencia; devuelve cuántos sacó.
+    
+    Borrar del outbox e insertar en el historial ocurre en la misma
+    transacción: si el proceso muere a mitad, el lote sigue en el outbox y pasa
+    en la próxima corrida, sin perderse ni duplicarse. Con SKIP LOCKED dos
+    workers pueden vaciarlo a la vez sin tomar las mismas filas.
+    
+    El outbox no tiene FKs: si una fila ya no cumple las del historial (un
+    insumo, usuario o motivo borrado antes del traspaso) el lote falla. Entonces
+    se pasa fila por fila y las que fallan van a inventory_outbox_rejected con
+    el error, para que el resto del libro no quede trabado.
+    """
+    cursor.execute('SAVEPOINT outbox_batch')
+    try:
+        cursor.execute(OUTBOX_BATCH_QUERY, {'ids': None, 'limit': batch_size})
+        moved = cursor.rowcount
+        cursor.execute('RELEASE SAVEPOINT outbox_batch')
+        return moved
+    except (psycopg2.IntegrityError, psycopg2.DataError):
+        cursor.execute('ROLLBACK TO SAVEPOINT outbox_batch')
+    
+    ids_cursor = cursor.connection.cursor()
+    ids_cursor.execute('''
+        SELECT id FROM inventory_outbox ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+    ''', (batch_size,))
+    ids = [row[0] for row in ids_cursor.fetchall()]
+    ids_cursor.close()
+    
+    for outbox_id in ids:
+        cursor.execute('SAVEPOINT outbox_row')
+        try:
+            cursor.execute(OUTBOX_BATCH_QUERY, {'ids': [outbox_id], 'limit': 1})
+            cursor.execute('RELEASE SAVEPOINT outbox_row')
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT outbox_row')
+            cursor.execute('''
+                WITH rejected AS (DELETE FROM inventory_outbox WHERE id = %s RETURNING *)
+                INSERT INTO inventory_outbox_rejected (id, location_id, supply_id, quantity_change, type,
+                                                       description, reason, user_id, created_at, error)
+                SELECT id, location_id, supply_id, quantity_change, type, description, reason, user_id,
+                       created_at, %s
+                FROM rejected
+            ''', (outbox_id, e.diag.message_primary or str(e)))
+            app.logger.warning('Movimiento %s del outbox rechazado: %s', outbox_id, e.diag.message_primary)
+    return len(ids)
+
+def adjust_stock(cursor, location_id, adjustments, user_id=None):
+    """Ajustes manuales [{supply_id, delta | stock, expected_version?, notes?}] en una transacción.
+    
+    delta suma esa cantidad. stock fija el valor y exige expected_version (la
+    versión de location_stock que vio el usuario): así no se pisa una venta
+    confirmada entre la lectura y el guardado. Con cualquier versión distinta se
+    lanza StockConflictError sin aplicar nada. Devuelve por insumo el delta
+    aplicado (el mismo que queda en el historial), el stock y la versión nuevos.
+    """
+    if any(not isinstance(adjustment, dict) or not adjustment.get('supply_id') for adjustment in adjustments):
+        raise ValueError('Cada ajuste necesita supply_id')
+    supply_ids = [adjustment['supply_id'] for adjustment in adjustments]
+    if len(set(supply_ids)) != len(supply_ids):
+        raise ValueError('Un insumo aparece más de una vez')
+    supply_ids.sort()
+    
+    cursor.execute('''
+        INSERT INTO location_stock (location_id, supply_id, min_stock)
+        SELECT %s, id, min_stock FROM supplies WHERE id = ANY(%s)
+        ON CONFLICT DO NOTHING
+    ''', (location_id, supply_ids))
+    cursor.execute('''
+        SELECT supply_id, stock, version FROM location_stock
+        WHERE location_id = %s AND supply_id = ANY(%s)
+        ORDER BY supply_id
+        FOR UPDATE
+    ''', (location_id, supply_ids))
+    current = {row['supply_id']: row for row in cursor.fetchall()}
+    
+    movements, conflicts = [], []
+    for adjustment in adjustments:
+        supply_id = adjustment['supply_id']
+        if supply_id not in current:
+            raise ValueError(f'Insumo no encontrado: {supply_id}')
+        row = current[supply_id]
+        
+        expected = adjustment.get('expected_version')
+        if expected is not None and int(expected) != row['version']:
+            conflicts.append({'supply_id': supply_id, 'stock': row['stock'], 'version': row['version'],
+                              'expected_version': int(expected)})
+            continue
+        
+        if adjustment.get('delta') is not None:
+            delta = Decimal(str(adjustment['delta']))
+        elif adjustment.get('stock') is not None:
+            if expected is None:
+                raise ValueError('Para fijar el stock se requiere expected_version (o enviar delta)')
+            if Decimal(str(adjustment['stock'])) < 0:
+                raise ValueError('Stock inválido')
+            delta = Decimal(str(adjustment['stock'])) - row['stock']
+        else:
+            raise ValueError('Cada ajuste necesita delta o stock')
+        
+        if delta:
+            movements.append((supply_id, delta, 'restock' if delta > 0 else 'ajuste',
+                              adjustment.get('notes') or 'Ajuste de inventario'))
+    
+    if conflicts:
+        raise StockConflictError(conflicts)
+    
+    apply_stock_movements(cursor, location_id, movements, user_id)
+    
+    applied = {movement[0]: movement[1] for movement in movements}
+    cursor.execute('''
+        SELECT supply_id, stock, version FROM location_stock
+        WHERE location_id = %s AND supply_id = ANY(%s)
+        ORDER BY supply_id
+    ''', (location_id, supply_ids))
+    return [{'supply_id': row['supply_id'], 'applied_delta': applied.get(row['supply_id'], Decimal(0)),
+             'stock': row['stock'], 'version': row['version']} for row in cursor.fetchall()]
+
+# === UNIDADES Y RECETAS ===
+
+class UnitConversionError(Exception):
+    """No hay conversión entre la unidad indicada y la del insumo"""
+
+def conversion_factors(cursor, supply_ids, units):
+    """Factor para pasar cada (insumo, unidad) a la unidad del insumo; prefiere la conversión propia del insumo"""
+    cursor.execute('''
+        SELECT m.n, s.name, s.unit, m.unit AS from_unit,
+               CASE WHEN m.unit IS NULL OR m.unit = s.unit THEN 1 ELSE uc.factor END AS factor
+        FROM unnest(%s::integer[], %s::text[]) WITH ORDINALITY AS m(supply_id, unit, n)
+        JOIN supplies s ON s.id = m.supply_id
+        LEFT JOIN LATERAL (
+            SELECT factor FROM unit_conversions
+            WHERE from_unit = m.unit AND to_unit = s.unit AND (supply_id = s.id OR supply_id IS NULL)
+            ORDER BY supply_id NULLS LAST
+            LIMIT 1
+        ) uc ON true
+        ORDER BY m.n
+    ''', (supply_ids, units))
+    rows = cursor.fetchall()
+    
+    if len(rows) != len(supply_ids):
+        raise UnitConversionError('Insumo no encontrado')
+    for row in rows:
+        if row['factor'] is None:
+            raise UnitConversionError(f"No hay conversión de {row['from_unit']} a {row['unit']} para {row['name']}")
+    return [row['factor'] for row in rows]
+
+def normalize_recipe_items(cursor, items):
+    """Cantidades de una receta en la unidad de cada insumo; las preparaciones van en su propia unidad.
+    Devuelve [(supply_id, preparation_id, cantidad, ítem)]"""
+    supply_items = [item for item in items if item.get('supply_id')]
+    factors = conversion_factors(cursor, [item['supply_id'] for item in supply_items],
+                                 [item.get('unit') for item in supply_items]) if supply_items else []
+    factor_of = {id(item): factor for item, factor in zip(supply_items, factors)}
+    
+    normalized = []
+    for item in items:
+        if not item.get('supply_id') and not item.get('preparation_id'):
+            raise UnitConversionError('Cada ítem de la receta necesita supply_id o preparation_id')
+        quantity = Decimal(str(item['quantity'])) * factor_of.get(id(item), 1)
+        normalized.append((item.get('supply_id'), None if item.get('supply_id') else item['preparation_id'], quantity, item))
+    return normalized
+
+def replace_product_recipe(cursor, product_id, supplies):
+    """Reemplazar la receta de un producto (insumos y preparaciones), aplanar su lista de materiales y recalcular su costo"""
+    items = normalize_recipe_items(cursor, supplies)
+    
+    cursor.execute('DELETE FROM product_supplies WHERE product_id = %s', (product_id,))
+    cursor.execute('''
+        INSERT INTO product_supplies (product_id, supply_id, preparation_id, quantity, optional)
+        SELECT %s, supply_id, preparation_id, quantity, optional
+        FROM unnest(%s::integer[], %s::integer[], %s::numeric[], %s::boolean[])
+            AS r(supply_id, preparation_id, quantity, optional)
+    ''', (product_id, [i[0] for i in items], [i[1] for i in items], [i[2] for i in items],
+          [i[3].get('optional', False) for i in items]))
+    
+    rebuild_product_bom(cursor, [product_id])
+    recompute_product_costs(cursor, product_ids=[product_id])
+
+# === MÉTRICAS ===
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas de rendimiento por ruta en formato Prometheus (requiere METRICS_TOKEN)"""
+    if not bearer_token_matches(os.getenv('METRICS_TOKEN')):
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+@admin_required
+def get_slow_queries():
+    """Sentencias lentas capturadas, agrupadas por huella, con el resumen del último plan"""
+    days = request.args.get('days', 7, type=int)
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            SELECT DISTINCT ON (fingerprint)
+                fingerprint, query, call_site, route, plan, captured_at AS last_captured_at,
+                COUNT(*) OVER w AS captures,
+                MAX(duration_ms) OVER w AS max_duration_ms,
+                AVG(duration_ms) OVER w AS avg_duration_ms
+            FROM slow_query_plans
+            WHERE captured_at >= NOW() - %s * INTERVAL '1 day'
+            WINDOW w AS (PARTITION BY fingerprint)
+            ORDER BY fingerprint, captured_at DESC
+        ''', (days,))
+        
+        queries = []
+        for row in cursor.fetchall():
+            row['plan_summary'] = summarize_plan(row.pop('plan'))
+            row['max_duration_ms'] = float(row['max_duration_ms'])
+            row['avg_duration_ms'] = round(float(row['avg_duration_ms']), 2)
+            row['last_captured_at'] = row['last_captured_at'].isoformat()
+            queries.append(row)
+        
+        queries.sort(key=lambda q: q['max_duration_ms'], reverse=True)
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(queries)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # === RUTAS DE AUTENTICACIÓN ===
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -73,6 +542,7 @@ def login():
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['role'] = user['role']
+            session['location_id'] = user['location_id']
             return redirect(url_for('dashboard'))
         else:
             return render_template('login.html', error='Usuario o contraseña incorrectos')
@@ -111,13 +581,14 @@ def dashboard():
     
     categories = cursor.fetchall()
     
-    # Obtener insumos bajos
+    # Obtener insumos bajos del local
     cursor.execute('''
-        SELECT id, name, stock, min_stock, unit
-        FROM supplies
-        WHERE stock <= min_stock
-        ORDER BY stock ASC
-    ''')
+        SELECT s.id, s.name, ls.stock, ls.min_stock, s.unit
+        FROM location_stock ls
+        JOIN supplies s ON s.id = ls.supply_id
+        WHERE ls.location_id = %s AND ls.stock <= ls.min_stock
+        ORDER BY ls.stock ASC
+    ''', (current_location_id(),))
     
     low_supplies = cursor.fetchall()
     
@@ -142,12 +613,15 @@ def get_product(product_id):
         return jsonify({'error': 'Producto no encontrado'}), 404
     
     cursor.execute('''
-        SELECT s.id, s.name, ps.quantity, ps.optional, s.stock
+        SELECT COALESCE(s.id, pr.id) AS id, COALESCE(s.name, pr.name) AS name, ps.quantity, ps.optional,
+               ps.preparation_id, ls.stock
         FROM product_supplies ps
-        JOIN supplies s ON ps.supply_id = s.id
+        LEFT JOIN supplies s ON ps.supply_id = s.id
+        LEFT JOIN preparations pr ON ps.preparation_id = pr.id
+        LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
         WHERE ps.product_id = %s
-        ORDER BY ps.optional, s.name
-    ''', (product_id,))
+        ORDER BY ps.optional, 2
+    ''', (current_location_id(), product_id))
     
     supplies = cursor.fetchall()
     
@@ -159,10 +633,27 @@ def get_product(product_id):
         'supplies': supplies
     })
 
+def day_closed_response(error):
+    """409 para una venta que el trigger de cierre de caja rechazó"""
+    return jsonify({'error': f'{error.diag.message_primary}: no admite ventas'}), 409
+
+# Columnas de sales que viajan en el evento sale.created
+SALE_EVENT_COLUMNS = 'id, product_id, quantity, unit_price, discount_amount, total_amount, ticket_id'
+
+def record_sale_event(cursor, location_id, sales):
+    """Evento sale.created con las líneas (filas de sales) de una venta o de un ticket completo"""
+    record_event(cursor, 'sale.created', {
+        'ticket_id': sales[0]['ticket_id'],
+        'user_id': session['user_id'],
+        'lines': sales,
+        'discount_amount': sum(sale['discount_amount'] or 0 for sale in sales),
+        'total_amount': sum(sale['total_amount'] or 0 for sale in sales),
+    }, aggregate_id=sales[0]['id'], location_id=location_id)
+
 @app.route('/api/sale', methods=['POST'])
 @login_required
 def register_sale():
-    """Registrar una venta y descontar insumos"""
+    """Registrar una venta y descontar insumos del local"""
     data = request.get_json()
     product_id = data.get('product_id')
     quantity = data.get('quantity', 1)
@@ -171,75 +662,52 @@ def register_sale():
     if not product_id:
         return jsonify({'error': 'Producto requerido'}), 400
     
+    location_id = current_location_id()
+    
+    # Precio vigente desde la caché de precios: queda registrado en la venta
+    unit_price = product_prices.price_at(int(product_id), datetime.now())
+    if unit_price is None:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Obtener insumos del producto
+        # Obtener insumos del producto (lista de materiales ya aplanada)
         cursor.execute('''
-            SELECT ps.supply_id, s.name, ps.quantity, s.stock, s.unit
-            FROM product_supplies ps
-            JOIN supplies s ON ps.supply_id = s.id
-            WHERE ps.product_id = %s
+            SELECT supply_id, quantity
+            FROM product_bom
+            WHERE product_id = %s
         ''', (product_id,))
         
         product_supplies = cursor.fetchall()
         
-        # Verificar stock disponible
-        for ps in product_supplies:
-            required = ps['quantity'] * quantity
-            if ps['stock'] < required:
-                cursor.close()
-                conn.close()
-                return jsonify({
-                    'error': f"Stock insuficiente de {ps['name']}. Disponible: {ps['stock']} {ps['unit']}"
-                }), 400
-        
         # Crear venta
-        cursor.execute('''
-            INSERT INTO sales (user_id, product_id, quantity)
-            VALUES (%s, %s, %s)
-            RETURNING id
-        ''', (session['user_id'], product_id, quantity))
+        cursor.execute(f'''
+            INSERT INTO sales (user_id, product_id, quantity, unit_price, total_amount, location_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING {SALE_EVENT_COLUMNS}
+        ''', (session['user_id'], product_id, quantity, unit_price, unit_price * quantity, location_id))
         
-        sale_id = cursor.fetchone()['id']
+        sale = cursor.fetchone()
+        sale_id = sale['id']
+        record_sale_event(cursor, location_id, [sale])
         
-        # Descontar insumos de producto
-        for ps in product_supplies:
-            quantity_to_deduct = ps['quantity'] * quantity
-            
-            cursor.execute('''
-                UPDATE supplies
-                SET stock = stock - %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (quantity_to_deduct, ps['supply_id']))
-            
-            # Registrar en historial
-            cursor.execute('''
-                INSERT INTO inventory_history (supply_id, quantity_change, type, description, user_id)
-                VALUES (%s, %s, 'venta', %s, %s)
-            ''', (ps['supply_id'], -quantity_to_deduct, f"Venta de producto ID {product_id}", session['user_id']))
-        
-        # Descontar insumos adicionales (descartables)
-        for supply_info in supplies_used:
-            supply_id = supply_info.get('supply_id')
-            qty = supply_info.get('quantity', 1)
-            
-            cursor.execute('''
-                UPDATE supplies
-                SET stock = stock - %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (qty, supply_id))
-            
+        # Descontar insumos del producto y descartables en una sola operación
+        movements = [(ps['supply_id'], -ps['quantity'] * quantity, 'venta', f"Venta de producto ID {product_id}")
+                     for ps in product_supplies]
+        movements += [(used.get('supply_id'), -used.get('quantity', 1), 'descartables', f"Descartables para venta ID {sale_id}")
+                      for used in supplies_used]
+        
+        apply_stock_movements(cursor, location_id, movements, session['user_id'])
+        
+        if supplies_used:
             cursor.execute('''
                 INSERT INTO supplies_used (sale_id, supply_id, quantity)
-                VALUES (%s, %s, %s)
-            ''', (sale_id, supply_id, qty))
-            
-            cursor.execute('''
-                INSERT INTO inventory_history (supply_id, quantity_change, type, description, user_id)
-                VALUES (%s, %s, 'descartables', %s, %s)
-            ''', (supply_id, -qty, f"Descartables para venta ID {sale_id}", session['user_id']))
+                SELECT %s, supply_id, quantity
+                FROM unnest(%s::integer[], %s::numeric[]) AS u(supply_id, quantity)
+            ''', (sale_id, [used.get('supply_id') for used in supplies_used],
+                  [used.get('quantity', 1) for used in supplies_used]))
         
         conn.commit()
         cursor.close()
@@ -247,10 +715,16 @@ def register_sale():
         
         return jsonify({'success': True, 'sale_id': sale_id})
     
+    except InsufficientStockError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         conn.rollback()
         cursor.close()
         conn.close()
+        if is_day_closed_error(e):
+            return day_closed_response(e)
         return jsonify({'error': str(e)}), 500
 
 # === RUTAS DE ADMINISTRACIÓN ===
@@ -305,23 +779,20 @@ def set_product_supplies():
     
     try:
         conn = get_db()
-        cursor = conn.cursor()
-        
-        # Limpiar insumos anteriores
-        cursor.execute('DELETE FROM product_supplies WHERE product_id = %s', (product_id,))
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Insertar nuevos
-        for supply in supplies:
-            cursor.execute('''
-                INSERT INTO product_supplies (product_id, supply_id, quantity, optional)
-                VALUES (%s, %s, %s, %s)
-            ''', (product_id, supply['supply_id'], supply['quantity'], supply.get('optional', False)))
+        # Reemplazar insumos anteriores (cantidades en la unidad de cada insumo)
+        replace_product_recipe(cursor, product_id, supplies)
         
         conn.commit()
         cursor.close()
         conn.close()
         
         return jsonify({'success': True})
+    except UnitConversionError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -333,11 +804,13 @@ def manage_inventory():
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     cursor.execute('''
-        SELECT s.id, s.name, s.stock, s.min_stock, s.unit, c.name as category
+        SELECT s.id, s.name, COALESCE(ls.stock, 0) AS stock, COALESCE(ls.min_stock, s.min_stock) AS min_stock,
+               COALESCE(ls.version, 0) AS version, s.unit, c.name as category
         FROM supplies s
+        LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
         LEFT JOIN categories c ON s.category_id = c.id
         ORDER BY c.name, s.name
-    ''')
+    ''', (current_location_id(),))
     
     supplies = cursor.fetchall()
     cursor.close()
@@ -348,41 +821,72 @@ def manage_inventory():
 @app.route('/api/admin/supply/<int:supply_id>', methods=['PUT'])
 @admin_required
 def update_supply(supply_id):
-    """Actualizar cantidad de insumo"""
-    data = request.get_json()
-    new_stock = data.get('stock')
-    notes = data.get('notes', '')
+    """Ajustar el stock de un insumo en el local: {"delta"} o {"stock", "expected_version"}"""
+    data = request.get_json() or {}
+    data['supply_id'] = supply_id
     
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Obtener stock anterior
-        cursor.execute('SELECT stock FROM supplies WHERE id = %s', (supply_id,))
-        current = cursor.fetchone()
+        result = adjust_stock(cursor, current_location_id(), [data], session['user_id'])[0]
         
-        if current:
-            difference = new_stock - current['stock']
-            
-            cursor.execute('''
-                UPDATE supplies
-                SET stock = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (new_stock, supply_id))
-            
-            # Registrar en historial
-            cursor.execute('''
-                INSERT INTO inventory_history (supply_id, quantity_change, type, description, user_id)
-                VALUES (%s, %s, 'restock', %s, %s)
-            ''', (supply_id, difference, notes or 'Actualización de inventario', session['user_id']))
-            
-            conn.commit()
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({'success': True, **result})
+    except StockConflictError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e), 'conflicts': e.conflicts}), 409
+    except (InsufficientStockError, ValueError, ArithmeticError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/supplies/adjust', methods=['POST'])
+@admin_required
+def bulk_adjust_supplies():
+    """Ajustar muchos insumos a la vez; si alguno tiene conflicto de versión no se aplica ninguno"""
+    data = request.get_json() or {}
+    adjustments = data.get('adjustments') or []
+    if not adjustments or not isinstance(adjustments, list):
+        return jsonify({'error': 'No hay ajustes'}), 400
+    for adjustment in adjustments:
+        if not isinstance(adjustment, dict) or not adjustment.get('supply_id') or \
+                (adjustment.get('delta') is None and adjustment.get('stock') is None):
+            return jsonify({'error': 'Cada ajuste necesita supply_id y delta o stock'}), 400
+        adjustment.setdefault('notes', data.get('notes'))
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
         
+        results = adjust_stock(cursor, current_location_id(), adjustments, session['user_id'])
+        
+        conn.commit()
         cursor.close()
         conn.close()
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'results': results})
+    except StockConflictError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e), 'conflicts': e.conflicts}), 409
+    except (InsufficientStockError, ValueError, ArithmeticError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/admin/export-csv')
@@ -393,54 +897,16 @@ def export_csv():
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        cursor.execute('''
-            SELECT c.name as categoria, s.name as insumo, s.stock as cantidad_actual, 
-                   s.unit as unidad, s.min_stock as stock_minimo
-            FROM supplies s
-            LEFT JOIN categories c ON s.category_id = c.id
-            ORDER BY c.name, s.name
-        ''')
-        
-        supplies = cursor.fetchall()
-        
-        # Obtener ventas del día
-        cursor.execute('''
-            SELECT p.name as producto, COUNT(*) as cantidad_vendida, 
-                   DATE(s.sale_date) as fecha
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE DATE(s.sale_date) = CURRENT_DATE
-            GROUP BY p.name, DATE(s.sale_date)
-            ORDER BY s.sale_date DESC
-        ''')
+        excel_buffer, filename = build_inventory_export(cursor, {'location_id': current_location_id()})
         
-        sales = cursor.fetchall()
         cursor.close()
         conn.close()
         
-        # Crear DataFrames
-        df_supplies = pd.DataFrame(supplies)
-        df_sales = pd.DataFrame(sales)
-        
-        # Crear archivo Excel
-        output = StringIO()
-        
-        # Usar BytesIO para crear archivo Excel binario
-        from io import BytesIO
-        excel_buffer = BytesIO()
-        
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            df_supplies.to_excel(writer, sheet_name='Inventario', index=False)
-            df_sales.to_excel(writer, sheet_name='Ventas', index=False)
-        
-        excel_buffer.seek(0)
-        
-        from flask import send_file
         return send_file(
             excel_buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=EXCEL_MIMETYPE,
             as_attachment=True,
-            download_name=f'inventario_illima_{datetime.now().strftime("%Y%m%d")}.xlsx'
+            download_name=filename
         )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -448,6 +914,7 @@ def export_csv():
 # === RUTAS DE UTILIDAD ===
 
 @app.route('/api/supplies')
+@conditional_get('supplies', stock=True)
 @login_required
 def get_supplies():
     """Obtener lista de insumos por categoría"""
@@ -455,10 +922,12 @@ def get_supplies():
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     cursor.execute('''
-        SELECT id, name, stock, unit, category_id
-        FROM supplies
-        ORDER BY category_id, name
-    ''')
+        SELECT s.id, s.name, COALESCE(ls.stock, 0) AS stock, COALESCE(ls.version, 0) AS version,
+               s.unit, s.category_id
+        FROM supplies s
+        LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
+        ORDER BY s.category_id, s.name
+    ''', (current_location_id(),))
     
     supplies = cursor.fetchall()
     cursor.close()
@@ -469,6 +938,7 @@ def get_supplies():
 # === RUTAS DE ADMINISTRACIÓN (ENHANCED PRODUCT MANAGEMENT) ===
 
 @app.route('/api/admin/products', methods=['GET'])
+@conditional_get('products', 'categories', 'product_supplies', admin=True)
 @admin_required
 def list_all_products():
     """Obtener lista completa de productos con filtros"""
@@ -482,7 +952,7 @@ def list_all_products():
         query = '''
             SELECT p.id, p.name, p.description, p.image_path, p.category_id, 
                    c.name as category_name, p.active, p.created_at,
-                   COUNT(ps.supply_id) as supply_count
+                   COUNT(*) FILTER (WHERE ps.id IS NOT NULL) as supply_count
             FROM products p
             LEFT JOIN categories c ON p.category_id = c.id
             LEFT JOIN product_supplies ps ON p.id = ps.product_id
@@ -518,6 +988,7 @@ def create_product():
     category_id = data.get('category_id')
     description = data.get('description', '')
     image_path = data.get('image_path')
+    price = data.get('price')
     
     if not name or not category_id:
         return jsonify({'error': 'Nombre y categoría requeridos'}), 400
@@ -527,15 +998,19 @@ def create_product():
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.execute('''
-            INSERT INTO products (name, category_id, description, image_path)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id, name, category_id, description, image_path, active, created_at
-        ''', (name, category_id, description, image_path))
+            INSERT INTO products (name, category_id, description, image_path, price)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id, name, category_id, description, image_path, price, active, created_at
+        ''', (name, category_id, description, image_path, price))
         
         product = cursor.fetchone()
+        if price is not None:
+            set_product_price(cursor, product['id'], price, notes='Precio inicial', user_id=session['user_id'])
+        recompute_product_costs(cursor, product_ids=[product['id']])
         conn.commit()
         cursor.close()
         conn.close()
+        product_prices.invalidate()
         
         return jsonify(product), 201
     except Exception as e:
@@ -552,9 +1027,11 @@ def manage_single_product(product_id):
         if request.method == 'GET':
             cursor.execute('''
                 SELECT p.id, p.name, p.description, p.image_path, p.category_id, 
-                       c.name as category_name, p.active, p.created_at
+                       c.name as category_name, p.price, p.active, p.created_at,
+                       pc.cost, pc.margin, pc.margin_pct
                 FROM products p
                 LEFT JOIN categories c ON p.category_id = c.id
+                LEFT JOIN product_costs pc ON pc.product_id = p.id
                 WHERE p.id = %s
             ''', (product_id,))
             
@@ -575,6 +1052,11 @@ def manage_single_product(product_id):
             description = data.get('description')
             image_path = data.get('image_path')
             active = data.get('active')
+            price = data.get('price')
+            
+            # El precio pasa por la lista de precios (queda en el historial)
+            if price is not None:
+                set_product_price(cursor, product_id, price, user_id=session['user_id'])
             
             cursor.execute('''
                 UPDATE products
@@ -584,13 +1066,14 @@ def manage_single_product(product_id):
                     image_path = COALESCE(%s, image_path),
                     active = COALESCE(%s, active)
                 WHERE id = %s
-                RETURNING id, name, category_id, description, image_path, active, created_at
+                RETURNING id, name, category_id, description, image_path, price, active, created_at
             ''', (name, category_id, description, image_path, active, product_id))
             
             product = cursor.fetchone()
             conn.commit()
             cursor.close()
             conn.close()
+            product_prices.invalidate()
             
             return jsonify(product)
         
@@ -624,12 +1107,15 @@ def manage_product_supplies_api(product_id):
         
         if request.method == 'GET':
             cursor.execute('''
-                SELECT s.id, s.name, ps.quantity, ps.optional, s.unit, s.stock
+                SELECT COALESCE(s.id, pr.id) AS id, COALESCE(s.name, pr.name) AS name, ps.quantity, ps.optional,
+                       COALESCE(s.unit, pr.unit) AS unit, ps.preparation_id, ls.stock
                 FROM product_supplies ps
-                JOIN supplies s ON ps.supply_id = s.id
+                LEFT JOIN supplies s ON ps.supply_id = s.id
+                LEFT JOIN preparations pr ON ps.preparation_id = pr.id
+                LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
                 WHERE ps.product_id = %s
-                ORDER BY ps.optional, s.name
-            ''', (product_id,))
+                ORDER BY ps.optional, 2
+            ''', (current_location_id(), product_id))
             
             supplies = cursor.fetchall()
             cursor.close()
@@ -641,13 +1127,7 @@ def manage_product_supplies_api(product_id):
             data = request.get_json()
             supplies = data.get('supplies', [])
             
-            cursor.execute('DELETE FROM product_supplies WHERE product_id = %s', (product_id,))
-            
-            for supply in supplies:
-                cursor.execute('''
-                    INSERT INTO product_supplies (product_id, supply_id, quantity, optional)
-                    VALUES (%s, %s, %s, %s)
-                ''', (product_id, supply['supply_id'], supply['quantity'], supply.get('optional', False)))
+            replace_product_recipe(cursor, product_id, supplies)
             
             conn.commit()
             cursor.close()
@@ -655,6 +1135,10 @@ def manage_product_supplies_api(product_id):
             
             return jsonify({'success': True, 'message': 'Insumos actualizados'})
     
+    except UnitConversionError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         if 'conn' in locals():
             conn.rollback()
@@ -696,6 +1180,7 @@ def bulk_update_products():
         conn.commit()
         cursor.close()
         conn.close()
+        product_prices.invalidate()
         
         return jsonify({'success': True, 'updated_count': len(product_ids)})
     except Exception as e:
@@ -704,29 +1189,186 @@ def bulk_update_products():
             conn.close()
         return jsonify({'error': str(e)}), 500
 
-# === SISTEMA DE VENTAS CON DESCUENTOS ===
+# === LISTA DE PRECIOS ===
 
-@app.route('/api/discounts', methods=['GET'])
-@login_required
-def get_discounts():
-    """Obtener lista de descuentos disponibles"""
+def load_product_prices():
+    """Productos con el precio vigente y los programados, para la caché de precios"""
+    conn = get_db()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute('''
+        SELECT p.id AS product_id, p.name, p.category_id, pp.effective_from, COALESCE(pp.price, p.price) AS price
+        FROM products p
+        LEFT JOIN LATERAL (
+            SELECT effective_from, price
+            FROM product_prices
+            WHERE product_id = p.id
+              AND effective_from >= COALESCE((
+                  SELECT MAX(effective_from) FROM product_prices
+                  WHERE product_id = p.id AND effective_from <= LOCALTIMESTAMP
+              ), '-infinity')
+        ) pp ON true
+        ORDER BY p.id, pp.effective_from
+    ''')
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return rows
+
+# Precio vigente de cada producto en memoria: la venta no consulta products ni product_prices
+product_prices = ProductPriceCache(load_product_prices)
+data_versions.on_change('products', product_prices.invalidate)
+data_versions.on_change('product_prices', product_prices.invalidate)
+
+def set_product_price(cursor, product_id, price, effective_from=None, notes=None, user_id=None):
+    """Agregar un precio a la lista (vigente ya o programado); si ya rige actualiza products.price y los costos"""
+    cursor.execute('''
+        INSERT INTO product_prices (product_id, price, effective_from, notes, user_id)
+        VALUES (%s, %s, COALESCE(%s, LOCALTIMESTAMP), %s, %s)
+        ON CONFLICT (product_id, effective_from) DO UPDATE
+            SET price = EXCLUDED.price, notes = EXCLUDED.notes, user_id = EXCLUDED.user_id
+        RETURNING id, product_id, price, effective_from, notes
+    ''', (product_id, price, effective_from, notes, user_id))
+    entry = cursor.fetchone()
+    
+    changed = apply_due_prices(cursor, [product_id])
+    if changed:
+        recompute_product_costs(cursor, product_ids=changed)
+    return entry
+
+@app.route('/api/admin/product/<int:product_id>/prices', methods=['GET', 'POST'])
+@admin_required
+def manage_product_prices(product_id):
+    """Historial de precios de un producto, o cargar un precio nuevo (con effective_from para programarlo)"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            price = Decimal(str(data.get('price')))
+            if not price.is_finite() or price < 0:
+                raise ValueError
+        except (ArithmeticError, ValueError):
+            return jsonify({'error': 'Precio inválido'}), 400
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        cursor.execute('''
-            SELECT id, name, description, discount_type, discount_value, 
-                   min_amount, active, created_at
-            FROM discounts
-            WHERE active = true
-            ORDER BY discount_value DESC
-        ''')
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT pp.id, pp.price, pp.effective_from, pp.notes, pp.created_at, u.username,
+                       pp.effective_from > LOCALTIMESTAMP AS scheduled
+                FROM product_prices pp
+                LEFT JOIN users u ON u.id = pp.user_id
+                WHERE pp.product_id = %s
+                ORDER BY pp.effective_from DESC
+            ''', (product_id,))
+            history = cursor.fetchall()
+            cursor.close()
+            conn.close()
+            
+            current = product_prices.price_at(product_id, datetime.now())
+            if current is None:
+                return jsonify({'error': 'Producto no encontrado'}), 404
+            return jsonify({'product_id': product_id, 'current_price': current, 'history': history})
         
-        discounts = cursor.fetchall()
+        entry = set_product_price(cursor, product_id, price, data.get('effective_from'),
+                                  data.get('notes'), session['user_id'])
+        
+        conn.commit()
         cursor.close()
         conn.close()
+        product_prices.invalidate()
         
-        return jsonify(discounts)
+        return jsonify(entry), 201
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+# === SISTEMA DE VENTAS CON DESCUENTOS ===
+
+DISCOUNT_TYPES = ('percentage', 'fixed', 'n_for_m')
+DISCOUNT_FIELDS = ('name', 'description', 'discount_type', 'discount_value', 'min_amount', 'active',
+                   'automatic', 'combinable', 'priority', 'product_ids', 'category_ids',
+                   'start_time', 'end_time', 'weekdays', 'buy_quantity', 'pay_quantity')
+# Las horas salen como texto: jsonify no serializa datetime.time
+DISCOUNT_COLUMNS = '''
+    id, name, description, discount_type, discount_value, min_amount, active, created_at,
+    automatic, combinable, priority, product_ids, category_ids,
+    to_char(start_time, 'HH24:MI') AS start_time, to_char(end_time, 'HH24:MI') AS end_time,
+    weekdays, buy_quantity, pay_quantity
+'''
+
+def load_active_discounts():
+    """Descuentos activos para la caché de reglas"""
+    conn = get_db()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f'''
+        SELECT {DISCOUNT_COLUMNS}
+        FROM discounts
+        WHERE active = true
+        ORDER BY discount_value DESC
+    ''')
+    discounts = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return discounts
+
+# Reglas activas en memoria: la venta no consulta la tabla discounts
+discount_rules = DiscountRuleCache(load_active_discounts)
+data_versions.on_change('discounts', discount_rules.invalidate)
+
+def validate_discount(data, partial=False):
+    """Mensaje de error si los datos del descuento no son válidos"""
+    discount_type = data.get('discount_type')
+    if not partial and (not data.get('name') or not discount_type):
+        return 'Datos requeridos faltantes'
+    if discount_type is not None and discount_type not in DISCOUNT_TYPES:
+        return 'Tipo de descuento inválido'
+    if discount_type == 'n_for_m':
+        buy, pay = data.get('buy_quantity'), data.get('pay_quantity')
+        if buy is None or pay is None or not int(buy) > int(pay) >= 0:
+            return 'Para N×M se requiere buy_quantity mayor que pay_quantity'
+    elif not partial and data.get('discount_value') is None:
+        return 'Datos requeridos faltantes'
+    if discount_type == 'percentage' and not 0 <= float(data.get('discount_value') or 0) <= 100:
+        return 'El porcentaje debe estar entre 0 y 100'
+    return None
+
+def cart_lines(items, moment):
+    """Líneas de carrito [{product_id, category_id, name, quantity, unit_price}] con el precio vigente en moment"""
+    quantities = defaultdict(int)
+    for item in items:
+        quantity = int(item.get('quantity', 1))
+        if quantity <= 0:
+            raise ValueError('Cantidad inválida')
+        quantities[int(item['product_id'])] += quantity
+    
+    lines = []
+    for product_id, quantity in quantities.items():
+        product = product_prices.product(product_id)
+        if product is None:
+            raise ValueError(f'Producto no encontrado: {product_id}')
+        lines.append({'product_id': product_id, 'category_id': product['category_id'], 'name': product['name'],
+                      'quantity': quantity, 'unit_price': product_prices.price_at(product_id, moment)})
+    return lines
+
+def selected_discount_ids(data):
+    """Descuentos elegidos en la petición: discount_ids o el discount_id de siempre"""
+    selected = data.get('discount_ids') or ([data['discount_id']] if data.get('discount_id') else [])
+    return [int(discount_id) for discount_id in selected]
+
+@app.route('/api/discounts', methods=['GET'])
+@conditional_get('discounts')
+@login_required
+def get_discounts():
+    """Obtener lista de descuentos disponibles (desde la caché de reglas)"""
+    try:
+        return jsonify(discount_rules.rows())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -734,33 +1376,39 @@ def get_discounts():
 @admin_required
 def create_discount():
     """Crear nuevo descuento"""
-    data = request.get_json()
-    name = data.get('name')
-    description = data.get('description', '')
-    discount_type = data.get('discount_type')  # 'percentage' or 'fixed'
-    discount_value = data.get('discount_value')
-    min_amount = data.get('min_amount', 0)
+    data = request.get_json() or {}
+    data.setdefault('description', '')
+    data.setdefault('min_amount', 0)
+    if data.get('discount_type') == 'n_for_m':
+        data.setdefault('discount_value', 0)
     
-    if not name or not discount_type or discount_value is None:
-        return jsonify({'error': 'Datos requeridos faltantes'}), 400
+    error = validate_discount(data)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    fields = [field for field in DISCOUNT_FIELDS if field in data]
     
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        cursor.execute('''
-            INSERT INTO discounts (name, description, discount_type, discount_value, min_amount)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id, name, description, discount_type, discount_value, min_amount, active
-        ''', (name, description, discount_type, discount_value, min_amount))
+        cursor.execute(f'''
+            INSERT INTO discounts ({', '.join(fields)})
+            VALUES ({', '.join(['%s'] * len(fields))})
+            RETURNING {DISCOUNT_COLUMNS}
+        ''', [data[field] for field in fields])
         
         discount = cursor.fetchone()
         conn.commit()
         cursor.close()
         conn.close()
+        discount_rules.invalidate()
         
         return jsonify(discount), 201
     except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/admin/discount/<int:discount_id>', methods=['GET', 'PUT', 'DELETE'])
@@ -772,7 +1420,7 @@ def manage_discount(discount_id):
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         if request.method == 'GET':
-            cursor.execute('SELECT * FROM discounts WHERE id = %s', (discount_id,))
+            cursor.execute(f'SELECT {DISCOUNT_COLUMNS} FROM discounts WHERE id = %s', (discount_id,))
             discount = cursor.fetchone()
             cursor.close()
             conn.close()
@@ -783,25 +1431,39 @@ def manage_discount(discount_id):
             return jsonify(discount)
         
         elif request.method == 'PUT':
-            data = request.get_json()
+            data = request.get_json() or {}
+            fields = [field for field in DISCOUNT_FIELDS if field in data]
+            if not fields:
+                cursor.close()
+                conn.close()
+                return jsonify({'error': 'No hay campos para actualizar'}), 400
             
-            cursor.execute('''
-                UPDATE discounts
-                SET name = COALESCE(%s, name),
-                    description = COALESCE(%s, description),
-                    discount_type = COALESCE(%s, discount_type),
-                    discount_value = COALESCE(%s, discount_value),
-                    min_amount = COALESCE(%s, min_amount),
-                    active = COALESCE(%s, active)
+            # Validar con los valores resultantes, no solo con los enviados
+            cursor.execute('SELECT discount_type, discount_value, buy_quantity, pay_quantity FROM discounts WHERE id = %s',
+                           (discount_id,))
+            current = cursor.fetchone()
+            if not current:
+                cursor.close()
+                conn.close()
+                return jsonify({'error': 'Descuento no encontrado'}), 404
+            error = validate_discount({**current, **data}, partial=True)
+            if error:
+                cursor.close()
+                conn.close()
+                return jsonify({'error': error}), 400
+            
+            cursor.execute(f'''
+                UPDATE discounts
+                SET {', '.join(f'{field} = %s' for field in fields)}
                 WHERE id = %s
-                RETURNING id, name, description, discount_type, discount_value, min_amount, active
-            ''', (data.get('name'), data.get('description'), data.get('discount_type'),
-                  data.get('discount_value'), data.get('min_amount'), data.get('active'), discount_id))
+                RETURNING {DISCOUNT_COLUMNS}
+            ''', [data[field] for field in fields] + [discount_id])
             
             discount = cursor.fetchone()
             conn.commit()
             cursor.close()
             conn.close()
+            discount_rules.invalidate()
             
             return jsonify(discount)
         
@@ -810,6 +1472,7 @@ def manage_discount(discount_id):
             conn.commit()
             cursor.close()
             conn.close()
+            discount_rules.invalidate()
             
             return jsonify({'success': True})
     
@@ -819,6 +1482,120 @@ def manage_discount(discount_id):
             conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cart/price', methods=['POST'])
+@login_required
+def price_cart_route():
+    """Calcular subtotal, descuentos y total de un carrito sin registrar la venta"""
+    data = request.get_json() or {}
+    items = data.get('items') or []
+    if not items:
+        return jsonify({'error': 'Carrito vacío'}), 400
+    
+    try:
+        moment = datetime.now()
+        lines = cart_lines(items, moment)
+        return jsonify(price_cart(discount_rules.rules(), lines, moment, selected_discount_ids(data)))
+    except (ValueError, KeyError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cart-sale', methods=['POST'])
+@login_required
+def register_cart_sale():
+    """Registrar un carrito completo como un ticket, en una sola transacción"""
+    data = request.get_json() or {}
+    items = data.get('items') or []
+    supplies_used = data.get('supplies_used', [])
+    
+    if not items:
+        return jsonify({'error': 'Carrito vacío'}), 400
+    
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        selected = selected_discount_ids(data)
+        moment = datetime.now()
+        lines = cart_lines(items, moment)
+        priced = price_cart(discount_rules.rules(), lines, moment, selected)
+        
+        # Una fila de venta por producto, todas con el mismo ticket; cada una con
+        # las reglas que la descontaron (discount_id: la primera, o null)
+        cursor.execute(f'''
+            WITH ticket AS (SELECT nextval('sales_ticket_seq') AS id)
+            INSERT INTO sales (user_id, product_id, quantity, unit_price, discount_id, discount_amount,
+                               total_amount, discount_info, location_id, ticket_id)
+            SELECT %s, l.product_id, l.quantity, l.unit_price, l.discount_id, l.discount_amount, l.total_amount,
+                   l.discount_info, %s, ticket.id
+            FROM unnest(%s::integer[], %s::integer[], %s::numeric[], %s::integer[], %s::numeric[], %s::numeric[],
+                        %s::text[])
+                AS l(product_id, quantity, unit_price, discount_id, discount_amount, total_amount, discount_info)
+            CROSS JOIN ticket
+            RETURNING {SALE_EVENT_COLUMNS}
+        ''', (session['user_id'], location_id,
+              [line['product_id'] for line in priced['lines']], [int(line['quantity']) for line in priced['lines']],
+              [line['unit_price'] for line in priced['lines']],
+              [line['applied'][0]['id'] if line['applied'] else None for line in priced['lines']],
+              [line['discount'] for line in priced['lines']], [line['total'] for line in priced['lines']],
+              [json.dumps(line['applied'], default=str) if line['applied'] else None for line in priced['lines']]))
+        
+        sales = cursor.fetchall()
+        ticket_id = sales[0]['ticket_id']
+        record_sale_event(cursor, location_id, sales)
+        
+        # Insumos de todos los productos del carrito en una sola consulta
+        cursor.execute('''
+            SELECT product_id, supply_id, quantity
+            FROM product_bom
+            WHERE product_id = ANY(%s)
+        ''', ([line['product_id'] for line in lines],))
+        
+        quantities = {line['product_id']: line['quantity'] for line in lines}
+        movements = [(row['supply_id'], -row['quantity'] * quantities[row['product_id']], 'venta', f"Venta ticket {ticket_id}")
+                     for row in cursor.fetchall()]
+        movements += [(used.get('supply_id'), -used.get('quantity', 1), 'descartables', f"Descartables ticket {ticket_id}")
+                      for used in supplies_used]
+        
+        apply_stock_movements(cursor, location_id, movements, session['user_id'])
+        
+        # Los descartables se registran contra la primera línea del ticket
+        if supplies_used:
+            cursor.execute('''
+                INSERT INTO supplies_used (sale_id, supply_id, quantity)
+                SELECT %s, supply_id, quantity
+                FROM unnest(%s::integer[], %s::numeric[]) AS u(supply_id, quantity)
+            ''', (sales[0]['id'], [used.get('supply_id') for used in supplies_used],
+                  [used.get('quantity', 1) for used in supplies_used]))
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'ticket_id': ticket_id,
+            'sale_ids': [sale['id'] for sale in sales],
+            'subtotal': priced['subtotal'],
+            'discount_amount': priced['discount'],
+            'total_amount': priced['total'],
+            'applied': priced['applied']
+        })
+    
+    except (InsufficientStockError, ValueError, KeyError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        if is_day_closed_error(e):
+            return day_closed_response(e)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/sale-with-discount', methods=['POST'])
 @login_required
 def register_sale_with_discount():
@@ -833,116 +1610,79 @@ def register_sale_with_discount():
     if not product_id:
         return jsonify({'error': 'Producto requerido'}), 400
     
+    location_id = current_location_id()
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Obtener producto
-        cursor.execute('SELECT id, name FROM products WHERE id = %s', (product_id,))
-        product = cursor.fetchone()
+        # Producto y precio vigente desde la caché de precios
+        moment = datetime.now()
+        product = product_prices.product(int(product_id))
         if not product:
             cursor.close()
             conn.close()
             return jsonify({'error': 'Producto no encontrado'}), 404
+        unit_price = product_prices.price_at(product['product_id'], moment)
         
-        # Obtener insumos del producto
+        # Obtener insumos del producto (lista de materiales ya aplanada)
         cursor.execute('''
-            SELECT ps.supply_id, s.name, ps.quantity, s.stock, s.unit
-            FROM product_supplies ps
-            JOIN supplies s ON ps.supply_id = s.id
-            WHERE ps.product_id = %s
+            SELECT supply_id, quantity
+            FROM product_bom
+            WHERE product_id = %s
         ''', (product_id,))
         
         product_supplies = cursor.fetchall()
         
-        # Verificar stock disponible
-        for ps in product_supplies:
-            required = ps['quantity'] * quantity
-            if ps['stock'] < required:
-                cursor.close()
-                conn.close()
-                return jsonify({
-                    'error': f"Stock insuficiente de {ps['name']}. Disponible: {ps['stock']} {ps['unit']}"
-                }), 400
-        
-        # Obtener precio del producto (si existe)
-        cursor.execute('SELECT price FROM products WHERE id = %s', (product_id,))
-        price_row = cursor.fetchone()
-        unit_price = price_row['price'] if price_row and price_row['price'] else 0
-        
-        # Calcular descuento
-        discount_amount = 0
-        discount_info = {'type': 'ninguno', 'value': 0}
-        
-        if discount_id:
-            cursor.execute('SELECT discount_type, discount_value FROM discounts WHERE id = %s', (discount_id,))
-            discount = cursor.fetchone()
-            if discount:
-                subtotal = unit_price * quantity
-                if discount['discount_type'] == 'percentage':
-                    discount_amount = (subtotal * discount['discount_value']) / 100
-                    discount_info = {'type': 'porcentaje', 'value': discount['discount_value']}
-                else:
-                    discount_amount = discount['discount_value'] * quantity
-                    discount_info = {'type': 'fijo', 'value': discount['discount_value']}
-        elif custom_discount:
+        # Calcular descuento: uno personalizado, o las reglas en memoria (automáticas más la elegida)
+        if custom_discount and not discount_id:
+            discount_amount = 0
+            discount_info = custom_discount
             subtotal = unit_price * quantity
             if isinstance(custom_discount, dict):
                 if custom_discount.get('type') == 'percentage':
                     discount_amount = (subtotal * custom_discount.get('value', 0)) / 100
-                    discount_info = custom_discount
                 else:
                     discount_amount = custom_discount.get('value', 0)
-                    discount_info = custom_discount
-        
-        total_amount = max(0, (unit_price * quantity) - discount_amount)
+            total_amount = max(0, subtotal - discount_amount)
+        else:
+            priced = price_cart(discount_rules.rules(),
+                                [{'product_id': product['product_id'], 'category_id': product['category_id'],
+                                  'quantity': quantity, 'unit_price': unit_price}],
+                                moment, selected_discount_ids(data))
+            discount_amount = priced['discount']
+            total_amount = priced['total']
+            discount_info = priced['applied']
+            discount_id = priced['applied'][0]['id'] if priced['applied'] else None
         
         # Crear venta
-        cursor.execute('''
-            INSERT INTO sales (user_id, product_id, quantity, discount_id, 
-                             discount_amount, total_amount, discount_info)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (session['user_id'], product_id, quantity, discount_id, 
-              discount_amount, total_amount, str(discount_info)))
-        
-        sale_id = cursor.fetchone()['id']
-        
-        # Descontar insumos
-        for ps in product_supplies:
-            quantity_to_deduct = ps['quantity'] * quantity
-            
-            cursor.execute('''
-                UPDATE supplies
-                SET stock = stock - %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (quantity_to_deduct, ps['supply_id']))
-            
-            cursor.execute('''
-                INSERT INTO inventory_history (supply_id, quantity_change, type, description, user_id)
-                VALUES (%s, %s, 'venta', %s, %s)
-            ''', (ps['supply_id'], -quantity_to_deduct, f"Venta ID {sale_id}", session['user_id']))
-        
-        # Descontar insumos adicionales
-        for supply_info in supplies_used:
-            supply_id = supply_info.get('supply_id')
-            qty = supply_info.get('quantity', 1)
-            
-            cursor.execute('''
-                UPDATE supplies
-                SET stock = stock - %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (qty, supply_id))
-            
+        cursor.execute(f'''
+            INSERT INTO sales (user_id, product_id, quantity, unit_price, discount_id, 
+                             discount_amount, total_amount, discount_info, location_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING {SALE_EVENT_COLUMNS}
+        ''', (session['user_id'], product_id, quantity, unit_price, discount_id, 
+              discount_amount, total_amount, json.dumps(discount_info, default=str), location_id))
+        
+        sale = cursor.fetchone()
+        sale_id = sale['id']
+        record_sale_event(cursor, location_id, [sale])
+        
+        # Descontar insumos del producto y descartables en una sola operación
+        movements = [(ps['supply_id'], -ps['quantity'] * quantity, 'venta', f"Venta ID {sale_id}")
+                     for ps in product_supplies]
+        movements += [(used.get('supply_id'), -used.get('quantity', 1), 'descartables', f"Descartables venta ID {sale_id}")
+                      for used in supplies_used]
+        
+        apply_stock_movements(cursor, location_id, movements, session['user_id'])
+        
+        if supplies_used:
             cursor.execute('''
                 INSERT INTO supplies_used (sale_id, supply_id, quantity)
-                VALUES (%s, %s, %s)
-            ''', (sale_id, supply_id, qty))
-            
-            cursor.execute('''
-                INSERT INTO inventory_history (supply_id, quantity_change, type, description, user_id)
-                VALUES (%s, %s, 'descartables', %s, %s)
-            ''', (supply_id, -qty, f"Descartables venta ID {sale_id}", session['user_id']))
+                SELECT %s, supply_id, quantity
+                FROM unnest(%s::integer[], %s::numeric[]) AS u(supply_id, quantity)
+            ''', (sale_id, [used.get('supply_id') for used in supplies_used],
+                  [used.get('quantity', 1) for used in supplies_used]))
         
         conn.commit()
         cursor.close()
@@ -955,61 +1695,372 @@ def register_sale_with_discount():
             'discount_amount': discount_amount
         })
     
+    except InsufficientStockError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        if is_day_closed_error(e):
+            return day_closed_response(e)
+        return jsonify({'error': str(e)}), 500
+
+# === ANULACIONES Y DEVOLUCIONES ===
+
+# Tipo de movimiento con el que vuelve al stock lo descontado por una venta devuelta
+REFUND_TYPE = 'devolucion'
+
+def refund_sales(cursor, sale_ids=(), ticket_ids=(), quantities=None, reason=None, user_id=None, location_id=None):
+    """Devolver líneas de venta (todo lo que les queda o algunas unidades) y reponer el stock que descontaron.
+    
+    sale_ids y ticket_ids se anulan completos; quantities {sale_id: unidades}
+    devuelve solo esas unidades. Una línea ya anulada se saltea, así que repetir
+    una anulación no cambia nada. Con location_id solo se aceptan ventas de ese
+    local. Devuelve por línea las unidades y el importe devueltos.
+    
+    Las líneas (y las demás del mismo ticket) se bloquean en orden de id y se
+    actualizan, junto con el registro en sale_refunds, en una sola sentencia.
+    Cada unidad devuelta repone su receta (product_bom). Los descartables son
+    del ticket, así que se reponen cuando el ticket queda anulado del todo (una
+    venta sin ticket, cuando se anula la línea). Todo entra por
+    apply_stock_movements, un UPDATE por local con los movimientos al outbox en
+    un solo INSERT. Lo repuesto queda como stock sin lote.
+    """
+    quantities = {int(sale_id): int(quantity) for sale_id, quantity in (quantities or {}).items()}
+    if any(quantity <= 0 for quantity in quantities.values()):
+        raise ValueError('Cantidad a devolver inválida')
+    sale_ids = sorted(set(map(int, sale_ids)) | set(quantities))
+    ticket_ids = sorted(set(map(int, ticket_ids)))
+    if not sale_ids and not ticket_ids:
+        raise ValueError('Indicar las ventas o tickets a devolver')
+    
+    # También se bloquean las otras líneas de los tickets, para saber si el ticket queda anulado
+    cursor.execute('''
+        SELECT id, sale_date, ticket_id, product_id, location_id, quantity, refunded_quantity,
+               COALESCE(total_amount, 0) AS total_amount, refunded_amount,
+               (id = ANY(%s) OR ticket_id = ANY(%s)) AS requested
+        FROM sales
+        WHERE id = ANY(%s) OR ticket_id = ANY(%s)
+           OR ticket_id IN (SELECT ticket_id FROM sales WHERE id = ANY(%s) AND ticket_id IS NOT NULL)
+        ORDER BY id
+        FOR UPDATE
+    ''', (sale_ids, ticket_ids, sale_ids, ticket_ids, sale_ids))
+    ticket_lines = cursor.fetchall()
+    lines = [line for line in ticket_lines if line['requested']]
+    
+    found_sales = {line['id'] for line in lines}
+    found_tickets = {line['ticket_id'] for line in lines}
+    missing = [str(sale_id) for sale_id in sale_ids if sale_id not in found_sales]
+    missing += [f'ticket {ticket_id}' for ticket_id in ticket_ids if ticket_id not in found_tickets]
+    if missing:
+        raise ValueError(f"Venta no encontrada: {', '.join(missing)}")
+    if location_id is not None and any(line['location_id'] != location_id for line in lines):
+        raise ValueError('Solo se pueden devolver ventas del local')
+    
+    refunds = []
+    for line in lines:
+        remaining = line['quantity'] - line['refunded_quantity']
+        quantity = quantities.get(line['id'], remaining)
+        if quantity > remaining:
+            raise ValueError(f"Venta {line['id']}: quedan {remaining} unidades sin devolver")
+        if not quantity:
+            continue
+        # La última devolución de la línea se lleva el resto exacto del importe (sin diferencias de redondeo)
+        if quantity == remaining:
+            amount = line['total_amount'] - line['refunded_amount']
+        else:
+            amount = (line['total_amount'] * quantity / line['quantity']).quantize(Decimal('0.01'))
+        refunds.append({'sale_id': line['id'], 'sale_date': line['sale_date'], 'ticket_id': line['ticket_id'],
+                        'product_id': line['product_id'], 'location_id': line['location_id'],
+                        'quantity': quantity, 'amount': amount, 'voided': quantity == remaining})
+    if not refunds:
+        return []
+    
+    # Un día con cierre de caja no cambia (el trigger de sales también lo impide)
+    cursor.execute('''
+        SELECT MIN(business_date) AS business_date FROM day_closes
+        WHERE (location_id, business_date) IN (SELECT * FROM unnest(%s::integer[], %s::date[]))
+    ''', ([r['location_id'] for r in refunds], [r['sale_date'].date() for r in refunds]))
+    closed = cursor.fetchone()
+    if closed and closed['business_date']:
+        raise DayClosedError(f"El día {closed['business_date']} tiene cierre de caja: no admite devoluciones")
+    
+    cursor.execute('''
+        WITH refunded AS (
+            UPDATE sales s
+            SET refunded_quantity = s.refunded_quantity + r.quantity,
+                refunded_amount = s.refunded_amount + r.amount
+            FROM unnest(%s::integer[], %s::timestamp[], %s::integer[], %s::numeric[]) AS r(id, sale_date, quantity, amount)
+            WHERE s.id = r.id AND s.sale_date = r.sale_date
+            RETURNING s.id, s.sale_date, s.ticket_id, s.product_id, s.location_id, r.quantity, r.amount
+        )
+        INSERT INTO sale_refunds (sale_id, sale_date, ticket_id, product_id, location_id, quantity, amount,
+                                  reason, user_id)
+        SELECT id, sale_date, ticket_id, product_id, location_id, quantity, amount, %s, %s
+        FROM refunded
+    ''', ([r['sale_id'] for r in refunds], [r['sale_date'] for r in refunds],
+          [r['quantity'] for r in refunds], [r['amount'] for r in refunds], reason, user_id))
+    
+    # Descartables: los de los tickets que quedan anulados del todo y los de las ventas sin ticket anuladas
+    refunded_now = {r['sale_id']: r['quantity'] for r in refunds}
+    tickets = defaultdict(list)
+    for line in ticket_lines:
+        if line['ticket_id'] is not None:
+            tickets[line['ticket_id']].append(line)
+    voided = [r for r in refunds if r['ticket_id'] is None and r['voided']]
+    for ticket in tickets.values():
+        if any(line['id'] in refunded_now for line in ticket) and all(
+                line['refunded_quantity'] + refunded_now.get(line['id'], 0) >= line['quantity'] for line in ticket):
+            voided += [{'sale_id': line['id'], 'location_id': line['location_id']} for line in ticket]
+    
+    # Receta de las unidades devueltas y descartables, por local e insumo
+    cursor.execute('''
+        SELECT r.location_id, b.supply_id, SUM(b.quantity * r.quantity) AS quantity
+        FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS r(product_id, location_id, quantity)
+        JOIN product_bom b ON b.product_id = r.product_id
+        GROUP BY r.location_id, b.supply_id
+        UNION ALL
+        SELECT v.location_id, u.supply_id, SUM(u.quantity)
+        FROM unnest(%s::integer[], %s::integer[]) AS v(sale_id, location_id)
+        JOIN supplies_used u ON u.sale_id = v.sale_id
+        GROUP BY v.location_id, u.supply_id
+    ''', ([r['product_id'] for r in refunds], [r['location_id'] for r in refunds], [r['quantity'] for r in refunds],
+          [r['sale_id'] for r in voided], [r['location_id'] for r in voided]))
+    restock = defaultdict(list)
+    for row in cursor.fetchall():
+        restock[row['location_id']].append(row)
+    
+    for refund_location_id in sorted({r['location_id'] for r in refunds}):
+        location_refunds = [r for r in refunds if r['location_id'] == refund_location_id]
+        tickets = {r['ticket_id'] for r in location_refunds}
+        if len(location_refunds) == 1:
+            description = f"Devolución venta ID {location_refunds[0]['sale_id']}"
+        elif len(tickets) == 1 and None not in tickets:
+            description = f'Devolución ticket {tickets.pop()}'
+        else:
+            description = f'Devolución de {len(location_refunds)} líneas de venta'
+        if reason:
+            description += f': {reason}'
+        
+        apply_stock_movements(cursor, refund_location_id,
+                              [(row['supply_id'], row['quantity'], REFUND_TYPE, description)
+                               for row in restock[refund_location_id]], user_id)
+        
+        record_event(cursor, 'sale.refunded', {
+            'user_id': user_id,
+            'reason': reason,
+            'lines': [{key: r[key] for key in ('sale_id', 'ticket_id', 'product_id', 'quantity', 'amount', 'voided')}
+                      for r in location_refunds],
+            'amount': sum(r['amount'] for r in location_refunds),
+        }, aggregate_id=location_refunds[0]['sale_id'], location_id=refund_location_id)
+    
+    # Los reportes abiertos en caché que incluyen esos días quedan desactualizados
+    refund_days = [r['sale_date'].date() for r in refunds]
+    invalidate_reports(cursor, {r['location_id'] for r in refunds}, min(refund_days), max(refund_days))
+    
+    return [{key: r[key] for key in ('sale_id', 'ticket_id', 'quantity', 'amount', 'voided')} for r in refunds]
+
+def refund_response(location_id, **kwargs):
+    """Ejecutar refund_sales en una transacción y armar la respuesta de las rutas de devolución"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        refunds = refund_sales(cursor, user_id=session['user_id'], location_id=location_id, **kwargs)
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'refunds': refunds,
+            'refunded_amount': sum(refund['amount'] for refund in refunds)
+        })
+    
+    except DayClosedError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 409
+    except (ValueError, TypeError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sales/refund', methods=['POST'])
+@admin_required
+def refund_sale():
+    """Anular una venta o un ticket del local, o devolver algunas unidades: {sale_id | ticket_id | lines, reason}"""
+    data = request.get_json() or {}
+    lines = data.get('lines') or []
+    
+    if not (data.get('sale_id') or data.get('ticket_id') or lines):
+        return jsonify({'error': 'Venta, ticket o líneas requeridos'}), 400
+    if any(not isinstance(line, dict) or not line.get('sale_id') or not line.get('quantity') for line in lines):
+        return jsonify({'error': 'Cada línea necesita sale_id y quantity'}), 400
+    
+    return refund_response(current_location_id(),
+                           sale_ids=[data['sale_id']] if data.get('sale_id') else [],
+                           ticket_ids=[data['ticket_id']] if data.get('ticket_id') else [],
+                           quantities={line['sale_id']: line['quantity'] for line in lines},
+                           reason=data.get('reason'))
+
+@app.route('/api/admin/sales/void', methods=['POST'])
+@admin_required
+def void_sales():
+    """Anular muchas ventas y tickets de una vez, de cualquier local (correcciones de fin de día)"""
+    data = request.get_json() or {}
+    sale_ids = data.get('sale_ids') or []
+    ticket_ids = data.get('ticket_ids') or []
+    
+    if not isinstance(sale_ids, list) or not isinstance(ticket_ids, list) or not (sale_ids or ticket_ids):
+        return jsonify({'error': 'sale_ids o ticket_ids requeridos'}), 400
+    
+    return refund_response(None, sale_ids=sale_ids, ticket_ids=ticket_ids, reason=data.get('reason'))
+
+# === CIERRE DE CAJA ===
+
+@app.route('/api/admin/day-close', methods=['POST'])
+@admin_required
+def close_day_route():
+    """Cerrar la caja del local en un día (por defecto hoy) y devolver el reporte Z: {date?}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        business_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else datetime.now().date()
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Fecha inválida (AAAA-MM-DD)'}), 400
+    
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        close_day(cursor, location_id, business_date, session['user_id'])
+        report = day_close_report(cursor, location_id, business_date)
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(report), 201
+    
+    except DayClosedError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         if 'conn' in locals():
             conn.rollback()
             conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/day-closes', methods=['GET'])
+@admin_required
+def list_day_closes():
+    """Cierres de caja del local, con sus totales: ?start_date&end_date"""
+    try:
+        start = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas (AAAA-MM-DD)'}), 400
+    
+    try:
+        conn = get_db('replica')
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        closes = day_closes_between(cursor, current_location_id(), start, end)
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(closes)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/day-closes/<business_date>', methods=['GET'])
+@admin_required
+def get_day_close(business_date):
+    """Reporte Z guardado de un día: totales y desglose por cajero, producto y descuento"""
+    try:
+        day = datetime.strptime(business_date, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida (AAAA-MM-DD)'}), 400
+    
+    try:
+        conn = get_db('replica')
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        report = day_close_report(cursor, current_location_id(), day)
+        
+        cursor.close()
+        conn.close()
+        
+        if not report:
+            return jsonify({'error': 'El día no tiene cierre de caja'}), 404
+        return jsonify(report)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/admin/sales-report', methods=['GET'])
 @admin_required
 def get_sales_report():
-    """Obtener reporte de ventas con descuentos"""
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    """Obtener reporte de ventas con descuentos (totales de los días cerrados desde el reporte Z)"""
+    try:
+        start, end = parse_report_dates(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas (AAAA-MM-DD)'}), 400
+    
+    location_id = current_location_id()
     
     try:
-        conn = get_db()
+        conn = get_db('replica')
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         query = '''
-            SELECT s.id, s.sale_date, p.name as product_name, s.quantity, 
+            SELECT s.id, s.sale_date, p.name as product_name, s.quantity, s.unit_price,
                    s.total_amount, s.discount_amount, s.discount_info,
+                   s.refunded_quantity, s.refunded_amount,
                    u.username as seller
             FROM sales s
             JOIN products p ON s.product_id = p.id
             JOIN users u ON s.user_id = u.id
-            WHERE 1=1
+            WHERE s.location_id = %s
         '''
-        params = []
+        params = [location_id]
         
-        if start_date:
-            query += ' AND DATE(s.sale_date) >= %s'
-            params.append(start_date)
+        if start:
+            query += ' AND s.sale_date >= %s'
+            params.append(start)
         
-        if end_date:
-            query += ' AND DATE(s.sale_date) <= %s'
-            params.append(end_date)
+        if end:
+            query += ' AND s.sale_date < %s::date + 1'
+            params.append(end)
         
         query += ' ORDER BY s.sale_date DESC'
         
         cursor.execute(query, params)
         sales = cursor.fetchall()
         
-        # Calcular totales
-        total_sales = sum(s['total_amount'] for s in sales) if sales else 0
-        total_discounts = sum(s['discount_amount'] for s in sales) if sales else 0
+        totals = sales_totals(cursor, location_id, start, end)
         
         cursor.close()
         conn.close()
         
         return jsonify({
             'sales': sales,
-            'totals': {
-                'total_sales': total_sales,
-                'total_discounts': total_discounts,
-                'sales_count': len(sales)
-            }
+            'totals': totals
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1025,11 +2076,13 @@ def get_inventory():
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         cursor.execute('''
-            SELECT s.id, s.name, s.stock, s.min_stock, s.unit, c.name as category
+            SELECT s.id, s.name, COALESCE(ls.stock, 0) AS stock, COALESCE(ls.min_stock, s.min_stock) AS min_stock,
+                   s.unit, c.name as category
             FROM supplies s
+            LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
             LEFT JOIN categories c ON s.category_id = c.id
             ORDER BY c.name, s.name
-        ''')
+        ''', (current_location_id(),))
         
         supplies = cursor.fetchall()
         cursor.close()
@@ -1043,6 +2096,8 @@ def get_inventory():
 @login_required
 def get_dashboard_stats():
     """Obtener estadísticas del dashboard"""
+    location_id = current_location_id()
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -1054,22 +2109,27 @@ def get_dashboard_stats():
         # Total de ventas del mes
         cursor.execute('''
             SELECT COUNT(*) as total FROM sales 
-            WHERE DATE_TRUNC('month', sale_date) = DATE_TRUNC('month', CURRENT_DATE)
-        ''')
+            WHERE location_id = %s AND sale_date >= DATE_TRUNC('month', CURRENT_DATE)
+              AND refunded_quantity < quantity
+        ''', (location_id,))
         total_sales = cursor.fetchone()['total']
         
         # Items con stock bajo
-        cursor.execute('SELECT COUNT(*) as total FROM supplies WHERE stock <= min_stock')
+        cursor.execute('''
+            SELECT COUNT(*) as total FROM location_stock
+            WHERE location_id = %s AND stock <= min_stock
+        ''', (location_id,))
         low_stock = cursor.fetchone()['total']
         
         # Ventas recientes
         cursor.execute('''
-            SELECT s.id, p.name as product_name, s.quantity, s.total_amount, s.sale_date
+            SELECT s.id, p.name as product_name, s.quantity, s.total_amount, s.refunded_quantity, s.sale_date
             FROM sales s
             JOIN products p ON s.product_id = p.id
+            WHERE s.location_id = %s
             ORDER BY s.sale_date DESC
             LIMIT 10
-        ''')
+        ''', (location_id,))
         recent_sales = cursor.fetchall()
         
         cursor.close()
@@ -1085,6 +2145,7 @@ def get_dashboard_stats():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/categories', methods=['GET'])
+@conditional_get('categories')
 @login_required
 def get_categories():
     """Obtener lista de categorías"""
@@ -1106,23 +2167,27 @@ def get_categories():
 @login_required
 def get_inventory_report():
     """Obtener reporte detallado de inventario"""
+    location_id = current_location_id()
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Inventario actual
         cursor.execute('''
-            SELECT s.id, s.name, s.stock, s.min_stock, s.unit, 
-                   c.name as category, s.updated_at,
+            SELECT s.id, s.name, ls.stock, ls.min_stock, s.unit, 
+                   c.name as category, ls.updated_at,
                    CASE 
-                     WHEN s.stock <= s.min_stock THEN 'bajo'
-                     WHEN s.stock <= s.min_stock * 1.5 THEN 'medio'
+                     WHEN ls.stock <= ls.min_stock THEN 'bajo'
+                     WHEN ls.stock <= ls.min_stock * 1.5 THEN 'medio'
                      ELSE 'bueno'
                    END as status
-            FROM supplies s
+            FROM location_stock ls
+            JOIN supplies s ON s.id = ls.supply_id
             LEFT JOIN categories c ON s.category_id = c.id
-            ORDER BY status, s.stock ASC
-        ''')
+            WHERE ls.location_id = %s
+            ORDER BY status, ls.stock ASC
+        ''', (location_id,))
         
         inventory = cursor.fetchall()
         
@@ -1130,12 +2195,13 @@ def get_inventory_report():
         cursor.execute('''
             SELECT ih.id, s.name as supply_name, ih.quantity_change, ih.type, 
                    ih.description, ih.created_at, u.username
-            FROM inventory_history ih
+            FROM inventory_movements ih
             JOIN supplies s ON ih.supply_id = s.id
             LEFT JOIN users u ON ih.user_id = u.id
+            WHERE ih.location_id = %s
             ORDER BY ih.created_at DESC
             LIMIT 50
-        ''')
+        ''', (location_id,))
         
         history = cursor.fetchall()
         
@@ -1154,22 +2220,22 @@ def get_inventory_report():
 def get_inventory_history():
     """Obtener historial de cambios de inventario"""
     supply_id = request.args.get('supply_id')
-    days = request.args.get('days', 30)
+    days = request.args.get('days', 30, type=int)
     
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         query = '''
-            SELECT ih.id, s.name, ih.quantity_change, ih.type, 
+            SELECT ih.id, s.name, ih.quantity_change, ih.type, ih.reason,
                    ih.description, ih.created_at, u.username
-            FROM inventory_history ih
+            FROM inventory_movements ih
             JOIN supplies s ON ih.supply_id = s.id
             LEFT JOIN users u ON ih.user_id = u.id
-            WHERE ih.created_at >= NOW() - INTERVAL '%s days'
-        ''' % days
+            WHERE ih.location_id = %s AND ih.created_at >= NOW() - %s * INTERVAL '1 day'
+        '''
         
-        params = []
+        params = [current_location_id(), days]
         
         if supply_id:
             query += ' AND ih.supply_id = %s'
@@ -1187,178 +2253,2025 @@ def get_inventory_history():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/sales-by-product', methods=['GET'])
-@login_required
-def get_sales_by_product():
-    """Obtener ventas agrupadas por producto"""
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+# === CACHÉ DE REPORTES POR PERÍODO ===
+#
+# Ver report_cache.py. La entrada se busca en la réplica (como el resto de la
+# lectura del reporte) y solo un reporte calculado escribe en el primario.
+
+def cached_report(report_type, params, start, end, tables, build):
+    """Responder un reporte desde report_cache, o calcularlo con build(cursor) y guardarlo.
     
+    build devuelve (contenido en bytes, mimetype, nombre de descarga o None);
+    tables son las tablas versionadas cuyos datos muestra el reporte.
+    """
+    location_id = params['location_id']
+    cache_key = report_cache_key(report_type, params)
+    
+    # Las conexiones se cierran también si falla la consulta, el cálculo o el guardado
+    conn = get_db('replica')
     try:
-        conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        query = '''
-            SELECT p.id, p.name, COUNT(s.id) as sales_count, 
-                   SUM(s.quantity) as total_quantity, 
-                   SUM(s.total_amount) as total_revenue,
-                   SUM(s.discount_amount) as total_discount
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE 1=1
-        '''
-        params = []
-        
-        if start_date:
-            query += ' AND DATE(s.sale_date) >= %s'
-            params.append(start_date)
-        
-        if end_date:
-            query += ' AND DATE(s.sale_date) <= %s'
-            params.append(end_date)
-        
-        query += ' GROUP BY p.id, p.name ORDER BY total_revenue DESC'
-        
-        cursor.execute(query, params)
-        sales = cursor.fetchall()
-        
+        catalog_version, entry = lookup_report(cursor, cache_key, tables)
+        if entry:
+            content, mimetype, filename = bytes(entry['content']), entry['mimetype'], entry['filename']
+            status = 'hit'
+        else:
+            # Si el período ya estaba cerrado antes de calcular, el resultado no va a cambiar
+            immutable = period_is_closed(cursor, location_id, start, end)
+            content, mimetype, filename = build(cursor)
+            status = 'closed' if immutable else 'miss'
         cursor.close()
+    finally:
         conn.close()
-        
-        return jsonify(sales)
+    
+    if not entry:
+        primary = get_db()
+        try:
+            primary_cursor = primary.cursor()
+            store_report(primary_cursor, cache_key, report_type, params, location_id, start, end,
+                         catalog_version, immutable, content, mimetype, filename)
+            primary.commit()
+            primary_cursor.close()
+        finally:
+            primary.close()
+    
+    metrics.observe_report_cache(report_type, status)
+    
+    if filename:
+        response = send_file(BytesIO(content), mimetype=mimetype, as_attachment=True, download_name=filename)
+    else:
+        response = app.response_class(content, mimetype=mimetype)
+    response.headers['X-Report-Cache'] = status
+    return response
+
+def json_report(rows):
+    """Contenido de un reporte JSON para cached_report"""
+    return dumps_bytes(rows), 'application/json', None
+
+def parse_report_dates(args):
+    """start_date y end_date (AAAA-MM-DD, opcionales) de un reporte por fechas"""
+    start = datetime.strptime(args['start_date'], '%Y-%m-%d').date() if args.get('start_date') else None
+    end = datetime.strptime(args['end_date'], '%Y-%m-%d').date() if args.get('end_date') else None
+    return start, end
+
+def sales_by_product(cursor, location_id, start=None, end=None):
+    """Ventas agrupadas por producto (los días con cierre de caja salen del reporte Z)"""
+    closed = [close['business_date'] for close in day_closes_between(cursor, location_id, start, end)]
+    open_days, open_params = open_days_filter(open_intervals(closed, start, end))
+    
+    cursor.execute(f'''
+        SELECT p.id, p.name, SUM(t.sales_count)::bigint as sales_count,
+               SUM(t.total_quantity)::bigint as total_quantity,
+               SUM(t.total_revenue) as total_revenue,
+               SUM(t.total_discount) as total_discount
+        FROM (
+            SELECT l.key_id AS product_id, l.sales_count, l.units AS total_quantity,
+                   l.net_amount AS total_revenue, l.discount_amount AS total_discount
+            FROM day_closes c
+            JOIN day_close_lines l ON l.close_id = c.id AND l.dimension = 'product'
+            WHERE c.location_id = %s AND c.business_date = ANY(%s::date[])
+            UNION ALL
+            SELECT s.product_id, COUNT(*) FILTER (WHERE s.refunded_quantity < s.quantity),
+                   SUM(s.quantity - s.refunded_quantity), SUM(COALESCE(s.total_amount, 0) - s.refunded_amount),
+                   SUM(COALESCE(s.discount_amount, 0))
+            FROM sales s
+            WHERE s.location_id = %s AND {open_days}
+            GROUP BY s.product_id
+        ) t
+        JOIN products p ON t.product_id = p.id
+        GROUP BY p.id, p.name
+        ORDER BY total_revenue DESC
+    ''', [location_id, closed, location_id] + open_params)
+    return cursor.fetchall()
+
+def sales_by_date(cursor, location_id, start=None, end=None):
+    """Ventas agrupadas por fecha (los días con cierre de caja salen del reporte Z)"""
+    closes = day_closes_between(cursor, location_id, start, end)
+    open_days, open_params = open_days_filter(open_intervals([close['business_date'] for close in closes], start, end))
+    
+    # Solo los días abiertos se calculan desde las ventas
+    cursor.execute(f'''
+        SELECT DATE(s.sale_date) as date, COUNT(*) FILTER (WHERE s.refunded_quantity < s.quantity) as sales_count,
+               SUM(COALESCE(s.total_amount, 0) - s.refunded_amount) as total_revenue,
+               SUM(COALESCE(s.discount_amount, 0)) as total_discount
+        FROM sales s
+        WHERE s.location_id = %s AND {open_days}
+        GROUP BY DATE(s.sale_date)
+    ''', [location_id] + open_params)
+    
+    sales = cursor.fetchall() + [{'date': close['business_date'], 'sales_count': close['sales_count'],
+                                  'total_revenue': close['net_amount'], 'total_discount': close['discount_amount']}
+                                 for close in closes]
+    sales.sort(key=lambda row: row['date'], reverse=True)
+    return sales
+
+def sales_totals(cursor, location_id, start=None, end=None):
+    """Totales netos de devoluciones entre start y end (los días con cierre de caja salen del reporte Z)"""
+    closed = [close['business_date'] for close in day_closes_between(cursor, location_id, start, end)]
+    open_days, open_params = open_days_filter(open_intervals(closed, start, end))
+    
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(t.net_amount), 0) AS total_sales,
+               COALESCE(SUM(t.discount_amount), 0) AS total_discounts,
+               COALESCE(SUM(t.refunded_amount), 0) AS total_refunds,
+               COALESCE(SUM(t.sales_count), 0)::bigint AS sales_count
+        FROM (
+            SELECT c.net_amount, c.discount_amount, c.refunded_amount, c.sales_count
+            FROM day_closes c
+            WHERE c.location_id = %s AND c.business_date = ANY(%s::date[])
+            UNION ALL
+            SELECT SUM(COALESCE(s.total_amount, 0) - s.refunded_amount), SUM(COALESCE(s.discount_amount, 0)),
+                   SUM(s.refunded_amount), COUNT(*) FILTER (WHERE s.refunded_quantity < s.quantity)
+            FROM sales s
+            WHERE s.location_id = %s AND {open_days}
+        ) t
+    ''', [location_id, closed, location_id] + open_params)
+    return cursor.fetchone()
+
+@app.route('/api/sales-by-product', methods=['GET'])
+@login_required
+def get_sales_by_product():
+    """Obtener ventas agrupadas por producto (en caché; sin vencimiento si el período está cerrado)"""
+    try:
+        start, end = parse_report_dates(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas (AAAA-MM-DD)'}), 400
+    
+    params = {'location_id': current_location_id(), 'start_date': start, 'end_date': end,
+              'format': JSON_DATETIME_FORMAT}
+    
+    try:
+        return cached_report('ventas_por_producto', params, start, end, ('products',),
+                             lambda cursor: json_report(sales_by_product(cursor, params['location_id'], start, end)))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/sales-by-date', methods=['GET'])
 @login_required
 def get_sales_by_date():
-    """Obtener ventas agrupadas por fecha"""
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    """Obtener ventas agrupadas por fecha (en caché; sin vencimiento si el período está cerrado)"""
+    try:
+        start, end = parse_report_dates(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas (AAAA-MM-DD)'}), 400
+    
+    params = {'location_id': current_location_id(), 'start_date': start, 'end_date': end,
+              'format': JSON_DATETIME_FORMAT}
     
     try:
-        conn = get_db()
+        return cached_report('ventas_por_fecha', params, start, end, (),
+                             lambda cursor: json_report(sales_by_date(cursor, params['location_id'], start, end)))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/inventory-forecast', methods=['GET'])
+@login_required
+def get_inventory_forecast():
+    """Obtener predicción de stock basada en ventas"""
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db('replica')
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        query = '''
-            SELECT DATE(s.sale_date) as date, COUNT(s.id) as sales_count,
-                   SUM(s.total_amount) as total_revenue,
-                   SUM(s.discount_amount) as total_discount
-            FROM sales s
-            WHERE 1=1
-        '''
-        params = []
+        # Calcular promedio diario de uso por insumo en el local
+        cursor.execute('''
+            SELECT daily.supply_id, s.name, AVG(daily_usage) as avg_daily_usage,
+                   COALESCE(ls.stock, 0) as stock, COALESCE(ls.min_stock, s.min_stock) as min_stock
+            FROM (
+                SELECT pb.supply_id, COUNT(*) as daily_usage
+                FROM product_bom pb
+                JOIN sales s ON pb.product_id = s.product_id
+                WHERE s.location_id = %s AND s.sale_date >= NOW() - INTERVAL '30 days'
+                  AND s.refunded_quantity < s.quantity
+                GROUP BY pb.supply_id, DATE(s.sale_date)
+            ) daily
+            JOIN supplies s ON daily.supply_id = s.id
+            LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
+            GROUP BY daily.supply_id, s.name, ls.stock, ls.min_stock, s.min_stock
+            HAVING AVG(daily_usage) > 0
+            ORDER BY (COALESCE(ls.stock, 0) / NULLIF(AVG(daily_usage), 0)) ASC
+        ''', (location_id, location_id))
+        
+        forecast = cursor.fetchall()
+        
+        # Calcular días hasta agotar stock
+        for item in forecast:
+            if item['avg_daily_usage'] and item['avg_daily_usage'] > 0:
+                days_to_empty = item['stock'] / item['avg_daily_usage']
+                item['days_to_empty'] = round(days_to_empty, 1)
+                item['needs_restock'] = days_to_empty <= 7
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(forecast)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/generate-full-report', methods=['GET'])
+@login_required
+def generate_full_report():
+    """Generar reporte completo en Excel (en caché; sin vencimiento si el mes está cerrado)"""
+    try:
+        params = normalize_report_params('reporte_completo', request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    month_start, next_month = month_bounds(params['month'])
+    
+    def build(cursor):
+        excel_buffer, filename = build_full_report(cursor, params)
+        return excel_buffer.getvalue(), EXCEL_MIMETYPE, filename
+    
+    try:
+        return cached_report('reporte_completo', params, month_start, next_month - timedelta(days=1),
+                             ('categories', 'supplies', 'products'), build)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# === GENERACIÓN DE REPORTES EXCEL ===
+
+EXCEL_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def write_excel(sheets):
+    """Escribir un libro Excel en memoria a partir de {hoja: filas}"""
+    excel_buffer = BytesIO()
+    
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        for sheet_name, rows in sheets.items():
+            pd.DataFrame(rows).to_excel(writer, sheet_name=sheet_name, index=False)
+    
+    excel_buffer.seek(0)
+    return excel_buffer
+
+def build_inventory_export(cursor, params):
+    """Inventario actual y ventas de un día (por defecto hoy)"""
+    day = params.get('date') or datetime.now().strftime('%Y-%m-%d')
+    location_id = params.get('location_id', DEFAULT_LOCATION_ID)
+    
+    cursor.execute('''
+        SELECT c.name as categoria, s.name as insumo, COALESCE(ls.stock, 0) as cantidad_actual, 
+               s.unit as unidad, COALESCE(ls.min_stock, s.min_stock) as stock_minimo
+        FROM supplies s
+        LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
+        LEFT JOIN categories c ON s.category_id = c.id
+        ORDER BY c.name, s.name
+    ''', (location_id,))
+    supplies = cursor.fetchall()
+    
+    cursor.execute('''
+        SELECT p.name as producto, COUNT(*) as cantidad_vendida, 
+               DATE(s.sale_date) as fecha
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        WHERE s.location_id = %s AND s.sale_date >= %s::date AND s.sale_date < %s::date + 1
+          AND s.refunded_quantity < s.quantity
+        GROUP BY p.name, DATE(s.sale_date)
+        ORDER BY cantidad_vendida DESC
+    ''', (location_id, day, day))
+    sales = cursor.fetchall()
+    
+    excel_buffer = write_excel({'Inventario': supplies, 'Ventas': sales})
+    return excel_buffer, f'inventario_illima_{day.replace("-", "")}.xlsx'
+
+def month_bounds(month):
+    """Primer día del mes (AAAA-MM) y primer día del mes siguiente"""
+    month_start = datetime.strptime(month, '%Y-%m').date()
+    return month_start, (month_start + timedelta(days=32)).replace(day=1)
+
+def build_full_report(cursor, params):
+    """Inventario y ventas de un mes (por defecto el mes actual); de un mes terminado, el stock a fin de mes"""
+    month = params.get('month') or datetime.now().strftime('%Y-%m')
+    location_id = params.get('location_id', DEFAULT_LOCATION_ID)
+    month_start, next_month = month_bounds(month)
+    
+    cursor.execute('''
+        SELECT s.id, s.name, COALESCE(ls.stock, 0) as stock, COALESCE(ls.min_stock, s.min_stock) as min_stock,
+               s.unit, c.name as category
+        FROM supplies s
+        LEFT JOIN location_stock ls ON ls.supply_id = s.id AND ls.location_id = %s
+        LEFT JOIN categories c ON s.category_id = c.id
+        ORDER BY c.name, s.name
+    ''', (location_id,))
+    inventory = cursor.fetchall()
+    
+    # Un mes terminado muestra el stock del libro al cierre del mes, que ya no cambia
+    ledger = None
+    if next_month <= date.today():
+        ledger = {row['supply_id']: row['stock'] for row in stock_as_of(cursor, next_month, location_id=location_id)}
+    for item in inventory:
+        supply_id = item.pop('id')
+        if ledger is not None:
+            item['stock'] = ledger.get(supply_id, 0)
+    
+    cursor.execute('''
+        SELECT DATE(s.sale_date) as date, p.name as product, s.quantity, s.total_amount,
+               s.refunded_quantity, s.refunded_amount
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        WHERE s.location_id = %s AND s.sale_date >= %s AND s.sale_date < %s
+        ORDER BY s.sale_date DESC
+    ''', (location_id, month_start, next_month))
+    sales = cursor.fetchall()
+    
+    excel_buffer = write_excel({'Inventario': inventory, 'Ventas': sales})
+    return excel_buffer, f'reporte_completo_{month.replace("-", "")}.xlsx'
+
+def build_cost_report(cursor, params):
+    """Costo y margen de cada producto (product_costs, que recalcula el worker) y costo vigente de cada insumo"""
+    cursor.execute('''
+        SELECT p.name as producto, c.name as categoria, pc.cost as costo, pc.price as precio,
+               pc.margin as margen, pc.margin_pct as margen_pct, pc.missing_costs as insumos_sin_costo
+        FROM product_costs pc
+        JOIN products p ON p.id = pc.product_id
+        LEFT JOIN categories c ON p.category_id = c.id
+        WHERE p.active
+        ORDER BY pc.margin_pct, p.name
+    ''')
+    products = cursor.fetchall()
+    
+    cursor.execute('''
+        SELECT s.name as insumo, s.unit as unidad, s.unit_cost as costo_unitario,
+               s.cost_updated_at as actualizado
+        FROM supplies s
+        ORDER BY s.name
+    ''')
+    supplies = cursor.fetchall()
+    
+    excel_buffer = write_excel({'Productos': products, 'Insumos': supplies})
+    return excel_buffer, f'costos_{datetime.now().strftime("%Y%m%d")}.xlsx'
+
+def build_sales_export(cursor, params):
+    """Detalle de ventas entre dos fechas"""
+    cursor.execute('''
+        SELECT s.id, s.sale_date, p.name as product_name, s.quantity, s.unit_price,
+               s.total_amount, s.discount_amount, s.refunded_quantity, s.refunded_amount,
+               u.username as seller
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        JOIN users u ON s.user_id = u.id
+        WHERE s.location_id = %s AND s.sale_date >= %s::date AND s.sale_date < %s::date + 1
+        ORDER BY s.sale_date
+    ''', (params.get('location_id', DEFAULT_LOCATION_ID), params['start_date'], params['end_date']))
+    sales = cursor.fetchall()
+    
+    excel_buffer = write_excel({'Ventas': sales})
+    filename = f'ventas_{params["start_date"].replace("-", "")}_{params["end_date"].replace("-", "")}.xlsx'
+    return excel_buffer, filename
+
+def build_production_report(cursor, params):
+    """Producción frente a consumo por ventas y rendimiento de cada preparación"""
+    summary = production_summary(cursor, params.get('location_id', DEFAULT_LOCATION_ID),
+                                 params['start_date'], params['end_date'])
+    
+    excel_buffer = write_excel({'Insumos': summary['supplies'], 'Preparaciones': summary['preparations']})
+    filename = f'produccion_{params["start_date"].replace("-", "")}_{params["end_date"].replace("-", "")}.xlsx'
+    return excel_buffer, filename
+
+# Tipos de reporte disponibles: constructor y si requiere rol administrador
+REPORT_TYPES = {
+    'inventario': {'builder': build_inventory_export, 'admin': True},
+    'reporte_completo': {'builder': build_full_report, 'admin': False},
+    'ventas': {'builder': build_sales_export, 'admin': True},
+    'costos': {'builder': build_cost_report, 'admin': True},
+    'produccion': {'builder': build_production_report, 'admin': True},
+}
+
+def _parse_param_date(value, fmt, name):
+    """Validar formato de un parámetro de fecha"""
+    try:
+        datetime.strptime(value, fmt)
+    except (TypeError, ValueError):
+        raise ValueError(f'Parámetro {name} inválido: {value}')
+    return value
+
+def normalize_report_params(report_type, data):
+    """Completar y validar parámetros para que pedidos iguales generen la misma clave"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    if report_type == 'inventario':
+        params = {'date': _parse_param_date(data.get('date') or today, '%Y-%m-%d', 'date')}
+    elif report_type == 'reporte_completo':
+        month = data.get('month') or datetime.now().strftime('%Y-%m')
+        params = {'month': _parse_param_date(month, '%Y-%m', 'month')}
+    elif report_type in ('ventas', 'produccion'):
+        params = {
+            'start_date': _parse_param_date(data.get('start_date') or today, '%Y-%m-%d', 'start_date'),
+            'end_date': _parse_param_date(data.get('end_date') or today, '%Y-%m-%d', 'end_date')
+        }
+    elif report_type == 'costos':
+        params = {'date': today}
+    else:
+        raise ValueError(f'Tipo de reporte desconocido: {report_type}')
+    
+    params['location_id'] = current_location_id()
+    return params
+
+# === TRABAJOS DE REPORTES EN SEGUNDO PLANO ===
+
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+
+REPORT_JOB_ACCESS_FIELDS = ('artifact_path', 'job_location_id', 'is_admin', 'requested')
+
+def _serialize_report_job(job):
+    """Formatear un trabajo de reporte para la respuesta JSON"""
+    job = dict(job)
+    if job['status'] == 'completado':
+        job['download_url'] = url_for('download_report_job', job_id=job['id'])
+    for field in REPORT_JOB_ACCESS_FIELDS:
+        job.pop(field, None)
+    return job
+
+def fetch_report_job(cursor, job_id, columns):
+    """Trabajo de reporte visible para el usuario de la sesión: (trabajo, None) o (None, (error, estado)).
+    
+    Un administrador ve todos. El resto solo los que pidió, de su local y de
+    tipos de reporte que no son solo para administradores.
+    """
+    cursor.execute(f'''
+        SELECT {columns}, j.report_type, j.params->>'location_id' AS job_location_id,
+               u.role = 'administrador' AS is_admin,
+               (j.requested_by = u.id OR EXISTS (
+                   SELECT 1 FROM report_job_requests r WHERE r.job_id = j.id AND r.user_id = u.id
+               )) AS requested
+        FROM report_jobs j
+        JOIN users u ON u.id = %s
+        WHERE j.id = %s
+    ''', (session['user_id'], job_id))
+    job = cursor.fetchone()
+    
+    if not job or not (job['is_admin'] or job['requested']):
+        return None, ('Trabajo no encontrado', 404)
+    if not job['is_admin']:
+        if REPORT_TYPES.get(job['report_type'], {'admin': True})['admin']:
+            return None, ('Acceso denegado', 403)
+        if job['job_location_id'] is not None and int(job['job_location_id']) != current_location_id():
+            return None, ('Trabajo no encontrado', 404)
+    return job, None
+
+@app.route('/api/report-jobs', methods=['POST'])
+@login_required
+def submit_report_job():
+    """Encolar un reporte pesado; pedidos idénticos en curso comparten el mismo trabajo"""
+    data = request.get_json() or {}
+    report_type = data.get('report_type')
+    
+    if report_type not in REPORT_TYPES:
+        return jsonify({'error': 'Tipo de reporte inválido'}), 400
+    
+    try:
+        params = normalize_report_params(report_type, data.get('params') or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    params_json = json.dumps(params, sort_keys=True)
+    params_hash = hashlib.sha256(params_json.encode()).hexdigest()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if REPORT_TYPES[report_type]['admin']:
+            cursor.execute('SELECT role FROM users WHERE id = %s', (session['user_id'],))
+            user = cursor.fetchone()
+            if not user or user['role'] != 'administrador':
+                cursor.close()
+                conn.close()
+                return jsonify({'error': 'Acceso denegado'}), 403
+        
+        # Si ya hay un trabajo igual pendiente o en proceso, se reutiliza.
+        # Se reintenta por si ese trabajo termina entre el INSERT y el SELECT.
+        job = None
+        for _ in range(3):
+            cursor.execute('''
+                INSERT INTO report_jobs (report_type, params, params_hash, requested_by)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (report_type, params_hash) WHERE status IN ('pendiente', 'procesando')
+                DO NOTHING
+                RETURNING id, report_type, params, status, error, created_at, started_at, finished_at
+            ''', (report_type, params_json, params_hash, session['user_id']))
+            job = cursor.fetchone()
+            created = job is not None
+            
+            if not job:
+                cursor.execute('''
+                    SELECT id, report_type, params, status, error, created_at, started_at, finished_at
+                    FROM report_jobs
+                    WHERE report_type = %s AND params_hash = %s
+                      AND status IN ('pendiente', 'procesando')
+                ''', (report_type, params_hash))
+                job = cursor.fetchone()
+            
+            if job:
+                break
+        
+        if job:
+            cursor.execute('''
+                INSERT INTO report_job_requests (job_id, user_id) VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+            ''', (job['id'], session['user_id']))
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        if not job:
+            return jsonify({'error': 'No se pudo encolar el reporte'}), 503
+        
+        return jsonify(_serialize_report_job(job)), 202 if created else 200
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/report-jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_report_job(job_id):
+    """Consultar el estado de un trabajo de reporte"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        job, denied = fetch_report_job(
+            cursor, job_id, 'j.id, j.params, j.status, j.error, j.created_at, j.started_at, j.finished_at')
+        
+        cursor.close()
+        conn.close()
+        
+        if denied:
+            return jsonify({'error': denied[0]}), denied[1]
+        
+        return jsonify(_serialize_report_job(job))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/report-jobs/<int:job_id>/download', methods=['GET'])
+@login_required
+def download_report_job(job_id):
+    """Descargar el archivo generado por un trabajo completado"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        job, denied = fetch_report_job(cursor, job_id, 'j.status, j.artifact_path, j.artifact_name')
+        
+        cursor.close()
+        conn.close()
+        
+        if denied:
+            return jsonify({'error': denied[0]}), denied[1]
+        
+        if job['status'] != 'completado':
+            return jsonify({'error': 'El reporte no está disponible', 'status': job['status']}), 409
+        
+        path = os.path.join(REPORTS_DIR, job['artifact_path'])
+        if not os.path.exists(path):
+            return jsonify({'error': 'Archivo de reporte no encontrado'}), 410
+        
+        return send_file(
+            os.path.abspath(path),
+            mimetype=EXCEL_MIMETYPE,
+            as_attachment=True,
+            download_name=job['artifact_name']
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# === LIBRO DE INVENTARIO: SNAPSHOTS Y CONSULTAS A UNA FECHA ===
+#
+# inventory_movements (inventory_history más los movimientos que todavía están
+# en inventory_outbox) es el libro de movimientos. Cada medianoche se guarda en
+# inventory_snapshots el stock de cada insumo en cada local calculado desde el
+# libro (no desde location_stock), incluyendo los movimientos con created_at
+# anterior a snapshot_at. El stock a una fecha T es el snapshot más cercano
+# anterior más los movimientos entre ese snapshot y T.
+
+LEDGER_STOCK_QUERY = '''
+    SELECT ls.location_id, s.id AS supply_id, s.name, s.unit, ls.stock AS recorded_stock,
+           COALESCE(snap.stock, 0) + COALESCE(d.delta, 0) AS stock,
+           snap.snapshot_at
+    FROM location_stock ls
+    JOIN supplies s ON s.id = ls.supply_id
+    LEFT JOIN LATERAL (
+        SELECT snapshot_at, stock
+        FROM inventory_snapshots
+        WHERE location_id = ls.location_id AND supply_id = ls.supply_id AND snapshot_at <= %(at)s
+        ORDER BY snapshot_at DESC
+        LIMIT 1
+    ) snap ON true
+    LEFT JOIN LATERAL (
+        SELECT SUM(ih.quantity_change) AS delta
+        FROM inventory_movements ih
+        WHERE ih.location_id = ls.location_id AND ih.supply_id = ls.supply_id
+          AND ih.created_at >= COALESCE(snap.snapshot_at, '-infinity'::timestamp)
+          AND ih.created_at <= %(at)s
+    ) d ON true
+    WHERE (%(location_id)s::integer IS NULL OR ls.location_id = %(location_id)s::integer)
+      AND (%(supply_id)s::integer IS NULL OR s.id = %(supply_id)s::integer)
+'''
+
+def stock_as_of(cursor, at, supply_id=None, location_id=None):
+    """Stock de cada insumo (o de uno) según el libro a la fecha indicada, en un local o en todos"""
+    cursor.execute(LEDGER_STOCK_QUERY + ' ORDER BY ls.location_id, s.id',
+                   {'at': at, 'supply_id': supply_id, 'location_id': location_id})
+    return cursor.fetchall()
+
+def take_inventory_snapshots(cursor, until=None):
+    """Guardar los snapshots diarios faltantes hasta la medianoche indicada (por defecto hoy)"""
+    cursor.execute('''
+        SELECT DATE_TRUNC('day', COALESCE(%s::timestamp, NOW()::timestamp)) AS until,
+               (SELECT MAX(snapshot_at) + INTERVAL '1 day' FROM inventory_snapshots) AS next_snapshot,
+               (SELECT DATE_TRUNC('day', MIN(created_at)) + INTERVAL '1 day' FROM inventory_movements) AS first_day
+    ''', (until,))
+    bounds = cursor.fetchone()
+    start = bounds['next_snapshot'] or bounds['first_day'] or bounds['until']
+    until = bounds['until']
+    
+    if start > until:
+        return 0
+    
+    # Un solo INSERT para todos los días pendientes: la suma acumulada de los
+    # movimientos diarios sobre el último snapshot de cada insumo.
+    cursor.execute('''
+        WITH days AS (
+            SELECT generate_series(%(start)s::timestamp, %(until)s::timestamp, INTERVAL '1 day') AS snapshot_at
+        ),
+        base AS (
+            SELECT ls.location_id, ls.supply_id,
+                   COALESCE(last.snapshot_at, '-infinity'::timestamp) AS base_at,
+                   COALESCE(last.stock, 0) AS base_stock
+            FROM location_stock ls
+            LEFT JOIN LATERAL (
+                SELECT snapshot_at, stock
+                FROM inventory_snapshots
+                WHERE location_id = ls.location_id AND supply_id = ls.supply_id
+                ORDER BY snapshot_at DESC
+                LIMIT 1
+            ) last ON true
+        ),
+        daily AS (
+            SELECT ih.location_id, ih.supply_id,
+                   GREATEST(DATE_TRUNC('day', ih.created_at) + INTERVAL '1 day', %(start)s::timestamp) AS snapshot_at,
+                   SUM(ih.quantity_change) AS delta
+            FROM inventory_movements ih
+            JOIN base b ON b.location_id = ih.location_id AND b.supply_id = ih.supply_id
+            WHERE ih.created_at >= b.base_at AND ih.created_at < %(until)s::timestamp
+            GROUP BY 1, 2, 3
+        )
+        INSERT INTO inventory_snapshots (location_id, supply_id, snapshot_at, stock)
+        SELECT b.location_id, b.supply_id, d.snapshot_at,
+               b.base_stock + SUM(COALESCE(dl.delta, 0)) OVER (
+                   PARTITION BY b.location_id, b.supply_id ORDER BY d.snapshot_at
+               )
+        FROM base b
+        CROSS JOIN days d
+        LEFT JOIN daily dl ON dl.location_id = b.location_id AND dl.supply_id = b.supply_id
+                          AND dl.snapshot_at = d.snapshot_at
+        ON CONFLICT (location_id, supply_id, snapshot_at) DO NOTHING
+    ''', {'start': start, 'until': until})
+    
+    return cursor.rowcount
+
+def reconcile_inventory(cursor):
+    """Comparar el stock según el libro con location_stock en cada local y registrar la diferencia"""
+    cursor.execute('''
+        SELECT location_id, supply_id, name, unit, recorded_stock, stock AS ledger_stock,
+               recorded_stock - stock AS drift
+        FROM (''' + LEDGER_STOCK_QUERY + ''') ledger
+        WHERE recorded_stock <> stock
+        ORDER BY ABS(recorded_stock - stock) DESC
+    ''', {'at': 'infinity', 'supply_id': None, 'location_id': None})
+    drift = cursor.fetchall()
+    
+    cursor.execute('''
+        INSERT INTO inventory_reconciliations (drift_count, details)
+        VALUES (%s, %s)
+        RETURNING id, run_at
+    ''', (len(drift), json.dumps(drift, default=str)))
+    run = cursor.fetchone()
+    
+    return {'id': run['id'], 'run_at': run['run_at'], 'drift_count': len(drift), 'drift': drift}
+
+@app.route('/api/inventory/as-of', methods=['GET'])
+@login_required
+def get_inventory_as_of():
+    """Obtener el stock de los insumos (o de uno) a una fecha y hora pasada"""
+    at = request.args.get('at')
+    supply_id = request.args.get('supply_id', type=int)
+    
+    try:
+        at = datetime.fromisoformat(at)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Parámetro at requerido en formato ISO (YYYY-MM-DDTHH:MM)'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        rows = stock_as_of(cursor, at, supply_id, current_location_id())
+        
+        cursor.close()
+        conn.close()
+        
+        for row in rows:
+            row.pop('recorded_stock')
+        
+        if supply_id:
+            if not rows:
+                return jsonify({'error': 'Insumo no encontrado'}), 404
+            return jsonify(rows[0])
+        
+        return jsonify(rows)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/inventory/snapshots', methods=['POST'])
+@admin_required
+def create_inventory_snapshots():
+    """Generar los snapshots diarios pendientes"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        created = take_inventory_snapshots(cursor)
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({'success': True, 'snapshots_created': created})
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/inventory/reconcile', methods=['GET', 'POST'])
+@admin_required
+def reconcile_inventory_route():
+    """Detectar diferencias entre el libro y el stock de cada local (POST con fix=true las corrige)"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        result = reconcile_inventory(cursor)
+        
+        # Corregir: registrar la diferencia como movimiento de ajuste, tomando
+        # location_stock (el conteo físico) como el valor correcto
+        if request.method == 'POST' and data.get('fix') and result['drift']:
+            cursor.executemany('''
+                INSERT INTO inventory_history (supply_id, location_id, quantity_change, type, description, user_id)
+                VALUES (%s, %s, %s, 'ajuste', %s, %s)
+            ''', [(row['supply_id'], row['location_id'], row['drift'], data.get('notes') or 'Ajuste por conciliación',
+                   session['user_id']) for row in result['drift']])
+            result['fixed'] = len(result['drift'])
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(result)
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+# === LOCALES: ALTA, ASIGNACIÓN Y RESÚMENES ENTRE LOCALES ===
+#
+# Cada local tiene su propio stock en location_stock, por lo que las ventas de
+# un local solo bloquean sus filas. Los totales entre locales no se calculan
+# en cada petición: salen de vistas materializadas que el worker refresca.
+
+ROLLUP_VIEWS = ('supply_stock_totals', 'location_sales_daily')
+
+def refresh_location_rollups(cursor):
+    """Refrescar las vistas materializadas de totales entre locales sin bloquear lecturas"""
+    for view in ROLLUP_VIEWS:
+        cursor.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}')
+        cursor.execute('''
+            INSERT INTO rollup_refreshes (view_name, refreshed_at)
+            VALUES (%s, CURRENT_TIMESTAMP)
+            ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+        ''', (view,))
+
+@app.route('/api/locations', methods=['GET'])
+@login_required
+def get_locations():
+    """Obtener los locales activos y el local de la sesión"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('SELECT id, name, address FROM locations WHERE active = true ORDER BY id')
+        locations = cursor.fetchall()
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify({'locations': locations, 'current_location_id': current_location_id()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/locations', methods=['POST'])
+@admin_required
+def create_location():
+    """Crear un local con todos los insumos en stock cero"""
+    data = request.get_json()
+    name = data.get('name')
+    
+    if not name:
+        return jsonify({'error': 'Nombre requerido'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            INSERT INTO locations (name, address)
+            VALUES (%s, %s)
+            RETURNING id, name, address, active
+        ''', (name, data.get('address')))
+        location = cursor.fetchone()
+        
+        cursor.execute('''
+            INSERT INTO location_stock (location_id, supply_id, stock, min_stock)
+            SELECT %s, id, 0, min_stock FROM supplies
+        ''', (location['id'],))
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(location), 201
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Ya existe un local con ese nombre'}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/users/<int:user_id>/location', methods=['PUT'])
+@admin_required
+def assign_user_location(user_id):
+    """Asignar un usuario a un local (null = puede elegir cualquiera)"""
+    data = request.get_json()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            UPDATE users SET location_id = %s WHERE id = %s
+            RETURNING id, username, location_id
+        ''', (data.get('location_id'), user_id))
+        user = cursor.fetchone()
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        if not user:
+            return jsonify({'error': 'Usuario no encontrado'}), 404
+        
+        return jsonify(user)
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Local no encontrado'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/locations/summary', methods=['GET'])
+@admin_required
+def get_locations_summary():
+    """Totales entre locales: stock por insumo y ventas por local (desde las vistas materializadas)"""
+    days = min(request.args.get('days', 30, type=int), 90)
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if request.args.get('refresh') == 'true':
+            refresh_location_rollups(cursor)
+            conn.commit()
+        
+        cursor.execute('''
+            SELECT supply_id, name, unit, total_stock, locations, locations_low
+            FROM supply_stock_totals
+            ORDER BY locations_low DESC, name
+        ''')
+        stock = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT l.id AS location_id, l.name,
+                   COALESCE(SUM(d.sales_count), 0) AS sales_count,
+                   COALESCE(SUM(d.units), 0) AS units,
+                   COALESCE(SUM(d.revenue), 0) AS revenue
+            FROM locations l
+            LEFT JOIN location_sales_daily d ON d.location_id = l.id AND d.day >= CURRENT_DATE - %s
+            GROUP BY l.id, l.name
+            ORDER BY revenue DESC
+        ''', (days,))
+        sales = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT MIN(refreshed_at) AS refreshed_at FROM rollup_refreshes WHERE view_name = ANY(%s)
+        ''', (list(ROLLUP_VIEWS),))
+        refreshed_at = cursor.fetchone()['refreshed_at']
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify({
+            'stock': stock,
+            'sales': sales,
+            'days': days,
+            'refreshed_at': refreshed_at.isoformat() if refreshed_at else None
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# === COSTOS DE INSUMOS Y MÁRGENES DE PRODUCTOS ===
+
+@app.route('/api/units', methods=['GET'])
+@login_required
+def get_unit_conversions():
+    """Obtener las conversiones de unidades"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            SELECT uc.id, uc.from_unit, uc.to_unit, uc.factor, uc.supply_id, s.name as supply_name
+            FROM unit_conversions uc
+            LEFT JOIN supplies s ON s.id = uc.supply_id
+            ORDER BY uc.supply_id NULLS FIRST, uc.from_unit, uc.to_unit
+        ''')
+        conversions = cursor.fetchall()
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(conversions)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/units', methods=['POST'])
+@admin_required
+def create_unit_conversion():
+    """Crear o actualizar una conversión (ej. 1 caja de leche = 1000 ml, solo para ese insumo)"""
+    data = request.get_json()
+    from_unit = data.get('from_unit')
+    to_unit = data.get('to_unit')
+    factor = data.get('factor')
+    supply_id = data.get('supply_id')
+    
+    if not from_unit or not to_unit or not factor or float(factor) <= 0:
+        return jsonify({'error': 'Unidades y factor positivo requeridos'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # La conversión inversa se guarda también, así las dos direcciones quedan consistentes
+        cursor.execute('''
+            INSERT INTO unit_conversions (from_unit, to_unit, factor, supply_id)
+            VALUES (%(from)s, %(to)s, %(factor)s, %(supply_id)s), (%(to)s, %(from)s, 1 / %(factor)s::numeric, %(supply_id)s)
+            ON CONFLICT (COALESCE(supply_id, 0), from_unit, to_unit) DO UPDATE SET factor = EXCLUDED.factor
+            RETURNING id, from_unit, to_unit, factor, supply_id
+        ''', {'from': from_unit, 'to': to_unit, 'factor': Decimal(str(factor)), 'supply_id': supply_id})
+        conversions = cursor.fetchall()
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(conversions), 201
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Insumo no encontrado'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/supply/<int:supply_id>/cost', methods=['POST'])
+@admin_required
+def record_supply_cost(supply_id):
+    """Registrar una compra con su costo unitario y recalcular los productos que usan el insumo"""
+    data = request.get_json()
+    unit_cost = data.get('unit_cost')
+    unit = data.get('unit')
+    quantity = data.get('quantity')
+    
+    if unit_cost is None or float(unit_cost) < 0:
+        return jsonify({'error': 'Costo unitario inválido'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('SELECT unit FROM supplies WHERE id = %s', (supply_id,))
+        supply = cursor.fetchone()
+        if not supply:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Insumo no encontrado'}), 404
+        
+        # 1 unidad de compra = factor unidades del insumo
+        factor = conversion_factors(cursor, [supply_id], [unit])[0]
+        purchase_cost = Decimal(str(unit_cost))
+        normalized_cost = purchase_cost / factor
+        
+        cursor.execute('''
+            INSERT INTO supply_costs (supply_id, unit_cost, purchase_unit, purchase_unit_cost, quantity, notes, user_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (supply_id, normalized_cost, unit or supply['unit'], purchase_cost,
+              Decimal(str(quantity)) * factor if quantity is not None else None,
+              data.get('notes'), session['user_id']))
+        
+        cursor.execute('''
+            UPDATE supplies SET unit_cost = %s, cost_updated_at = CURRENT_TIMESTAMP WHERE id = %s
+        ''', (normalized_cost, supply_id))
+        
+        products_updated = recompute_product_costs(cursor, supply_ids=[supply_id])
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'unit_cost': round(normalized_cost, 4),
+            'unit': supply['unit'],
+            'products_updated': products_updated
+        })
+    except UnitConversionError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/supply/<int:supply_id>/costs', methods=['GET'])
+@admin_required
+def get_supply_cost_history(supply_id):
+    """Historial de compras y costos de un insumo"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            SELECT sc.id, sc.unit_cost, sc.purchase_unit, sc.purchase_unit_cost, sc.quantity,
+                   sc.notes, u.username, sc.created_at
+            FROM supply_costs sc
+            LEFT JOIN users u ON u.id = sc.user_id
+            WHERE sc.supply_id = %s
+            ORDER BY sc.created_at DESC
+            LIMIT 100
+        ''', (supply_id,))
+        costs = cursor.fetchall()
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(costs)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/product-costs', methods=['GET'])
+@admin_required
+def get_product_costs():
+    """Costo y margen de cada producto (refresh=true recalcula todos)"""
+    category_id = request.args.get('category_id', type=int)
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        # La primera vez (productos anteriores al costeo) se calcula todo
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM product_costs) AS computed')
+        if request.args.get('refresh') == 'true' or not cursor.fetchone()['computed']:
+            recompute_product_costs(cursor)
+            conn.commit()
+        
+        cursor.execute('''
+            SELECT p.id, p.name, c.name as category_name, pc.cost, pc.price, pc.margin,
+                   pc.margin_pct, pc.missing_costs, pc.computed_at
+            FROM product_costs pc
+            JOIN products p ON p.id = pc.product_id
+            LEFT JOIN categories c ON p.category_id = c.id
+            WHERE p.active AND (%s::integer IS NULL OR p.category_id = %s::integer)
+            ORDER BY pc.margin_pct, p.name
+        ''', (category_id, category_id))
+        products = cursor.fetchall()
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(products)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# === PREPARACIONES (SUB-RECETAS) ===
+
+def save_preparation_items(cursor, preparation_id, items):
+    """Reemplazar los componentes de una preparación y reaplanar las listas de materiales afectadas"""
+    normalized = normalize_recipe_items(cursor, items)
+    
+    cursor.execute('DELETE FROM preparation_items WHERE preparation_id = %s', (preparation_id,))
+    cursor.execute('''
+        INSERT INTO preparation_items (preparation_id, supply_id, component_preparation_id, quantity)
+        SELECT %s, supply_id, component_id, quantity
+        FROM unnest(%s::integer[], %s::integer[], %s::numeric[]) AS i(supply_id, component_id, quantity)
+    ''', (preparation_id, [i[0] for i in normalized], [i[1] for i in normalized], [i[2] for i in normalized]))
+    
+    product_ids = rebuild_after_preparation_change(cursor, preparation_id)
+    recompute_product_costs(cursor, product_ids=product_ids)
+    return product_ids
+
+@app.route('/api/admin/preparations', methods=['GET', 'POST'])
+@admin_required
+def manage_preparations():
+    """Listar preparaciones (con su costo por unidad) o crear una"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT pr.id, pr.name, pr.unit, pr.yield_quantity, pr.notes, pr.output_supply_id,
+                       (SELECT COUNT(*) FROM preparation_items pi WHERE pi.preparation_id = pr.id) AS item_count,
+                       ROUND(COALESCE(SUM(pb.quantity * s.unit_cost), 0), 4) AS unit_cost
+                FROM preparations pr
+                LEFT JOIN preparation_bom pb ON pb.preparation_id = pr.id
+                LEFT JOIN supplies s ON s.id = pb.supply_id
+                GROUP BY pr.id
+                ORDER BY pr.name
+            ''')
+            preparations = cursor.fetchall()
+            cursor.close()
+            conn.close()
+            
+            return jsonify(preparations)
+        
+        data = request.get_json()
+        if not data.get('name') or not data.get('unit'):
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Nombre y unidad requeridos'}), 400
+        
+        cursor.execute('''
+            INSERT INTO preparations (name, unit, yield_quantity, notes, output_supply_id)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id, name, unit, yield_quantity, notes, output_supply_id
+        ''', (data['name'], data['unit'], data.get('yield_quantity', 1), data.get('notes'),
+              data.get('output_supply_id')))
+        preparation = cursor.fetchone()
+        
+        save_preparation_items(cursor, preparation['id'], data.get('items', []))
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(preparation), 201
+    except (UnitConversionError, RecipeCycleError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Ya existe una preparación con ese nombre'}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/preparations/<int:preparation_id>', methods=['GET', 'PUT'])
+@admin_required
+def manage_preparation(preparation_id):
+    """Obtener una preparación con sus componentes e insumos aplanados, o actualizarla"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if request.method == 'PUT':
+            data = request.get_json()
+            cursor.execute('''
+                UPDATE preparations
+                SET name = COALESCE(%s, name),
+                    unit = COALESCE(%s, unit),
+                    yield_quantity = COALESCE(%s, yield_quantity),
+                    notes = COALESCE(%s, notes),
+                    output_supply_id = COALESCE(%s, output_supply_id),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                RETURNING id
+            ''', (data.get('name'), data.get('unit'), data.get('yield_quantity'), data.get('notes'),
+                  data.get('output_supply_id'), preparation_id))
+            if not cursor.fetchone():
+                cursor.close()
+                conn.close()
+                return jsonify({'error': 'Preparación no encontrada'}), 404
+            
+            # Sin items se conservan los componentes, pero el rendimiento pudo cambiar
+            if 'items' in data:
+                save_preparation_items(cursor, preparation_id, data['items'])
+            else:
+                product_ids = rebuild_after_preparation_change(cursor, preparation_id)
+                recompute_product_costs(cursor, product_ids=product_ids)
+            conn.commit()
+        
+        cursor.execute('''
+            SELECT id, name, unit, yield_quantity, notes, output_supply_id FROM preparations WHERE id = %s
+        ''', (preparation_id,))
+        preparation = cursor.fetchone()
+        if not preparation:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Preparación no encontrada'}), 404
+        
+        cursor.execute('''
+            SELECT pi.supply_id, pi.component_preparation_id AS preparation_id,
+                   COALESCE(s.name, pr.name) AS name, COALESCE(s.unit, pr.unit) AS unit, pi.quantity
+            FROM preparation_items pi
+            LEFT JOIN supplies s ON s.id = pi.supply_id
+            LEFT JOIN preparations pr ON pr.id = pi.component_preparation_id
+            WHERE pi.preparation_id = %s
+            ORDER BY 3
+        ''', (preparation_id,))
+        preparation['items'] = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT pb.supply_id, s.name, s.unit, pb.quantity, ROUND(pb.quantity * s.unit_cost, 4) AS cost
+            FROM preparation_bom pb
+            JOIN supplies s ON s.id = pb.supply_id
+            WHERE pb.preparation_id = %s
+            ORDER BY s.name
+        ''', (preparation_id,))
+        preparation['bom'] = cursor.fetchall()
+        preparation['unit_cost'] = sum(row['cost'] for row in preparation['bom'])
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(preparation)
+    except (UnitConversionError, RecipeCycleError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+# === PRODUCCIÓN ===
+
+def production_summary(cursor, location_id, start_date, end_date):
+    """Por insumo: lo producido, lo consumido por producción y lo consumido por ventas;
+    por preparación: tandas, rendimiento esperado y real y merma"""
+    cursor.execute('''
+        SELECT s.id AS supply_id, s.name, s.unit,
+               COALESCE(SUM(ih.quantity_change) FILTER (WHERE ih.type = 'produccion' AND ih.quantity_change > 0), 0) AS produced,
+               COALESCE(-SUM(ih.quantity_change) FILTER (WHERE ih.type = 'produccion' AND ih.quantity_change < 0), 0) AS consumed_by_production,
+               COALESCE(-SUM(ih.quantity_change) FILTER (WHERE ih.type IN ('venta', 'descartables')), 0) AS consumed_by_sales
+        FROM inventory_movements ih
+        JOIN supplies s ON s.id = ih.supply_id
+        WHERE ih.location_id = %s AND ih.created_at >= %s::date AND ih.created_at < %s::date + 1
+          AND ih.type IN ('produccion', 'venta', 'descartables')
+        GROUP BY s.id
+        HAVING COUNT(*) FILTER (WHERE ih.type = 'produccion') > 0
+        ORDER BY s.name
+    ''', (location_id, start_date, end_date))
+    supplies = cursor.fetchall()
+    
+    cursor.execute('''
+        SELECT pr.id AS preparation_id, pr.name, s.unit, COUNT(*) AS runs,
+               SUM(r.batches) AS batches, SUM(r.expected_yield) AS expected_yield,
+               SUM(r.actual_yield) AS actual_yield, SUM(r.waste_quantity) AS waste_quantity,
+               ROUND(SUM(r.actual_yield) / NULLIF(SUM(r.expected_yield), 0) * 100, 2) AS yield_pct
+        FROM production_runs r
+        JOIN preparations pr ON pr.id = r.preparation_id
+        LEFT JOIN supplies s ON s.id = pr.output_supply_id
+        WHERE r.location_id = %s AND r.created_at >= %s::date AND r.created_at < %s::date + 1
+        GROUP BY pr.id, s.unit
+        ORDER BY pr.name
+    ''', (location_id, start_date, end_date))
+    preparations = cursor.fetchall()
+    
+    return {'supplies': supplies, 'preparations': preparations}
+
+@app.route('/api/admin/production-runs', methods=['GET', 'POST'])
+@admin_required
+def production_runs():
+    """Listar tandas de producción del local o registrar una.
+    
+    Una tanda consume los insumos de la preparación (aplanados en preparation_bom)
+    y acredita su insumo de salida con lo que rindió de verdad; la diferencia con
+    el rendimiento de la receta queda como merma.
+    """
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT r.id, r.preparation_id, pr.name AS preparation_name, r.batches,
+                       r.expected_yield, r.actual_yield, r.waste_quantity, s.name AS output_supply,
+                       s.unit, r.notes, u.username, r.created_at
+                FROM production_runs r
+                JOIN preparations pr ON pr.id = r.preparation_id
+                LEFT JOIN supplies s ON s.id = pr.output_supply_id
+                LEFT JOIN users u ON u.id = r.user_id
+                WHERE r.location_id = %s
+                ORDER BY r.created_at DESC
+                LIMIT %s
+            ''', (location_id, request.args.get('limit', 50, type=int)))
+            runs = cursor.fetchall()
+            cursor.close()
+            conn.close()
+            
+            return jsonify(runs)
+        
+        data = request.get_json() or {}
+        batches = Decimal(str(data.get('batches', 1)))
+        if batches <= 0:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'La cantidad de tandas debe ser mayor a 0'}), 400
+        
+        cursor.execute('''
+            SELECT id, name, unit, yield_quantity, output_supply_id FROM preparations WHERE id = %s
+        ''', (data.get('preparation_id'),))
+        preparation = cursor.fetchone()
+        if not preparation:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Preparación no encontrada'}), 404
+        if not preparation['output_supply_id']:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'La preparación no tiene un insumo de salida para acreditar'}), 400
         
-        if start_date:
-            query += ' AND DATE(s.sale_date) >= %s'
-            params.append(start_date)
+        cursor.execute('''
+            SELECT supply_id, quantity FROM preparation_bom WHERE preparation_id = %s
+        ''', (preparation['id'],))
+        bom = cursor.fetchall()
+        if not bom:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'La preparación no tiene insumos'}), 400
+        
+        # El rendimiento está en la unidad de la preparación; se acredita en la del insumo
+        units = batches * preparation['yield_quantity']
+        factor = conversion_factors(cursor, [preparation['output_supply_id']], [preparation['unit']])[0]
+        expected_yield = units * factor
+        actual_yield = Decimal(str(data['actual_yield'])) if data.get('actual_yield') is not None else expected_yield
+        if actual_yield < 0:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Rendimiento inválido'}), 400
         
-        if end_date:
-            query += ' AND DATE(s.sale_date) <= %s'
-            params.append(end_date)
+        cursor.execute('''
+            INSERT INTO production_runs (preparation_id, location_id, batches, expected_yield,
+                                         actual_yield, waste_quantity, notes, user_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, preparation_id, batches, expected_yield, actual_yield, waste_quantity, created_at
+        ''', (preparation['id'], location_id, batches, expected_yield, actual_yield,
+              max(expected_yield - actual_yield, 0), data.get('notes'), session['user_id']))
+        run = cursor.fetchone()
+        
+        # Consumo y acreditación en una sola pasada sobre el stock del local
+        description = f"Producción #{run['id']}: {preparation['name']}"
+        movements = [(row['supply_id'], -row['quantity'] * units, 'produccion', description) for row in bom]
+        if actual_yield > 0:
+            movements.append((preparation['output_supply_id'], actual_yield, 'produccion', description))
+        apply_stock_movements(cursor, location_id, movements, session['user_id'])
         
-        query += ' GROUP BY DATE(s.sale_date) ORDER BY date DESC'
+        conn.commit()
+        cursor.close()
+        conn.close()
         
-        cursor.execute(query, params)
-        sales = cursor.fetchall()
+        return jsonify(run), 201
+    except (InsufficientStockError, UnitConversionError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/production-report', methods=['GET'])
+@admin_required
+def get_production_report():
+    """Producción frente a consumo por ventas entre dos fechas (por defecto, hoy)"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    start_date = request.args.get('start_date') or today
+    end_date = request.args.get('end_date') or today
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        summary = production_summary(cursor, current_location_id(), start_date, end_date)
         
         cursor.close()
         conn.close()
         
-        return jsonify(sales)
+        return jsonify(summary)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/inventory-forecast', methods=['GET'])
+# === MERMAS ===
+
+# Tipos de movimiento que cuentan como consumo al calcular la tasa de merma (las devoluciones, REFUND_TYPE, lo restan)
+CONSUMPTION_TYPES = ('venta', 'descartables', 'produccion')
+
+def refresh_loss_rollup(cursor):
+    """Recalcular supply_loss_daily desde el día anterior a la última corrida (todo, la primera vez).
+    
+    Rehacer días completos, y no solo las filas nuevas, cubre movimientos que se
+    confirmaron tarde con una fecha ya procesada.
+    """
+    cursor.execute('''
+        SELECT refreshed_at::date - 1 AS since FROM rollup_refreshes WHERE view_name = 'supply_loss_daily'
+    ''')
+    row = cursor.fetchone()
+    since = row['since'] if row else None
+    
+    cursor.execute('''
+        DELETE FROM supply_loss_daily WHERE %(since)s::date IS NULL OR day >= %(since)s::date
+    ''', {'since': since})
+    cursor.execute('''
+        INSERT INTO supply_loss_daily (location_id, day, supply_id, consumed, wasted, waste_cost, wasted_by_reason)
+        SELECT d.location_id, d.day, d.supply_id, SUM(d.consumed), SUM(d.wasted),
+               ROUND(SUM(d.wasted) * MAX(s.unit_cost), 4),
+               COALESCE(jsonb_object_agg(d.reason, d.wasted) FILTER (WHERE d.reason IS NOT NULL), '{}')
+        FROM (
+            SELECT location_id, created_at::date AS day, supply_id, reason,
+                   COALESCE(-SUM(quantity_change) FILTER (WHERE type = ANY(%(consumption)s) OR type = %(refund)s), 0)
+                       AS consumed,
+                   COALESCE(-SUM(quantity_change) FILTER (WHERE type = 'merma'), 0) AS wasted
+            FROM inventory_movements
+            WHERE (%(since)s::date IS NULL OR created_at >= %(since)s::date)
+              AND ((quantity_change < 0 AND (type = 'merma' OR type = ANY(%(consumption)s))) OR type = %(refund)s)
+            GROUP BY location_id, created_at::date, supply_id, reason
+        ) d
+        JOIN supplies s ON s.id = d.supply_id
+        GROUP BY d.location_id, d.day, d.supply_id
+    ''', {'since': since, 'consumption': list(CONSUMPTION_TYPES), 'refund': REFUND_TYPE})
+    
+    cursor.execute('''
+        INSERT INTO rollup_refreshes (view_name, refreshed_at)
+        VALUES ('supply_loss_daily', CURRENT_TIMESTAMP)
+        ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+    ''')
+
+@app.route('/api/waste-reasons', methods=['GET'])
 @login_required
-def get_inventory_forecast():
-    """Obtener predicción de stock basada en ventas"""
+def get_waste_reasons():
+    """Motivos de merma disponibles"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute('SELECT code, name FROM waste_reasons ORDER BY name')
+        reasons = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(reasons)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/waste', methods=['POST'])
+@login_required
+def log_waste():
+    """Registrar mermas en lote: {"entries": [{supply_id, quantity, unit?, reason, notes?}]}"""
+    entries = (request.get_json() or {}).get('entries') or []
+    if not entries:
+        return jsonify({'error': 'No hay mermas para registrar'}), 400
+    
+    for entry in entries:
+        if not entry.get('supply_id') or not entry.get('reason'):
+            return jsonify({'error': 'Cada merma necesita supply_id y reason'}), 400
+        try:
+            if Decimal(str(entry.get('quantity'))) <= 0:
+                raise ValueError
+        except (ArithmeticError, ValueError):
+            return jsonify({'error': 'Cantidad inválida'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('SELECT code, name FROM waste_reasons')
+        reasons = {row['code']: row['name'] for row in cursor.fetchall()}
+        unknown = sorted({entry['reason'] for entry in entries} - set(reasons))
+        if unknown:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': f"Motivo de merma inválido: {', '.join(unknown)}"}), 400
+        
+        factors = conversion_factors(cursor, [entry['supply_id'] for entry in entries],
+                                     [entry.get('unit') for entry in entries])
+        movements = [
+            (entry['supply_id'], -Decimal(str(entry['quantity'])) * factor, 'merma',
+             entry.get('notes') or reasons[entry['reason']], entry['reason'])
+            for entry, factor in zip(entries, factors)
+        ]
+        apply_stock_movements(cursor, current_location_id(), movements, session['user_id'])
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({'success': True, 'entries': len(movements)}), 201
+    except (InsufficientStockError, UnitConversionError) as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/waste', methods=['GET'])
+@admin_required
+def get_waste_analytics():
+    """Merma y tasa de merma por insumo, categoría, motivo y día (refresh=true actualiza el rollup)"""
+    days = request.args.get('days', 30, type=int)
+    
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Calcular promedio diario de uso por insumo
+        if request.args.get('refresh') == 'true':
+            refresh_loss_rollup(cursor)
+            conn.commit()
+        
+        # Tasa de merma: lo perdido sobre todo lo que salió del stock (consumo + merma)
+        params = {'location_id': current_location_id(), 'days': days}
         cursor.execute('''
-            SELECT ps.supply_id, s.name, AVG(daily_usage) as avg_daily_usage, s.stock, s.min_stock
-            FROM (
-                SELECT ps.supply_id, COUNT(*) as daily_usage
-                FROM product_supplies ps
-                JOIN sales s ON ps.product_id = s.product_id
-                WHERE s.sale_date >= NOW() - INTERVAL '30 days'
-                GROUP BY ps.supply_id, DATE(s.sale_date)
-            ) daily
-            JOIN supplies s ON daily.supply_id = s.id
-            JOIN product_supplies ps ON s.id = ps.supply_id
-            GROUP BY ps.supply_id, s.name, s.stock, s.min_stock
-            HAVING AVG(daily_usage) > 0
-            ORDER BY (s.stock / NULLIF(AVG(daily_usage), 0)) ASC
-        ''')
+            SELECT s.id AS supply_id, s.name, s.unit, c.name AS category_name,
+                   SUM(d.consumed) AS consumed, SUM(d.wasted) AS wasted, SUM(d.waste_cost) AS waste_cost,
+                   ROUND(SUM(d.wasted) / NULLIF(SUM(d.consumed) + SUM(d.wasted), 0) * 100, 2) AS waste_pct
+            FROM supply_loss_daily d
+            JOIN supplies s ON s.id = d.supply_id
+            LEFT JOIN categories c ON c.id = s.category_id
+            WHERE d.location_id = %(location_id)s AND d.day >= CURRENT_DATE - %(days)s
+            GROUP BY s.id, c.name
+            HAVING SUM(d.wasted) > 0
+            ORDER BY waste_cost DESC, wasted DESC
+        ''', params)
+        by_supply = cursor.fetchall()
         
-        forecast = cursor.fetchall()
+        cursor.execute('''
+            SELECT c.id AS category_id, COALESCE(c.name, 'Sin categoría') AS name,
+                   SUM(d.waste_cost) AS waste_cost,
+                   ROUND(SUM(d.consumed * s.unit_cost), 4) AS consumed_cost,
+                   ROUND(SUM(d.waste_cost) / NULLIF(SUM(d.consumed * s.unit_cost) + SUM(d.waste_cost), 0) * 100, 2) AS waste_pct
+            FROM supply_loss_daily d
+            JOIN supplies s ON s.id = d.supply_id
+            LEFT JOIN categories c ON c.id = s.category_id
+            WHERE d.location_id = %(location_id)s AND d.day >= CURRENT_DATE - %(days)s
+            GROUP BY c.id, c.name
+            HAVING SUM(d.wasted) > 0
+            ORDER BY waste_cost DESC
+        ''', params)
+        by_category = cursor.fetchall()
         
-        # Calcular días hasta agotar stock
-        for item in forecast:
-            if item['avg_daily_usage'] and item['avg_daily_usage'] > 0:
-                days_to_empty = item['stock'] / item['avg_daily_usage']
-                item['days_to_empty'] = round(days_to_empty, 1)
-                item['needs_restock'] = days_to_empty <= 7
+        cursor.execute('''
+            SELECT r.code, r.name, COUNT(DISTINCT d.supply_id) AS supplies,
+                   ROUND(SUM(w.quantity::numeric * s.unit_cost), 4) AS waste_cost
+            FROM supply_loss_daily d
+            CROSS JOIN LATERAL jsonb_each_text(d.wasted_by_reason) AS w(code, quantity)
+            JOIN waste_reasons r ON r.code = w.code
+            JOIN supplies s ON s.id = d.supply_id
+            WHERE d.location_id = %(location_id)s AND d.day >= CURRENT_DATE - %(days)s
+            GROUP BY r.code, r.name
+            ORDER BY waste_cost DESC
+        ''', params)
+        by_reason = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT day, SUM(wasted) AS wasted, SUM(waste_cost) AS waste_cost
+            FROM supply_loss_daily
+            WHERE location_id = %(location_id)s AND day >= CURRENT_DATE - %(days)s
+            GROUP BY day
+            HAVING SUM(wasted) > 0
+            ORDER BY day
+        ''', params)
+        daily = cursor.fetchall()
+        
+        cursor.execute("SELECT refreshed_at FROM rollup_refreshes WHERE view_name = 'supply_loss_daily'")
+        row = cursor.fetchone()
         
         cursor.close()
         conn.close()
         
-        return jsonify(forecast)
+        return jsonify({
+            'by_supply': by_supply,
+            'by_category': by_category,
+            'by_reason': by_reason,
+            'daily': daily,
+            'days': days,
+            'refreshed_at': row['refreshed_at'].isoformat() if row else None
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/generate-full-report', methods=['GET'])
+# === LOTES Y VENCIMIENTOS ===
+
+@app.route('/api/lots', methods=['GET'])
 @login_required
-def generate_full_report():
-    """Generar reporte completo en Excel"""
-    from io import BytesIO
-    from flask import send_file
+def get_lots():
+    """Lotes abiertos del local en orden FEFO (opcional supply_id)"""
+    supply_id = request.args.get('supply_id', type=int)
     
     try:
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute('''
+            SELECT l.id, l.supply_id, s.name, s.unit, l.lot_code, l.quantity, l.initial_quantity,
+                   l.received_at, l.expires_at, l.expires_at - CURRENT_DATE AS days_left
+            FROM supply_lots l
+            JOIN supplies s ON s.id = l.supply_id
+            WHERE l.location_id = %s AND l.quantity > 0
+              AND (%s::integer IS NULL OR l.supply_id = %s::integer)
+            ORDER BY l.supply_id, l.expires_at, l.id
+        ''', (current_location_id(), supply_id, supply_id))
+        lots = cursor.fetchall()
+        cursor.close()
+        conn.close()
         
-        # Inventario
+        return jsonify(lots)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/lots/expiring', methods=['GET'])
+@login_required
+def get_expiring_lots():
+    """Lotes con stock que vencen en los próximos N días (incluye los ya vencidos)"""
+    days = request.args.get('days', 3, type=int)
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
         cursor.execute('''
-            SELECT s.name, s.stock, s.min_stock, s.unit, c.name as category
-            FROM supplies s
-            LEFT JOIN categories c ON s.category_id = c.id
-            ORDER BY c.name, s.name
-        ''')
-        inventory = cursor.fetchall()
+            SELECT l.id, l.supply_id, s.name, s.unit, l.lot_code, l.quantity, l.expires_at,
+                   l.expires_at - CURRENT_DATE AS days_left,
+                   ROUND(l.quantity * s.unit_cost, 2) AS value_at_risk
+            FROM supply_lots l
+            JOIN supplies s ON s.id = l.supply_id
+            WHERE l.location_id = %s AND l.quantity > 0
+              AND l.expires_at IS NOT NULL AND l.expires_at <= CURRENT_DATE + %s
+            ORDER BY l.expires_at, s.name
+        ''', (current_location_id(), days))
+        lots = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        
+        return jsonify({'lots': lots, 'days': days, 'value_at_risk': sum(lot['value_at_risk'] for lot in lots)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/lots', methods=['POST'])
+@admin_required
+def receive_lot():
+    """Ingresar un lote: suma al stock del local y queda disponible para FEFO"""
+    data = request.get_json() or {}
+    if not data.get('supply_id'):
+        return jsonify({'error': 'Insumo requerido'}), 400
+    try:
+        quantity = Decimal(str(data.get('quantity')))
+        if quantity <= 0:
+            raise ValueError
+    except (ArithmeticError, ValueError):
+        return jsonify({'error': 'Cantidad inválida'}), 400
+    
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        quantity *= conversion_factors(cursor, [data['supply_id']], [data.get('unit')])[0]
         
-        # Ventas del mes
         cursor.execute('''
-            SELECT DATE(s.sale_date) as date, p.name as product, s.quantity, s.total_amount
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE DATE_TRUNC('month', s.sale_date) = DATE_TRUNC('month', CURRENT_DATE)
-            ORDER BY s.sale_date DESC
-        ''')
-        sales = cursor.fetchall()
+            INSERT INTO supply_lots (location_id, supply_id, lot_code, initial_quantity, quantity,
+                                     received_at, expires_at, notes, user_id)
+            VALUES (%s, %s, %s, %s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP), %s, %s, %s)
+            RETURNING id, supply_id, lot_code, quantity, received_at, expires_at
+        ''', (location_id, data['supply_id'], data.get('lot_code'), quantity, quantity,
+              data.get('received_at'), data.get('expires_at'), data.get('notes'), session['user_id']))
+        lot = cursor.fetchone()
+        
+        apply_stock_movements(cursor, location_id, [
+            (data['supply_id'], quantity, 'restock', f"Lote #{lot['id']}" + (f" ({data['lot_code']})" if data.get('lot_code') else ''))
+        ], session['user_id'])
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
         
-        df_inventory = pd.DataFrame(inventory)
-        df_sales = pd.DataFrame(sales)
+        return jsonify(lot), 201
+    except UnitConversionError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+# === RECEPCIÓN DE MERCADERÍA ===
+
+def record_goods_receipt(cursor, location_id, supplier_id, lines, reference=None, notes=None, user_id=None):
+    """Registrar un remito: líneas, lotes, costos y stock en sentencias set-based.
+    
+    lines: [{supply_id, quantity, unit?, unit_cost?, expires_at?, lot_code?}], con
+    cantidad y costo en la unidad de compra. El stock solo se incrementa
+    (stock + cantidad), nunca se escribe un valor leído antes.
+    """
+    factors = conversion_factors(cursor, [line['supply_id'] for line in lines], [line.get('unit') for line in lines])
+    
+    purchase_quantities = [Decimal(str(line['quantity'])) for line in lines]
+    purchase_costs = [Decimal(str(line['unit_cost'])) if line.get('unit_cost') is not None else None for line in lines]
+    quantities = [quantity * factor for quantity, factor in zip(purchase_quantities, factors)]
+    unit_costs = [cost / factor if cost is not None else None for cost, factor in zip(purchase_costs, factors)]
+    total_cost = sum(quantity * cost for quantity, cost in zip(purchase_quantities, purchase_costs) if cost is not None)
+    
+    cursor.execute('''
+        INSERT INTO goods_receipts (location_id, supplier_id, reference, total_cost, notes, user_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id, location_id, supplier_id, reference, total_cost, received_at
+    ''', (location_id, supplier_id, reference, total_cost, notes, user_id))
+    receipt = cursor.fetchone()
+    
+    cursor.execute('''
+        INSERT INTO goods_receipt_lines (receipt_id, supply_id, quantity, purchase_unit, purchase_quantity,
+                                         unit_cost, purchase_unit_cost, lot_code, expires_at)
+        SELECT %s, l.supply_id, l.quantity, COALESCE(l.unit, s.unit), l.purchase_quantity,
+               l.unit_cost, l.purchase_unit_cost, l.lot_code, l.expires_at
+        FROM unnest(%s::integer[], %s::numeric[], %s::text[], %s::numeric[], %s::numeric[], %s::numeric[],
+                    %s::text[], %s::date[])
+            AS l(supply_id, quantity, unit, purchase_quantity, unit_cost, purchase_unit_cost, lot_code, expires_at)
+        JOIN supplies s ON s.id = l.supply_id
+    ''', (receipt['id'], [line['supply_id'] for line in lines], quantities, [line.get('unit') for line in lines],
+          purchase_quantities, unit_costs, purchase_costs, [line.get('lot_code') for line in lines],
+          [line.get('expires_at') for line in lines]))
+    
+    # Las líneas con vencimiento ingresan como lote (ver FEFO en consume_lots_fefo)
+    cursor.execute('''
+        INSERT INTO supply_lots (location_id, supply_id, lot_code, initial_quantity, quantity,
+                                 received_at, expires_at, notes, user_id, receipt_line_id)
+        SELECT %s, supply_id, lot_code, quantity, quantity, %s, expires_at, %s, %s, id
+        FROM goods_receipt_lines
+        WHERE receipt_id = %s AND expires_at IS NOT NULL
+    ''', (location_id, receipt['received_at'], f"Recepción #{receipt['id']}", user_id, receipt['id']))
+    receipt['lots'] = cursor.rowcount
+    
+    # Historial de costos y costo vigente (promedio ponderado si el insumo viene en varias líneas)
+    cursor.execute('''
+        INSERT INTO supply_costs (supply_id, unit_cost, purchase_unit, purchase_unit_cost, quantity, notes, user_id)
+        SELECT supply_id, unit_cost, purchase_unit, purchase_unit_cost, quantity, %s, %s
+        FROM goods_receipt_lines
+        WHERE receipt_id = %s AND unit_cost IS NOT NULL
+    ''', (f"Recepción #{receipt['id']}", user_id, receipt['id']))
+    cursor.execute('''
+        UPDATE supplies s
+        SET unit_cost = c.unit_cost, cost_updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT supply_id, SUM(quantity * unit_cost) / SUM(quantity) AS unit_cost
+            FROM goods_receipt_lines
+            WHERE receipt_id = %s AND unit_cost IS NOT NULL
+            GROUP BY supply_id
+        ) c
+        WHERE s.id = c.supply_id
+        RETURNING s.id
+    ''', (receipt['id'],))
+    costed = [row['id'] for row in cursor.fetchall()]
+    
+    description = f"Recepción #{receipt['id']}" + (f" ({reference})" if reference else '')
+    apply_stock_movements(cursor, location_id, [
+        (line['supply_id'], quantity, 'restock', description) for line, quantity in zip(lines, quantities)
+    ], user_id)
+    
+    receipt['products_updated'] = recompute_product_costs(cursor, supply_ids=costed) if costed else 0
+    receipt['lines'] = len(lines)
+    return receipt
+
+@app.route('/api/admin/suppliers', methods=['GET', 'POST'])
+@admin_required
+def manage_suppliers():
+    """Listar proveedores o crear uno"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        excel_buffer = BytesIO()
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT sp.id, sp.name, sp.contact, COUNT(gr.id) AS receipts, MAX(gr.received_at) AS last_receipt
+                FROM suppliers sp
+                LEFT JOIN goods_receipts gr ON gr.supplier_id = sp.id
+                GROUP BY sp.id
+                ORDER BY sp.name
+            ''')
+            suppliers = cursor.fetchall()
+            cursor.close()
+            conn.close()
+            
+            return jsonify(suppliers)
         
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            df_inventory.to_excel(writer, sheet_name='Inventario', index=False)
-            df_sales.to_excel(writer, sheet_name='Ventas', index=False)
+        data = request.get_json() or {}
+        if not data.get('name'):
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Nombre requerido'}), 400
         
-        excel_buffer.seek(0)
+        cursor.execute('''
+            INSERT INTO suppliers (name, contact) VALUES (%s, %s) RETURNING id, name, contact
+        ''', (data['name'], data.get('contact')))
+        supplier = cursor.fetchone()
+        conn.commit()
         cursor.close()
         conn.close()
         
-        return send_file(
-            excel_buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'reporte_completo_{datetime.now().strftime("%Y%m%d")}.xlsx'
-        )
+        return jsonify(supplier), 201
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Ya existe un proveedor con ese nombre'}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/receipts', methods=['GET', 'POST'])
+@admin_required
+def manage_receipts():
+    """Listar recepciones del local o registrar un remito con muchas líneas"""
+    location_id = current_location_id()
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if request.method == 'GET':
+            cursor.execute('''
+                SELECT gr.id, gr.reference, sp.name AS supplier, gr.total_cost, gr.received_at,
+                       u.username, (SELECT COUNT(*) FROM goods_receipt_lines l WHERE l.receipt_id = gr.id) AS lines
+                FROM goods_receipts gr
+                JOIN suppliers sp ON sp.id = gr.supplier_id
+                LEFT JOIN users u ON u.id = gr.user_id
+                WHERE gr.location_id = %s
+                ORDER BY gr.received_at DESC
+                LIMIT %s
+            ''', (location_id, request.args.get('limit', 50, type=int)))
+            receipts = cursor.fetchall()
+            cursor.close()
+            conn.close()
+            
+            return jsonify(receipts)
+        
+        data = request.get_json() or {}
+        lines = data.get('lines') or []
+        if not data.get('supplier_id') or not lines:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Proveedor y líneas requeridos'}), 400
+        for line in lines:
+            try:
+                if not line.get('supply_id') or Decimal(str(line.get('quantity'))) <= 0:
+                    raise ValueError
+                if line.get('unit_cost') is not None and Decimal(str(line['unit_cost'])) < 0:
+                    raise ValueError
+            except (ArithmeticError, ValueError):
+                cursor.close()
+                conn.close()
+                return jsonify({'error': f"Línea inválida: {line}"}), 400
+        
+        receipt = record_goods_receipt(cursor, location_id, data['supplier_id'], lines,
+                                       data.get('reference'), data.get('notes'), session['user_id'])
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        return jsonify(receipt), 201
+    except UnitConversionError as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Ese remito del proveedor ya fue registrado'}), 409
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Proveedor no encontrado'}), 400
+    except Exception as e:
+        if 'conn' in locals():
+            conn.rollback()
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/receipts/<int:receipt_id>', methods=['GET'])
+@admin_required
+def get_receipt(receipt_id):
+    """Un remito con sus líneas"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute('''
+            SELECT gr.id, gr.location_id, gr.reference, gr.supplier_id, sp.name AS supplier,
+                   gr.total_cost, gr.notes, gr.received_at, u.username
+            FROM goods_receipts gr
+            JOIN suppliers sp ON sp.id = gr.supplier_id
+            LEFT JOIN users u ON u.id = gr.user_id
+            WHERE gr.id = %s
+        ''', (receipt_id,))
+        receipt = cursor.fetchone()
+        if not receipt:
+            cursor.close()
+            conn.close()
+            return jsonify({'error': 'Recepción no encontrada'}), 404
+        
+        cursor.execute('''
+            SELECT l.supply_id, s.name, s.unit, l.quantity, l.purchase_unit, l.purchase_quantity,
+                   l.unit_cost, l.purchase_unit_cost, l.lot_code, l.expires_at
+            FROM goods_receipt_lines l
+            JOIN supplies s ON s.id = l.supply_id
+            WHERE l.receipt_id = %s
+            ORDER BY l.id
+        ''', (receipt_id,))
+        receipt['lines'] = cursor.fetchall()
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(receipt)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# === FEED DE EVENTOS ===
+
+def events_auth_required(f):
+    """Como admin_required, pero acepta también Authorization: Bearer EVENTS_TOKEN (consumidores sin sesión)"""
+    admin_view = admin_required(f)
+    
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if bearer_token_matches(os.getenv('EVENTS_TOKEN')):
+            return f(*args, **kwargs)
+        return admin_view(*args, **kwargs)
+    return decorated_function
+
+@app.route('/api/admin/events', methods=['GET'])
+@events_auth_required
+def get_events():
+    """Eventos confirmados posteriores a ?after (offset opaco), en lotes de ?limit; filtros ?types y ?location_id"""
+    types = [t for t in request.args.get('types', '').split(',') if t] or None
+    if types and set(types) - set(EVENT_TYPES):
+        return jsonify({'error': f"Tipos de evento válidos: {', '.join(EVENT_TYPES)}"}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        feed = read_events(cursor, request.args.get('after'), request.args.get('limit', EVENT_FEED_BATCH, type=int),
+                           types, request.args.get('location_id', type=int))
+        
+        cursor.close()
+        conn.close()
+        
+        return jsonify(feed)
+    except ValueError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
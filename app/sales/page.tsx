@@ -28,8 +28,10 @@ interface Discount {
   id: number
   name: string
   description: string
-  discount_type: "percentage" | "fixed"
+  discount_type: "percentage" | "fixed" | "n_for_m"
   discount_value: number
+  buy_quantity?: number
+  pay_quantity?: number
 }
 
 export default function SalesPage() {
@@ -42,6 +44,7 @@ export default function SalesPage() {
   const [selectedDiscount, setSelectedDiscount] = useState<string>("none")
   const [showCheckout, setShowCheckout] = useState(false)
   const [loading, setLoading] = useState(false)
+  const [totals, setTotals] = useState({ subtotal: 0, discount: 0, total: 0 })
 
   useEffect(() => {
     fetchProducts()
@@ -148,26 +151,41 @@ export default function SalesPage() {
     setCart(cart.filter((item) => item.product_id !== productId))
   }
 
-  const calculateTotals = () => {
-    const subtotal = cart.reduce((sum, item) => sum + item.subtotal, 0)
-
-    let discount = 0
-    if (selectedDiscount !== "none") {
-      const discountObj = discounts.find((d) => d.id.toString() === selectedDiscount)
-      if (discountObj) {
-        if (discountObj.discount_type === "percentage") {
-          discount = (subtotal * discountObj.discount_value) / 100
-        } else {
-          discount = discountObj.discount_value * cart.reduce((sum, item) => sum + item.quantity, 0)
-        }
-      }
+  // Totales calculados por el servidor: incluye descuentos automáticos (happy hour, 3x2)
+  useEffect(() => {
+    if (cart.length === 0) {
+      setTotals({ subtotal: 0, discount: 0, total: 0 })
+      return
     }
 
-    const total = Math.max(0, subtotal - discount)
-    return { subtotal, discount, total }
-  }
+    const subtotal = cart.reduce((sum, item) => sum + item.subtotal, 0)
+    setTotals((current) => ({ ...current, subtotal }))
 
-  const totals = calculateTotals()
+    const controller = new AbortController()
+    fetch("/api/cart/price", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        items: cart.map((item) => ({ product_id: item.product_id, quantity: item.quantity })),
+        discount_id: selectedDiscount !== "none" ? selectedDiscount : null,
+      }),
+      signal: controller.signal,
+    })
+      .then((response) => (response.ok ? response.json() : null))
+      .then((data) => {
+        if (data) {
+          setTotals({
+            subtotal: Number(data.subtotal),
+            discount: Number(data.discount),
+            total: Number(data.total),
+          })
+        }
+      })
+      .catch((error) => {
+        if (error.name !== "AbortError") console.error("Error pricing cart:", error)
+      })
+    return () => controller.abort()
+  }, [cart, selectedDiscount])
 
   return (
     <div className="min-h-screen bg-gradient-to-br from-purple-50 via-pink-50 to-blue-50">
@@ -323,7 +341,9 @@ export default function SalesPage() {
                             {discount.name} (
                             {discount.discount_type === "percentage"
                               ? `${discount.discount_value}%`
-                              : `$${discount.discount_value}`}
+                              : discount.discount_type === "n_for_m"
+                                ? `${discount.buy_quantity}x${discount.pay_quantity}`
+                                : `$${discount.discount_value}`}
                             )
                           </SelectItem>
                         ))}
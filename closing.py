@@ -0,0 +1,278 @@
+"""
+Cierre de caja (reporte Z) por local y día.
+
+close_day congela los totales del día (tickets, unidades, importe bruto,
+descuentos, devoluciones y neto) en day_closes, y el desglose por cajero,
+producto y descuento en day_close_lines, con una sola sentencia sobre las
+ventas del día. Esas filas no se pueden modificar ni borrar (trigger), y un
+trigger sobre sales rechaza ventas, devoluciones o borrados en un día cerrado:
+el reporte Z sigue coincidiendo con las ventas.
+
+Cerrar y vender se coordinan con un advisory lock por local: cada sentencia
+sobre sales toma el lock compartido y el cierre el exclusivo. Una venta en
+curso demora el cierre hasta confirmarse (y entra en el reporte); una que
+empieza durante el cierre espera y después encuentra el día cerrado.
+
+Los reportes diarios toman los días cerrados de estas filas y calculan desde
+sales solo los días abiertos (open_intervals).
+"""
+from datetime import date, timedelta
+
+from partitions import MAINTENANCE_SETTING
+
+# Primer argumento de pg_advisory_xact_lock(clave, location_id) para el cierre de caja
+DAY_CLOSE_LOCK = 7401
+
+DIMENSIONS = ('cashier', 'product', 'discount')
+
+# SQLSTATE propio con el que el trigger rechaza cambios en días cerrados
+DAY_CLOSED_SQLSTATE = 'IL001'
+
+class DayClosedError(ValueError):
+    """El día ya tiene cierre de caja"""
+
+def is_day_closed_error(error):
+    """True si es el error de la BD con que el trigger rechaza una venta en un día cerrado"""
+    return getattr(error, 'pgcode', None) == DAY_CLOSED_SQLSTATE
+
+def install_day_closes(cursor):
+    """Tablas de cierres, inmutabilidad y bloqueo de ventas en días cerrados (idempotente)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS day_closes (
+            id SERIAL PRIMARY KEY,
+            location_id INTEGER NOT NULL REFERENCES locations(id),
+            business_date DATE NOT NULL,
+            closed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            closed_by INTEGER REFERENCES users(id),
+            tickets INTEGER NOT NULL,
+            sales_count INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            gross_amount DECIMAL(12, 2) NOT NULL,
+            discount_amount DECIMAL(12, 2) NOT NULL,
+            refunded_amount DECIMAL(12, 2) NOT NULL,
+            net_amount DECIMAL(12, 2) NOT NULL,
+            UNIQUE (location_id, business_date)
+        )
+    ''')
+    # key_id: usuario, producto o descuento (null: ventas sin descuento elegido);
+    # label es el nombre al momento del cierre
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS day_close_lines (
+            close_id INTEGER NOT NULL REFERENCES day_closes(id),
+            dimension VARCHAR(20) NOT NULL,
+            key_id INTEGER,
+            label TEXT,
+            tickets INTEGER NOT NULL,
+            sales_count INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            gross_amount DECIMAL(12, 2) NOT NULL,
+            discount_amount DECIMAL(12, 2) NOT NULL,
+            refunded_amount DECIMAL(12, 2) NOT NULL,
+            net_amount DECIMAL(12, 2) NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS day_close_lines_close_idx ON day_close_lines (close_id, dimension)
+    ''')
+
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION reject_day_close_change() RETURNS trigger AS $$
+        BEGIN
+            RAISE EXCEPTION 'Los cierres de caja no se modifican';
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    for table in ('day_closes', 'day_close_lines'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {table}_immutable ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_immutable
+            BEFORE UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION reject_day_close_change()
+        ''')
+
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION assert_sales_days_open(locations INTEGER[], days DATE[]) RETURNS void AS $$
+        DECLARE
+            changed RECORD;
+        BEGIN
+            FOR changed IN
+                SELECT DISTINCT l.location_id, l.day FROM unnest(locations, days) AS l(location_id, day) ORDER BY 1, 2
+            LOOP
+                PERFORM pg_advisory_xact_lock_shared({DAY_CLOSE_LOCK}, changed.location_id);
+                IF EXISTS (SELECT 1 FROM day_closes
+                           WHERE location_id = changed.location_id AND business_date = changed.day) THEN
+                    RAISE EXCEPTION 'El día % está cerrado en el local %', changed.day, changed.location_id
+                        USING ERRCODE = '{DAY_CLOSED_SQLSTATE}';
+                END IF;
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    # Cada rama nombra solo las tablas de transición que declara el trigger de esa operación
+    # Las filas que create_month_partition saca de la default y reinserta no son ventas nuevas
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION check_sales_day_open() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('{MAINTENANCE_SETTING}', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                PERFORM assert_sales_days_open(ARRAY(SELECT location_id FROM new_rows),
+                                               ARRAY(SELECT sale_date::date FROM new_rows));
+            ELSE
+                PERFORM assert_sales_days_open(ARRAY(SELECT location_id FROM old_rows),
+                                               ARRAY(SELECT sale_date::date FROM old_rows));
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM assert_sales_days_open(ARRAY(SELECT location_id FROM new_rows),
+                                               ARRAY(SELECT sale_date::date FROM new_rows));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    # Las tablas de transición tienen que declararse por operación
+    for operation, referencing in (('INSERT', 'NEW TABLE AS new_rows'),
+                                   ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+                                   ('DELETE', 'OLD TABLE AS old_rows')):
+        name = f'sales_{operation.lower()}_day_open'
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON sales')
+        cursor.execute(f'''
+            CREATE TRIGGER {name}
+            AFTER {operation} ON sales
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE FUNCTION check_sales_day_open()
+        ''')
+
+def close_day(cursor, location_id, business_date, user_id=None):
+    """Cerrar la caja de un local en un día; devuelve el id del cierre.
+
+    Los totales y el desglose salen de una sola pasada sobre las ventas del día
+    (GROUPING SETS). Unidades e importes son netos de devoluciones; las líneas
+    devueltas del todo no cuentan en sales_count.
+    """
+    if business_date > date.today():
+        raise ValueError('No se puede cerrar un día futuro')
+
+    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', (DAY_CLOSE_LOCK, location_id))
+    cursor.execute('''
+        SELECT 1 FROM day_closes WHERE location_id = %s AND business_date = %s
+    ''', (location_id, business_date))
+    if cursor.fetchone():
+        raise DayClosedError(f'El día {business_date} ya está cerrado')
+
+    cursor.execute('''
+        WITH agg AS (
+            SELECT CASE WHEN GROUPING(s.user_id) = 0 THEN 'cashier'
+                        WHEN GROUPING(s.product_id) = 0 THEN 'product'
+                        WHEN GROUPING(s.discount_id) = 0 THEN 'discount'
+                        ELSE 'total' END AS dimension,
+                   COALESCE(s.user_id, s.product_id, s.discount_id) AS key_id,
+                   COUNT(DISTINCT COALESCE(s.ticket_id, -s.id)) FILTER (WHERE s.refunded_quantity < s.quantity) AS tickets,
+                   COUNT(*) FILTER (WHERE s.refunded_quantity < s.quantity) AS sales_count,
+                   COALESCE(SUM(s.quantity - s.refunded_quantity), 0) AS units,
+                   COALESCE(SUM(COALESCE(s.total_amount, 0) + COALESCE(s.discount_amount, 0)), 0) AS gross_amount,
+                   COALESCE(SUM(COALESCE(s.discount_amount, 0)), 0) AS discount_amount,
+                   COALESCE(SUM(s.refunded_amount), 0) AS refunded_amount,
+                   COALESCE(SUM(COALESCE(s.total_amount, 0) - s.refunded_amount), 0) AS net_amount
+            FROM sales s
+            WHERE s.location_id = %(location_id)s
+              AND s.sale_date >= %(day)s::date AND s.sale_date < %(day)s::date + 1
+            GROUP BY GROUPING SETS ((s.user_id), (s.product_id), (s.discount_id), ())
+        ),
+        header AS (
+            INSERT INTO day_closes (location_id, business_date, closed_by, tickets, sales_count, units,
+                                    gross_amount, discount_amount, refunded_amount, net_amount)
+            SELECT %(location_id)s, %(day)s, %(user_id)s, tickets, sales_count, units,
+                   gross_amount, discount_amount, refunded_amount, net_amount
+            FROM agg
+            WHERE dimension = 'total'
+            RETURNING id
+        ),
+        lines AS (
+            INSERT INTO day_close_lines (close_id, dimension, key_id, label, tickets, sales_count, units,
+                                         gross_amount, discount_amount, refunded_amount, net_amount)
+            SELECT header.id, a.dimension, a.key_id,
+                   CASE a.dimension WHEN 'cashier' THEN u.username
+                                    WHEN 'product' THEN p.name
+                                    ELSE COALESCE(d.name, 'Sin descuento elegido') END,
+                   a.tickets, a.sales_count, a.units, a.gross_amount, a.discount_amount, a.refunded_amount,
+                   a.net_amount
+            FROM agg a
+            CROSS JOIN header
+            LEFT JOIN users u ON a.dimension = 'cashier' AND u.id = a.key_id
+            LEFT JOIN products p ON a.dimension = 'product' AND p.id = a.key_id
+            LEFT JOIN discounts d ON a.dimension = 'discount' AND d.id = a.key_id
+            WHERE a.dimension <> 'total'
+        )
+        SELECT id FROM header
+    ''', {'location_id': location_id, 'day': business_date, 'user_id': user_id})
+    return cursor.fetchone()['id']
+
+def day_close_report(cursor, location_id, business_date):
+    """Reporte Z guardado: totales del día y desglose por dimensión (None si el día no está cerrado)"""
+    cursor.execute('''
+        SELECT * FROM day_closes WHERE location_id = %s AND business_date = %s
+    ''', (location_id, business_date))
+    close = cursor.fetchone()
+    if not close:
+        return None
+
+    cursor.execute('''
+        SELECT dimension, key_id, label, tickets, sales_count, units, gross_amount, discount_amount,
+               refunded_amount, net_amount
+        FROM day_close_lines
+        WHERE close_id = %s
+        ORDER BY dimension, net_amount DESC, label
+    ''', (close['id'],))
+    report = {'close': close}
+    for dimension in DIMENSIONS:
+        report[dimension] = []
+    for line in cursor.fetchall():
+        report[line.pop('dimension')].append(line)
+    return report
+
+def day_closes_between(cursor, location_id, start=None, end=None):
+    """Cierres del local entre start y end inclusive (None es sin límite)"""
+    cursor.execute('''
+        SELECT * FROM day_closes
+        WHERE location_id = %(location_id)s
+          AND (%(start)s::date IS NULL OR business_date >= %(start)s::date)
+          AND (%(end)s::date IS NULL OR business_date <= %(end)s::date)
+        ORDER BY business_date
+    ''', {'location_id': location_id, 'start': start, 'end': end})
+    return cursor.fetchall()
+
+def open_intervals(closed_days, start=None, end=None):
+    """Tramos [desde, hasta) de días sin cierre entre start y end inclusive; None es sin límite"""
+    intervals = []
+    current = start
+    for day in sorted(closed_days):
+        if (start and day < start) or (end and day > end):
+            continue
+        if current is None or current < day:
+            intervals.append((current, day))
+        current = day + timedelta(days=1)
+
+    until = end + timedelta(days=1) if end else None
+    if current is None or until is None or current < until:
+        intervals.append((current, until))
+    return intervals
+
+def open_days_filter(intervals, column='s.sale_date'):
+    """Condición SQL (y sus parámetros) que restringe column a los tramos de open_intervals.
+
+    Rangos explícitos y no un JOIN contra los tramos: el planificador los usa
+    para descartar particiones y recorrer el índice solo en esos días.
+    """
+    conditions, params = [], []
+    for since, until in intervals:
+        bounds = []
+        if since:
+            bounds.append(f'{column} >= %s')
+            params.append(since)
+        if until:
+            bounds.append(f'{column} < %s')
+            params.append(until)
+        conditions.append(' AND '.join(bounds) or 'TRUE')
+    return '(' + (' OR '.join(f'({condition})' for condition in conditions) or 'FALSE') + ')', params
@@ -48,23 +48,20 @@ export default function SalesCheckout({ isOpen, cart, discount, totals, onClose
     setError("")
 
     try {
-      // Process each product in cart
-      for (const item of cart) {
-        const response = await fetch("/api/sale-with-discount", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({
-            product_id: item.product_id,
-            quantity: item.quantity,
-            discount_id: discount || null,
-            supplies_used: [],
-          }),
-        })
-
-        if (!response.ok) {
-          const data = await response.json()
-          throw new Error(data.error || "Error al procesar la venta")
-        }
+      // Todo el carrito en una sola venta (un ticket)
+      const response = await fetch("/api/cart-sale", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          items: cart.map((item) => ({ product_id: item.product_id, quantity: item.quantity })),
+          discount_id: discount !== "none" ? discount : null,
+          supplies_used: [],
+        }),
+      })
+
+      if (!response.ok) {
+        const data = await response.json()
+        throw new Error(data.error || "Error al procesar la venta")
       }
 
       setSuccess(true)
@@ -0,0 +1,143 @@
+"""
+Outbox de eventos y feed incremental para consumidores externos (exportación
+contable, pantalla de cocina).
+
+Cada venta (sale.created), devolución (sale.refunded), movimiento de stock
+(stock.changed) y cambio de producto (product.created / product.updated /
+product.deleted) agrega una fila a event_outbox en la misma transacción que el
+cambio: si la transacción se confirma el evento existe, y si se revierte no.
+Las ventas, devoluciones y el stock los registra la aplicación (un evento por
+venta, ticket o devolución y uno por operación de stock); los productos, un
+trigger, porque se modifican desde varias rutas y desde el worker (precios
+programados).
+
+Posición en el feed: (txid, id), donde txid es la transacción que escribió el
+evento. El id solo no sirve como offset: una transacción que tomó un id menor
+puede confirmarse después de que el consumidor ya leyó ids mayores, y ese
+evento se perdería. El feed solo entrega eventos de transacciones anteriores a
+la más vieja todavía en curso (pg_snapshot_xmin), así que lo que aparezca más
+tarde siempre queda después de la última posición leída. El offset que ve el
+consumidor es "<txid>-<id>" y se trata como un valor opaco.
+
+Los eventos se borran a los EVENT_RETENTION_DAYS días (ver worker.py).
+"""
+import json
+import os
+
+# Eventos por lectura del feed: por defecto y máximo
+EVENT_FEED_BATCH = int(os.getenv('EVENT_FEED_BATCH', '500'))
+EVENT_FEED_MAX_BATCH = int(os.getenv('EVENT_FEED_MAX_BATCH', '5000'))
+EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', '30'))
+
+EVENT_TYPES = ('sale.created', 'sale.refunded', 'stock.changed',
+               'product.created', 'product.updated', 'product.deleted')
+
+START_OFFSET = '0-0'
+
+def install_event_outbox(cursor):
+    """Tabla event_outbox y triggers de eventos de productos (idempotente)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_outbox (
+            txid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+            id BIGSERIAL,
+            event_type VARCHAR(50) NOT NULL,
+            aggregate_id BIGINT,
+            location_id INTEGER,
+            payload JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (txid, id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION record_product_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO event_outbox (event_type, aggregate_id, payload)
+                VALUES ('product.deleted', OLD.id, to_jsonb(OLD));
+            ELSE
+                INSERT INTO event_outbox (event_type, aggregate_id, payload)
+                VALUES (CASE TG_OP WHEN 'INSERT' THEN 'product.created' ELSE 'product.updated' END,
+                        NEW.id, to_jsonb(NEW));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS products_events ON products')
+    cursor.execute('''
+        CREATE TRIGGER products_events
+        AFTER INSERT OR DELETE ON products
+        FOR EACH ROW EXECUTE FUNCTION record_product_event()
+    ''')
+    # Un UPDATE que no cambia nada no genera evento
+    cursor.execute('DROP TRIGGER IF EXISTS products_update_events ON products')
+    cursor.execute('''
+        CREATE TRIGGER products_update_events
+        AFTER UPDATE ON products
+        FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION record_product_event()
+    ''')
+
+def record_event(cursor, event_type, payload, aggregate_id=None, location_id=None):
+    """Agregar un evento al outbox, dentro de la transacción del cursor"""
+    cursor.execute('''
+        INSERT INTO event_outbox (event_type, aggregate_id, location_id, payload)
+        VALUES (%s, %s, %s, %s)
+    ''', (event_type, aggregate_id, location_id, json.dumps(payload, default=str)))
+
+def format_offset(txid, event_id):
+    return f'{txid}-{event_id}'
+
+def parse_offset(offset):
+    """(txid, id) a partir del offset "<txid>-<id>"; ValueError si no es válido"""
+    txid, separator, event_id = (offset or START_OFFSET).partition('-')
+    if not separator or not txid.isdigit() or not event_id.isdigit():
+        raise ValueError(f'Offset inválido: {offset}')
+    return int(txid), int(event_id)
+
+def read_events(cursor, after=START_OFFSET, limit=EVENT_FEED_BATCH, event_types=None, location_id=None):
+    """Eventos confirmados posteriores al offset, en orden, y el offset desde el que seguir leyendo"""
+    txid, event_id = parse_offset(after)
+    limit = max(1, min(limit, EVENT_FEED_MAX_BATCH))
+    # El horizonte sale de la misma sentencia (mismo snapshot) que los eventos
+    cursor.execute('''
+        SELECT h.horizon::text AS horizon, e.*
+        FROM (SELECT pg_snapshot_xmin(pg_current_snapshot()) AS horizon) h
+        LEFT JOIN LATERAL (
+            SELECT txid::text AS txid, id, event_type, aggregate_id, location_id, payload, created_at
+            FROM event_outbox
+            WHERE (txid, id) > (%(txid)s::text::xid8, %(id)s)
+              AND txid < h.horizon
+              AND (%(types)s::text[] IS NULL OR event_type = ANY(%(types)s::text[]))
+              AND (%(location_id)s::integer IS NULL OR location_id = %(location_id)s::integer)
+            ORDER BY txid, id
+            LIMIT %(limit)s
+        ) e ON true
+    ''', {'txid': txid, 'id': event_id, 'types': event_types, 'location_id': location_id, 'limit': limit + 1})
+    rows = cursor.fetchall()
+    horizon = int(rows[0]['horizon'])
+    rows = [row for row in rows if row['id'] is not None]
+
+    events = [{
+        'offset': format_offset(row['txid'], row['id']),
+        'type': row['event_type'],
+        'aggregate_id': row['aggregate_id'],
+        'location_id': row['location_id'],
+        'payload': row['payload'],
+        'created_at': row['created_at'],
+    } for row in rows[:limit]]
+    has_more = len(rows) > limit
+
+    if has_more:
+        next_offset = events[-1]['offset']
+    else:
+        # Todo lo anterior al horizonte ya se leyó (o no pasa los filtros): se sigue desde ahí;
+        # los ids empiezan en 1, así que (horizonte, 0) queda antes de cualquier evento futuro
+        next_offset = format_offset(*max((txid, event_id), (horizon, 0)))
+    return {'events': events, 'next_offset': next_offset, 'has_more': has_more}
+
+def purge_events(cursor, retention_days=EVENT_RETENTION_DAYS):
+    """Borrar los eventos más viejos que el período de retención; devuelve cuántos"""
+    cursor.execute('''
+        DELETE FROM event_outbox WHERE created_at < NOW() - %s * INTERVAL '1 day'
+    ''', (retention_days,))
+    return cursor.rowcount
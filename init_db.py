@@ -4,6 +4,11 @@ Script para inicializar la base de datos con todas las tablas
 import psycopg2
 import os
 from dotenv import load_dotenv
+from partitions import PARTITIONED_TABLES, migrate_to_partitioned, ensure_partitions
+from versioning import install_version_triggers
+from events import install_event_outbox
+from closing import install_day_closes
+from report_cache import install_report_cache
 
 load_dotenv()
 
@@ -15,17 +20,42 @@ def init_database():
         conn = psycopg2.connect(db_url)
         cursor = conn.cursor()
         
-        # Tabla de usuarios
+        # Tabla de locales (el local 1 es el original, dueño de los datos previos)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS locations (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) NOT NULL UNIQUE,
+                address TEXT,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            INSERT INTO locations (id, name) VALUES (1, 'Principal')
+            ON CONFLICT (id) DO NOTHING
+        ''')
+        
+        cursor.execute('''
+            SELECT setval(pg_get_serial_sequence('locations', 'id'), (SELECT MAX(id) FROM locations))
+        ''')
+        
+        # Tabla de usuarios (location_id null = puede operar en cualquier local)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 id SERIAL PRIMARY KEY,
                 username VARCHAR(100) UNIQUE NOT NULL,
                 password VARCHAR(255) NOT NULL,
                 role VARCHAR(50) NOT NULL DEFAULT 'usuario',
+                location_id INTEGER REFERENCES locations(id),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
+        cursor.execute('''
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS location_id INTEGER REFERENCES locations(id)
+        ''')
+        
         # Tabla de categorías
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS categories (
@@ -43,13 +73,43 @@ def init_database():
                 name VARCHAR(100) NOT NULL,
                 category_id INTEGER REFERENCES categories(id),
                 unit VARCHAR(50) NOT NULL,
-                stock DECIMAL(10, 2) NOT NULL DEFAULT 0,
                 min_stock DECIMAL(10, 2) DEFAULT 10,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
+        # Stock por local: cada local bloquea solo sus propias filas al vender
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS location_stock (
+                location_id INTEGER NOT NULL REFERENCES locations(id),
+                supply_id INTEGER NOT NULL REFERENCES supplies(id) ON DELETE CASCADE,
+                stock DECIMAL(10, 2) NOT NULL DEFAULT 0,
+                min_stock DECIMAL(10, 2) DEFAULT 10,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (location_id, supply_id)
+            )
+        ''')
+        
+        # Versión de cada fila: la sube cada movimiento, para detectar ediciones sobre un stock ya cambiado
+        cursor.execute('''
+            ALTER TABLE location_stock ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0
+        ''')
+        
+        # Migrar supplies.stock (modelo de un solo local) al local principal
+        cursor.execute('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'supplies' AND column_name = 'stock'
+        ''')
+        if cursor.fetchone():
+            cursor.execute('''
+                INSERT INTO location_stock (location_id, supply_id, stock, min_stock)
+                SELECT 1, id, stock, min_stock FROM supplies
+                ON CONFLICT (location_id, supply_id) DO NOTHING
+            ''')
+            cursor.execute('ALTER TABLE supplies DROP COLUMN stock')
+            print("Stock de insumos migrado a location_stock (local 1)")
+        
         # Tabla de productos
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS products (
@@ -76,42 +136,695 @@ def init_database():
             )
         ''')
         
-        # Tabla de ventas
+        # Tabla de ventas (particionada por mes de sale_date)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sales (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 user_id INTEGER REFERENCES users(id),
                 product_id INTEGER REFERENCES products(id),
                 quantity INTEGER NOT NULL DEFAULT 1,
-                sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT
-            )
+                sale_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                notes TEXT,
+                location_id INTEGER NOT NULL DEFAULT 1 REFERENCES locations(id),
+                PRIMARY KEY (id, sale_date)
+            ) PARTITION BY RANGE (sale_date)
         ''')
         
-        # Tabla de descartables usados
+        # Tabla de descartables usados (sin clave foránea a sales: una tabla
+        # particionada solo admite claves únicas que incluyan sale_date)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS supplies_used (
                 id SERIAL PRIMARY KEY,
-                sale_id INTEGER REFERENCES sales(id) ON DELETE CASCADE,
+                sale_id INTEGER,
                 supply_id INTEGER REFERENCES supplies(id),
                 quantity DECIMAL(10, 2) NOT NULL,
                 used_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
-        # Tabla de historial de inventario
+        # Tabla de historial de inventario (particionada por mes de created_at)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS inventory_history (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 supply_id INTEGER REFERENCES supplies(id),
                 quantity_change DECIMAL(10, 2) NOT NULL,
                 type VARCHAR(50) NOT NULL,
                 description TEXT,
                 user_id INTEGER REFERENCES users(id),
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                location_id INTEGER NOT NULL DEFAULT 1 REFERENCES locations(id),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        ''')
+        
+        # Tabla de descuentos
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS discounts (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) NOT NULL,
+                description TEXT,
+                discount_type VARCHAR(20) NOT NULL CHECK (discount_type IN ('percentage', 'fixed')),
+                discount_value DECIMAL(10, 2) NOT NULL,
+                min_amount DECIMAL(10, 2) DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Reglas de descuento: alcance, happy hour, N×M y combinación (ver pricing.py)
+        cursor.execute('''
+            ALTER TABLE discounts DROP CONSTRAINT IF EXISTS discounts_discount_type_check
+        ''')
+        cursor.execute('''
+            ALTER TABLE discounts
+                ADD CONSTRAINT discounts_discount_type_check
+                    CHECK (discount_type IN ('percentage', 'fixed', 'n_for_m')),
+                ADD COLUMN IF NOT EXISTS automatic BOOLEAN NOT NULL DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS combinable BOOLEAN NOT NULL DEFAULT TRUE,
+                ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS product_ids INTEGER[],
+                ADD COLUMN IF NOT EXISTS category_ids INTEGER[],
+                ADD COLUMN IF NOT EXISTS start_time TIME,
+                ADD COLUMN IF NOT EXISTS end_time TIME,
+                ADD COLUMN IF NOT EXISTS weekdays SMALLINT[],
+                ADD COLUMN IF NOT EXISTS buy_quantity INTEGER,
+                ADD COLUMN IF NOT EXISTS pay_quantity INTEGER
+        ''')
+        
+        # Precio de productos y montos de ventas con descuento (usados por /api/sale-with-discount)
+        cursor.execute('''
+            ALTER TABLE products ADD COLUMN IF NOT EXISTS price DECIMAL(10, 2)
+        ''')
+        
+        cursor.execute('''
+            ALTER TABLE sales
+                ADD COLUMN IF NOT EXISTS discount_id INTEGER REFERENCES discounts(id),
+                ADD COLUMN IF NOT EXISTS discount_amount DECIMAL(10, 2) DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS total_amount DECIMAL(10, 2) DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS discount_info TEXT,
+                ADD COLUMN IF NOT EXISTS unit_price DECIMAL(10, 2)
+        ''')
+        
+        # Lista de precios con vigencia: historial completo y precios programados.
+        # products.price es copia del vigente (ver pricing.apply_due_prices)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_prices (
+                id SERIAL PRIMARY KEY,
+                product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                price DECIMAL(10, 2) NOT NULL CHECK (price >= 0),
+                effective_from TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                notes TEXT,
+                user_id INTEGER REFERENCES users(id),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (product_id, effective_from)
+            )
+        ''')
+        
+        # Precio inicial de los productos que ya tenían uno
+        cursor.execute('''
+            INSERT INTO product_prices (product_id, price, effective_from, notes)
+            SELECT id, price, COALESCE(created_at, CURRENT_TIMESTAMP), 'Precio inicial'
+            FROM products p
+            WHERE price IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM product_prices pp WHERE pp.product_id = p.id)
+        ''')
+        
+        # Migrar tablas existentes sin particionar y crear las particiones mensuales
+        for table in PARTITIONED_TABLES:
+            if migrate_to_partitioned(cursor, table):
+                print(f"Tabla {table} migrada a particiones mensuales")
+            ensure_partitions(cursor, table)
+        
+        # Local de cada venta y movimiento (las filas previas quedan en el local 1)
+        for table in PARTITIONED_TABLES:
+            cursor.execute(f'''
+                ALTER TABLE {table}
+                ADD COLUMN IF NOT EXISTS location_id INTEGER NOT NULL DEFAULT 1 REFERENCES locations(id)
+            ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS sales_location_date_idx ON sales (location_id, sale_date)
+        ''')
+        
+        # Ticket: agrupa las líneas de una misma venta de carrito
+        cursor.execute('''
+            CREATE SEQUENCE IF NOT EXISTS sales_ticket_seq
+        ''')
+        cursor.execute('''
+            ALTER TABLE sales ADD COLUMN IF NOT EXISTS ticket_id BIGINT
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS sales_ticket_idx ON sales (ticket_id)
+        ''')
+        
+        # Devoluciones: lo devuelto de cada línea (anulada si refunded_quantity = quantity);
+        # los reportes cuentan quantity - refunded_quantity y total_amount - refunded_amount
+        cursor.execute('''
+            ALTER TABLE sales
+                ADD COLUMN IF NOT EXISTS refunded_quantity INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS refunded_amount DECIMAL(10, 2) NOT NULL DEFAULT 0
+        ''')
+        
+        # Registro de cada devolución (sin clave foránea a sales, igual que supplies_used)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sale_refunds (
+                id SERIAL PRIMARY KEY,
+                sale_id INTEGER NOT NULL,
+                sale_date TIMESTAMP NOT NULL,
+                ticket_id BIGINT,
+                product_id INTEGER REFERENCES products(id),
+                location_id INTEGER NOT NULL REFERENCES locations(id),
+                quantity INTEGER NOT NULL CHECK (quantity > 0),
+                amount DECIMAL(10, 2) NOT NULL,
+                reason TEXT,
+                user_id INTEGER REFERENCES users(id),
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS sale_refunds_sale_idx ON sale_refunds (sale_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS sale_refunds_location_created_idx ON sale_refunds (location_id, created_at)
+        ''')
+        # Al anular una línea se devuelven sus descartables
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS supplies_used_sale_idx ON supplies_used (sale_id)
+        ''')
+        
+        # Índices por fecha para reportes y listados recientes
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS sales_sale_date_idx ON sales (sale_date)
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS inventory_history_created_idx ON inventory_history (created_at)
+        ''')
+        
+        # Registro de particiones archivadas por la política de retención
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS partition_archives (
+                id SERIAL PRIMARY KEY,
+                table_name VARCHAR(100) NOT NULL,
+                partition_name VARCHAR(100) NOT NULL,
+                range_start DATE NOT NULL,
+                range_end DATE NOT NULL,
+                row_count INTEGER NOT NULL,
+                archive_path VARCHAR(255) NOT NULL,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Índice para sumar movimientos de un insumo de un local en un rango de fechas
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS inventory_history_location_supply_created_idx
+            ON inventory_history (location_id, supply_id, created_at) INCLUDE (quantity_change)
+        ''')
+        
+        cursor.execute('''
+            DROP INDEX IF EXISTS inventory_history_supply_created_idx
+        ''')
+        
+        # Tabla de snapshots diarios de stock por local (calculados desde inventory_history)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_snapshots (
+                location_id INTEGER NOT NULL DEFAULT 1 REFERENCES locations(id),
+                supply_id INTEGER NOT NULL REFERENCES supplies(id),
+                snapshot_at TIMESTAMP NOT NULL,
+                stock DECIMAL(12, 2) NOT NULL,
+                PRIMARY KEY (location_id, supply_id, snapshot_at)
+            )
+        ''')
+        
+        # Migrar snapshots de un solo local: la clave primaria pasa a incluir el local
+        cursor.execute('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'inventory_snapshots' AND column_name = 'location_id'
+        ''')
+        if not cursor.fetchone():
+            cursor.execute('''
+                ALTER TABLE inventory_snapshots
+                    ADD COLUMN location_id INTEGER NOT NULL DEFAULT 1 REFERENCES locations(id),
+                    DROP CONSTRAINT inventory_snapshots_pkey,
+                    ADD PRIMARY KEY (location_id, supply_id, snapshot_at)
+            ''')
+        
+        # Tabla de conciliaciones entre el historial y el stock de cada local
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_reconciliations (
+                id SERIAL PRIMARY KEY,
+                run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                drift_count INTEGER NOT NULL,
+                details JSONB NOT NULL DEFAULT '[]'
+            )
+        ''')
+        
+        # Tabla de trabajos de reportes en segundo plano
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                id SERIAL PRIMARY KEY,
+                report_type VARCHAR(50) NOT NULL,
+                params JSONB NOT NULL DEFAULT '{}',
+                params_hash VARCHAR(64) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                artifact_path VARCHAR(255),
+                artifact_name VARCHAR(255),
+                error TEXT,
+                requested_by INTEGER REFERENCES users(id),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        
+        # Un solo trabajo activo por reporte y parámetros (pedidos iguales se agrupan)
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS report_jobs_active_idx
+            ON report_jobs (report_type, params_hash)
+            WHERE status IN ('pendiente', 'procesando')
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS report_jobs_pending_idx
+            ON report_jobs (created_at)
+            WHERE status = 'pendiente'
+        ''')
+        
+        # Usuarios que pidieron cada trabajo (un pedido igual reutiliza el trabajo de otro)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS report_job_requests (
+                job_id INTEGER NOT NULL REFERENCES report_jobs(id) ON DELETE CASCADE,
+                user_id INTEGER NOT NULL REFERENCES users(id),
+                requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (job_id, user_id)
+            )
+        ''')
+        
+        # Planes de ejecución capturados de sentencias lentas
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS slow_query_plans (
+                id SERIAL PRIMARY KEY,
+                fingerprint VARCHAR(32) NOT NULL,
+                query TEXT NOT NULL,
+                call_site VARCHAR(255),
+                route VARCHAR(255),
+                duration_ms NUMERIC(12,2) NOT NULL,
+                plan JSONB NOT NULL,
+                captured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS slow_query_plans_fingerprint_idx
+            ON slow_query_plans (fingerprint, captured_at DESC)
+        ''')
+        
+        # Conversiones de unidades (supply_id null = válida para todos los insumos)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS unit_conversions (
+                id SERIAL PRIMARY KEY,
+                from_unit VARCHAR(50) NOT NULL,
+                to_unit VARCHAR(50) NOT NULL,
+                factor DECIMAL(14, 6) NOT NULL CHECK (factor > 0),
+                supply_id INTEGER REFERENCES supplies(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS unit_conversions_idx
+            ON unit_conversions (COALESCE(supply_id, 0), from_unit, to_unit)
+        ''')
+        
+        cursor.execute('''
+            INSERT INTO unit_conversions (from_unit, to_unit, factor) VALUES
+            ('kg', 'gr', 1000), ('gr', 'kg', 0.001),
+            ('kg', 'g', 1000), ('g', 'kg', 0.001),
+            ('g', 'gr', 1), ('gr', 'g', 1),
+            ('l', 'ml', 1000), ('ml', 'l', 0.001)
+            ON CONFLICT DO NOTHING
+        ''')
+        
+        # Costo unitario vigente de cada insumo (en su unidad) y su historial de compras
+        cursor.execute('''
+            ALTER TABLE supplies
+                ADD COLUMN IF NOT EXISTS unit_cost DECIMAL(12, 4) NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS cost_updated_at TIMESTAMP
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS supply_costs (
+                id SERIAL PRIMARY KEY,
+                supply_id INTEGER NOT NULL REFERENCES supplies(id) ON DELETE CASCADE,
+                unit_cost DECIMAL(12, 4) NOT NULL,
+                purchase_unit VARCHAR(50) NOT NULL,
+                purchase_unit_cost DECIMAL(12, 4) NOT NULL,
+                quantity DECIMAL(12, 2),
+                notes TEXT,
+                user_id INTEGER REFERENCES users(id),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS supply_costs_supply_idx ON supply_costs (supply_id, created_at DESC)
+        ''')
+        
+        # Costo y margen calculados de cada producto (ver costing.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_costs (
+                product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+                cost DECIMAL(12, 4) NOT NULL,
+                price DECIMAL(10, 2) NOT NULL,
+                margin DECIMAL(12, 4) NOT NULL,
+                margin_pct DECIMAL(12, 2) NOT NULL,
+                missing_costs INTEGER NOT NULL DEFAULT 0,
+                computed_at TIMESTAMP NOT NULL
+            )
+        ''')
+        
+        # Preparaciones intermedias (sub-recetas): rinden yield_quantity unidades
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS preparations (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) NOT NULL UNIQUE,
+                unit VARCHAR(50) NOT NULL,
+                yield_quantity DECIMAL(10, 2) NOT NULL DEFAULT 1 CHECK (yield_quantity > 0),
+                notes TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Componentes de una preparación: un insumo o una preparación
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS preparation_items (
+                id SERIAL PRIMARY KEY,
+                preparation_id INTEGER NOT NULL REFERENCES preparations(id) ON DELETE CASCADE,
+                supply_id INTEGER REFERENCES supplies(id),
+                component_preparation_id INTEGER REFERENCES preparations(id),
+                quantity DECIMAL(12, 4) NOT NULL,
+                CHECK ((supply_id IS NULL) <> (component_preparation_id IS NULL))
+            )
+        ''')
+        
+        # Insumo con stock que produce la preparación (ej. torta en porciones)
+        cursor.execute('''
+            ALTER TABLE preparations ADD COLUMN IF NOT EXISTS output_supply_id INTEGER REFERENCES supplies(id)
+        ''')
+        
+        # Tandas de producción: consumen insumos y acreditan el insumo de salida
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS production_runs (
+                id SERIAL PRIMARY KEY,
+                preparation_id INTEGER NOT NULL REFERENCES preparations(id),
+                location_id INTEGER NOT NULL REFERENCES locations(id),
+                batches DECIMAL(10, 2) NOT NULL,
+                expected_yield DECIMAL(12, 2) NOT NULL,
+                actual_yield DECIMAL(12, 2) NOT NULL,
+                waste_quantity DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                notes TEXT,
+                user_id INTEGER REFERENCES users(id),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS production_runs_location_created_idx ON production_runs (location_id, created_at)
+        ''')
+        
+        # Las recetas de productos también pueden usar preparaciones
+        cursor.execute('''
+            ALTER TABLE product_supplies ADD COLUMN IF NOT EXISTS preparation_id INTEGER REFERENCES preparations(id)
+        ''')
+        
+        # Listas de materiales aplanadas (ver recipes.py): insumos por unidad
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS preparation_bom (
+                preparation_id INTEGER NOT NULL REFERENCES preparations(id) ON DELETE CASCADE,
+                supply_id INTEGER NOT NULL REFERENCES supplies(id),
+                quantity DECIMAL(14, 6) NOT NULL,
+                PRIMARY KEY (preparation_id, supply_id)
+            )
+        ''')
+        
+        cursor.execute("SELECT to_regclass('product_bom') IS NULL")
+        create_product_bom = cursor.fetchone()[0]
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_bom (
+                product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                supply_id INTEGER NOT NULL REFERENCES supplies(id),
+                quantity DECIMAL(14, 6) NOT NULL,
+                PRIMARY KEY (product_id, supply_id)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS product_bom_supply_idx ON product_bom (supply_id)
+        ''')
+        
+        # Recetas existentes (solo insumos): la lista aplanada es la misma receta
+        if create_product_bom:
+            cursor.execute('''
+                INSERT INTO product_bom (product_id, supply_id, quantity)
+                SELECT product_id, supply_id, SUM(quantity)
+                FROM product_supplies
+                WHERE supply_id IS NOT NULL
+                GROUP BY product_id, supply_id
+            ''')
+        
+        # Totales entre locales: vistas materializadas que el worker refresca
+        # (REFRESH CONCURRENTLY necesita un índice único en cada una)
+        cursor.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS supply_stock_totals AS
+            SELECT s.id AS supply_id, s.name, s.unit,
+                   COALESCE(SUM(ls.stock), 0) AS total_stock,
+                   COUNT(ls.location_id) AS locations,
+                   COUNT(ls.location_id) FILTER (WHERE ls.stock <= ls.min_stock) AS locations_low
+            FROM supplies s
+            LEFT JOIN location_stock ls ON ls.supply_id = s.id
+            GROUP BY s.id, s.name, s.unit
+        ''')
+        
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS supply_stock_totals_idx ON supply_stock_totals (supply_id)
+        ''')
+        
+        # Versión anterior sin descontar devoluciones: se vuelve a crear
+        cursor.execute('''
+            SELECT 1 FROM pg_matviews
+            WHERE matviewname = 'location_sales_daily' AND definition NOT LIKE '%refunded_quantity%'
+        ''')
+        if cursor.fetchone():
+            cursor.execute('DROP MATERIALIZED VIEW location_sales_daily')
+        
+        cursor.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS location_sales_daily AS
+            SELECT location_id, sale_date::date AS day,
+                   COUNT(*) FILTER (WHERE refunded_quantity < quantity) AS sales_count,
+                   SUM(quantity - refunded_quantity) AS units,
+                   SUM(COALESCE(total_amount, 0) - refunded_amount) AS revenue
+            FROM sales
+            WHERE sale_date >= CURRENT_DATE - 90
+            GROUP BY location_id, sale_date::date
+        ''')
+        
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS location_sales_daily_idx ON location_sales_daily (location_id, day)
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_refreshes (
+                view_name VARCHAR(100) PRIMARY KEY,
+                refreshed_at TIMESTAMP NOT NULL
+            )
+        ''')
+        
+        # Mermas: motivo de cada baja de stock que no es venta
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS waste_reasons (
+                code VARCHAR(30) PRIMARY KEY,
+                name VARCHAR(100) NOT NULL
+            )
+        ''')
+        
+        cursor.execute('''
+            INSERT INTO waste_reasons (code, name) VALUES
+            ('vencido', 'Vencido o en mal estado'),
+            ('roto', 'Roto o caído'),
+            ('preparacion', 'Error de preparación'),
+            ('faltante', 'Faltante sin explicación'),
+            ('otro', 'Otro')
+            ON CONFLICT DO NOTHING
+        ''')
+        
+        cursor.execute('''
+            ALTER TABLE inventory_history ADD COLUMN IF NOT EXISTS reason VARCHAR(30) REFERENCES waste_reasons(code)
+        ''')
+        
+        # Movimientos confirmados que todavía no pasaron a inventory_history. La venta
+        # escribe acá (sin particiones, índices secundarios ni FKs) y el worker los
+        # mueve en lotes; las FKs del historial se verifican al moverlos
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                location_id INTEGER NOT NULL,
+                supply_id INTEGER NOT NULL,
+                quantity_change DECIMAL(10, 2) NOT NULL,
+                type VARCHAR(50) NOT NULL,
+                description TEXT,
+                reason VARCHAR(30),
+                user_id INTEGER,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Movimientos que no pasaron al historial porque ya no cumplen sus FKs (por ejemplo
+        # un insumo borrado antes del traspaso); quedan con el error para revisarlos
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_outbox_rejected (
+                id BIGINT PRIMARY KEY,
+                location_id INTEGER NOT NULL,
+                supply_id INTEGER NOT NULL,
+                quantity_change DECIMAL(10, 2) NOT NULL,
+                type VARCHAR(50) NOT NULL,
+                description TEXT,
+                reason VARCHAR(30),
+                user_id INTEGER,
+                created_at TIMESTAMP NOT NULL,
+                error TEXT NOT NULL,
+                rejected_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Libro completo: el historial más lo pendiente de mover y lo rechazado (con id negativo)
+        cursor.execute('''
+            CREATE OR REPLACE VIEW inventory_movements AS
+            SELECT id::bigint AS id, supply_id, location_id, quantity_change, type, description, reason,
+                   user_id, created_at
+            FROM inventory_history
+            UNION ALL
+            SELECT -id, supply_id, location_id, quantity_change, type, description, reason,
+                   user_id, created_at
+            FROM inventory_outbox
+            UNION ALL
+            SELECT -id, supply_id, location_id, quantity_change, type, description, reason,
+                   user_id, created_at
+            FROM inventory_outbox_rejected
+        ''')
+        
+        # Consumo y merma diarios por local e insumo; se actualiza por días desde la última corrida
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS supply_loss_daily (
+                location_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                supply_id INTEGER NOT NULL REFERENCES supplies(id) ON DELETE CASCADE,
+                consumed DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                wasted DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                waste_cost DECIMAL(14, 4) NOT NULL DEFAULT 0,
+                wasted_by_reason JSONB NOT NULL DEFAULT '{}',
+                PRIMARY KEY (location_id, day, supply_id)
+            )
+        ''')
+        
+        # Lotes con fecha de vencimiento; su suma nunca supera el stock del local
+        # (lo que no está en ningún lote es stock sin vencimiento registrado)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS supply_lots (
+                id SERIAL PRIMARY KEY,
+                location_id INTEGER NOT NULL REFERENCES locations(id),
+                supply_id INTEGER NOT NULL REFERENCES supplies(id) ON DELETE CASCADE,
+                lot_code VARCHAR(50),
+                initial_quantity DECIMAL(10, 2) NOT NULL,
+                quantity DECIMAL(10, 2) NOT NULL CHECK (quantity >= 0),
+                received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                expires_at DATE,
+                notes TEXT,
+                user_id INTEGER REFERENCES users(id)
+            )
+        ''')
+        
+        # Lotes abiertos en orden FEFO (primero el que vence antes) y próximos a vencer
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS supply_lots_fefo_idx
+            ON supply_lots (location_id, supply_id, COALESCE(expires_at, 'infinity'::date), id) WHERE quantity > 0
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS supply_lots_expiring_idx
+            ON supply_lots (location_id, expires_at) WHERE quantity > 0 AND expires_at IS NOT NULL
+        ''')
+        
+        # Proveedores y recepciones de mercadería (remitos)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS suppliers (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) UNIQUE NOT NULL,
+                contact TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS goods_receipts (
+                id SERIAL PRIMARY KEY,
+                location_id INTEGER NOT NULL REFERENCES locations(id),
+                supplier_id INTEGER NOT NULL REFERENCES suppliers(id),
+                reference VARCHAR(100),
+                total_cost DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                notes TEXT,
+                user_id INTEGER REFERENCES users(id),
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # El mismo remito de un proveedor no se puede cargar dos veces
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS goods_receipts_reference_idx
+            ON goods_receipts (supplier_id, reference) WHERE reference IS NOT NULL
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS goods_receipts_location_received_idx ON goods_receipts (location_id, received_at)
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS goods_receipt_lines (
+                id SERIAL PRIMARY KEY,
+                receipt_id INTEGER NOT NULL REFERENCES goods_receipts(id) ON DELETE CASCADE,
+                supply_id INTEGER NOT NULL REFERENCES supplies(id),
+                quantity DECIMAL(12, 2) NOT NULL CHECK (quantity > 0),
+                purchase_unit VARCHAR(50) NOT NULL,
+                purchase_quantity DECIMAL(12, 2) NOT NULL,
+                unit_cost DECIMAL(12, 4),
+                purchase_unit_cost DECIMAL(12, 4),
+                lot_code VARCHAR(50),
+                expires_at DATE
+            )
+        ''')
+        
+        # Lote creado por una línea de recepción (las líneas con vencimiento ingresan como lote)
+        cursor.execute('''
+            ALTER TABLE supply_lots ADD COLUMN IF NOT EXISTS receipt_line_id INTEGER REFERENCES goods_receipt_lines(id)
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS goods_receipt_lines_receipt_idx ON goods_receipt_lines (receipt_id)
+        ''')
+        
+        # Versiones de datos para los GET condicionales (ver versioning.py)
+        install_version_triggers(cursor)
+        
+        # Outbox de eventos para consumidores externos (ver events.py)
+        install_event_outbox(cursor)
+        
+        # Cierres de caja: reportes Z inmutables y días cerrados sin ventas nuevas (ver closing.py)
+        install_day_closes(cursor)
+        
+        # Caché de reportes por período (ver report_cache.py)
+        install_report_cache(cursor)
+        
         conn.commit()
         print("Base de datos inicializada correctamente")
         
@@ -234,10 +947,18 @@ def init_database():
         
         for name, cat_id, unit, stock in supplies_data:
             cursor.execute('''
-                INSERT INTO supplies (name, category_id, unit, stock)
-                VALUES (%s, %s, %s, %s)
+                INSERT INTO supplies (name, category_id, unit)
+                VALUES (%s, %s, %s)
                 ON CONFLICT DO NOTHING
-            ''', (name, cat_id, unit, stock))
+            ''', (name, cat_id, unit))
+        
+        # Stock inicial de cada insumo en cada local
+        cursor.execute('''
+            INSERT INTO location_stock (location_id, supply_id, stock, min_stock)
+            SELECT l.id, s.id, 0, s.min_stock
+            FROM locations l CROSS JOIN supplies s
+            ON CONFLICT (location_id, supply_id) DO NOTHING
+        ''')
         
         conn.commit()
         print("Insumos insertados")
@@ -0,0 +1,414 @@
+"""
+Instrumentación de rendimiento: latencia por ruta, tiempo en BD, cantidad de
+queries y filas leídas por petición, expuestas en formato Prometheus.
+
+Cada conexión de get_db() usa InstrumentedConnection, cuyos cursores miden
+cada execute. Los totales de la petición se acumulan en flask.g y al terminar
+se agregan en histogramas por ruta. Los valores son por proceso: con varios
+workers de gunicorn, Prometheus debe sumar las series de cada uno.
+
+Las sentencias que superan SLOW_QUERY_MS se registran en el log
+illima.slow_query (SQL normalizado, sin valores de parámetros). Una muestra
+de las lentas de solo lectura se vuelve a ejecutar con EXPLAIN (ANALYZE,
+BUFFERS) en otra conexión y el plan se guarda en slow_query_plans.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+import psycopg2
+import psycopg2.extensions
+from flask import g, has_request_context, request
+
+logger = logging.getLogger('illima.performance')
+slow_query_logger = logging.getLogger('illima.slow_query')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# Una misma sentencia repetida tantas veces en una petición se marca como N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '5'))
+
+# Umbral del log de sentencias lentas en milisegundos (negativo lo desactiva)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+
+# Fracción de sentencias lentas de solo lectura que se analizan con EXPLAIN ANALYZE
+EXPLAIN_SAMPLE_RATE = float(os.getenv('EXPLAIN_SAMPLE_RATE', '0'))
+# Segundos mínimos entre dos capturas de la misma sentencia
+EXPLAIN_COOLDOWN = float(os.getenv('EXPLAIN_COOLDOWN', '300'))
+EXPLAIN_STATEMENT_TIMEOUT_MS = int(os.getenv('EXPLAIN_STATEMENT_TIMEOUT_MS', '30000'))
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s")
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+@lru_cache(maxsize=2048)
+def normalize_sql(query):
+    """Sentencia sin literales ni parámetros, para agrupar ejecuciones iguales"""
+    query = _LITERAL_RE.sub('?', query)
+    query = _IN_LIST_RE.sub('(?)', query)
+    return _WHITESPACE_RE.sub(' ', query).strip()
+
+def query_fingerprint(normalized):
+    """Huella de una sentencia normalizada: la etiqueta de las métricas y la clave de slow_query_plans"""
+    return hashlib.md5(normalized.encode()).hexdigest()
+
+def detect_n_plus_one(statement_counts, threshold=N_PLUS_ONE_THRESHOLD):
+    """Sentencias ejecutadas threshold veces o más en una misma petición"""
+    return {sql: count for sql, count in statement_counts.items() if count >= threshold}
+
+class Histogram:
+    """Histograma acumulativo estilo Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + '}'
+
+class MetricsRegistry:
+    """Métricas agregadas del proceso"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.request_duration = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.db_duration = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.query_count = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+        self.rows_fetched = Counter()
+        self.connections = Counter()
+        self.n_plus_one = Counter()
+        self.slow_queries = Counter()
+        self.replica_routing = Counter()
+        self.report_cache = Counter()
+
+    def observe_request(self, route, method, status, duration, stats):
+        with self.lock:
+            self.request_duration[(route, method, status)].observe(duration)
+            self.db_duration[(route, method)].observe(stats['db_time'])
+            self.query_count[(route, method)].observe(stats['queries'])
+            self.rows_fetched[(route, method)] += stats['rows']
+            self.connections[(route, method)] += stats['connections']
+
+            for statement in detect_n_plus_one(stats['statements']):
+                self.n_plus_one[(route, method, query_fingerprint(statement))] += 1
+
+    def observe_replica_routing(self, target, reason):
+        """Una conexión de lectura que fue a la réplica o al primario (y por qué)"""
+        with self.lock:
+            self.replica_routing[(target, reason)] += 1
+
+    def observe_report_cache(self, report_type, status):
+        """Un reporte servido desde la caché (hit) o calculado (miss, closed si quedó guardado sin vencimiento)"""
+        with self.lock:
+            self.report_cache[(report_type, status)] += 1
+
+    def _render_histogram(self, lines, name, help_text, histograms, label_names):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, hist in sorted(histograms.items()):
+            labels = dict(zip(label_names, key))
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {count}')
+            lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {hist.count}')
+            lines.append(f'{name}_sum{_labels(**labels)} {hist.sum:.6f}')
+            lines.append(f'{name}_count{_labels(**labels)} {hist.count}')
+
+    def _render_counter(self, lines, name, help_text, counter, label_names):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for key, value in sorted(counter.items()):
+            lines.append(f'{name}{_labels(**dict(zip(label_names, key)))} {value}')
+
+    def render(self):
+        """Texto en formato de exposición de Prometheus"""
+        lines = []
+        with self.lock:
+            self._render_histogram(lines, 'illima_http_request_duration_seconds',
+                                   'Duración total de la petición por ruta.',
+                                   self.request_duration, ('route', 'method', 'status'))
+            self._render_histogram(lines, 'illima_db_time_seconds',
+                                   'Tiempo por petición ejecutando sentencias SQL.',
+                                   self.db_duration, ('route', 'method'))
+            self._render_histogram(lines, 'illima_db_queries_per_request',
+                                   'Sentencias SQL ejecutadas por petición.',
+                                   self.query_count, ('route', 'method'))
+            self._render_counter(lines, 'illima_db_rows_fetched_total',
+                                 'Filas leídas de la BD.', self.rows_fetched, ('route', 'method'))
+            self._render_counter(lines, 'illima_db_connections_total',
+                                 'Conexiones a la BD abiertas.', self.connections, ('route', 'method'))
+            self._render_counter(lines, 'illima_n_plus_one_total',
+                                 'Peticiones que repitieron la misma sentencia N o más veces.',
+                                 self.n_plus_one, ('route', 'method', 'fingerprint'))
+            self._render_counter(lines, 'illima_slow_queries_total',
+                                 'Sentencias que superaron SLOW_QUERY_MS.',
+                                 self.slow_queries, ('route', 'fingerprint'))
+            self._render_counter(lines, 'illima_replica_routing_total',
+                                 'Conexiones de solo lectura por destino (replica o primary) y motivo.',
+                                 self.replica_routing, ('target', 'reason'))
+            self._render_counter(lines, 'illima_report_cache_total',
+                                 'Reportes por período servidos desde la caché (hit) o calculados (miss, closed).',
+                                 self.report_cache, ('report_type', 'status'))
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+def _request_stats():
+    if has_request_context():
+        return g.get('db_stats')
+    return None
+
+def _new_stats():
+    return {'queries': 0, 'db_time': 0.0, 'rows': 0, 'connections': 0, 'statements': Counter()}
+
+class InstrumentedCursorMixin:
+    """Mide cada sentencia y cuenta las filas leídas"""
+
+    def _query_text(self, query):
+        if isinstance(query, bytes):
+            return query.decode('utf-8', 'replace')
+        if not isinstance(query, str):
+            return query.as_string(self)
+        return query
+
+    def _record(self, query, vars, elapsed):
+        text = self._query_text(query)
+        normalized = normalize_sql(text)
+
+        stats = _request_stats()
+        if stats is not None:
+            stats['queries'] += 1
+            stats['db_time'] += elapsed
+            stats['statements'][normalized] += 1
+
+        if SLOW_QUERY_MS >= 0 and elapsed * 1000 >= SLOW_QUERY_MS:
+            self._record_slow_query(text, normalized, vars, elapsed)
+
+    def _record_slow_query(self, text, normalized, vars, elapsed):
+        call_site = _call_site()
+        route = request.url_rule.rule if has_request_context() and request.url_rule else '-'
+
+        slow_query_logger.warning('%.1f ms en %s (%s) [%s] %s: %s', elapsed * 1000, call_site, route,
+                                  describe_params(vars), query_fingerprint(normalized), normalized)
+
+        with metrics.lock:
+            metrics.slow_queries[(route, query_fingerprint(normalized))] += 1
+
+        if (EXPLAIN_SAMPLE_RATE > 0 and is_read_only(text)
+                and random.random() < EXPLAIN_SAMPLE_RATE and _explain_allowed(normalized)):
+            try:
+                statement = self.mogrify(text, vars).decode('utf-8', 'replace')
+            except Exception:
+                return
+            threading.Thread(
+                target=capture_plan,
+                args=(statement, normalized, call_site, route, elapsed * 1000),
+                daemon=True
+            ).start()
+
+    def _record_rows(self, rows):
+        stats = _request_stats()
+        if stats is not None:
+            stats['rows'] += rows
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        self._record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._record_rows(len(rows))
+        return rows
+
+_cursor_classes = {}
+
+def instrumented_cursor_class(base):
+    """Subclase instrumentada (en caché) de una clase de cursor de psycopg2"""
+    if issubclass(base, InstrumentedCursorMixin):
+        return base
+    cls = _cursor_classes.get(base)
+    if cls is None:
+        cls = type(f'Instrumented{base.__name__}', (InstrumentedCursorMixin, base), {})
+        _cursor_classes[base] = cls
+    return cls
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Conexión cuyos cursores (incluido RealDictCursor) quedan instrumentados"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stats = _request_stats()
+        if stats is not None:
+            stats['connections'] += 1
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+# === LOG DE SENTENCIAS LENTAS Y CAPTURA DE PLANES ===
+
+_READ_ONLY_RE = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_WRITE_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY|CALL|NEXTVAL|SETVAL)\b', re.IGNORECASE)
+
+_explain_lock = threading.Lock()
+_explain_running = threading.Semaphore(1)
+_last_explain = {}
+
+def is_read_only(query):
+    """True si la sentencia es una lectura que se puede re-ejecutar con EXPLAIN ANALYZE"""
+    return bool(_READ_ONLY_RE.match(query)) and not _WRITE_RE.search(query)
+
+def describe_params(vars):
+    """Tipos de los parámetros, sin sus valores"""
+    if vars is None:
+        return 'sin parámetros'
+    if isinstance(vars, dict):
+        return ', '.join(f'{key}={type(value).__name__}' for key, value in vars.items())
+    return ', '.join(type(value).__name__ for value in vars)
+
+def _call_site():
+    """Primer frame fuera de este módulo y de psycopg2 (la línea que ejecutó la sentencia)"""
+    frame = sys._getframe(1)
+    while frame:
+        filename = frame.f_code.co_filename
+        if filename != __file__ and f'{os.sep}psycopg2{os.sep}' not in filename:
+            return f'{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'desconocido'
+
+def _explain_allowed(normalized):
+    """Limitar a una captura por sentencia cada EXPLAIN_COOLDOWN segundos"""
+    now = time.monotonic()
+    with _explain_lock:
+        if now - _last_explain.get(normalized, float('-inf')) < EXPLAIN_COOLDOWN:
+            return False
+        _last_explain[normalized] = now
+        return True
+
+def capture_plan(statement, normalized, call_site, route, duration_ms):
+    """Ejecutar EXPLAIN (ANALYZE, BUFFERS) en una conexión aparte y guardar el plan"""
+    if not _explain_running.acquire(blocking=False):
+        return
+
+    conn = None
+    try:
+        conn = psycopg2.connect(os.getenv('DATABASE_URL', 'postgresql://localhost:5432/illima_db'))
+        cursor = conn.cursor()
+
+        # La sentencia se re-ejecuta dentro de una transacción que se descarta
+        cursor.execute('SET LOCAL statement_timeout = %s', (EXPLAIN_STATEMENT_TIMEOUT_MS,))
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement)
+        plan = cursor.fetchone()[0]
+        conn.rollback()
+
+        cursor.execute('''
+            INSERT INTO slow_query_plans (fingerprint, query, call_site, route, duration_ms, plan)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (query_fingerprint(normalized), normalized, call_site, route,
+              round(duration_ms, 2), json.dumps(plan)))
+        conn.commit()
+        cursor.close()
+    except Exception as e:
+        logger.warning('No se pudo capturar el plan de "%s": %s', normalized[:200], e)
+    finally:
+        if conn is not None:
+            conn.close()
+        _explain_running.release()
+
+def summarize_plan(plan):
+    """Tiempo total y recorridos secuenciales con filtro (candidatos a índice) de un plan JSON"""
+    root = plan[0] if isinstance(plan, list) else plan
+    seq_scans = []
+
+    def walk(node):
+        if node.get('Node Type') == 'Seq Scan' and node.get('Filter'):
+            seq_scans.append({
+                'relation': node.get('Relation Name'),
+                'filter': node.get('Filter'),
+                'rows_removed': node.get('Rows Removed by Filter', 0),
+                'actual_rows': node.get('Actual Rows', 0)
+            })
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(root['Plan'])
+    seq_scans.sort(key=lambda scan: scan['rows_removed'], reverse=True)
+
+    return {
+        'execution_ms': root.get('Execution Time'),
+        'shared_read_blocks': root['Plan'].get('Shared Read Blocks', 0),
+        'seq_scans': seq_scans
+    }
+
+def init_instrumentation(app):
+    """Registrar la medición de cada petición en la aplicación Flask"""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.db_stats = _new_stats()
+
+    @app.after_request
+    def record_request_metrics(response):
+        stats = g.get('db_stats')
+        if stats is None:
+            return response
+
+        duration = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule else 'sin_ruta'
+        metrics.observe_request(route, request.method, response.status_code, duration, stats)
+
+        for statement, count in detect_n_plus_one(stats['statements']).items():
+            logger.warning('Posible N+1 en %s %s: %d ejecuciones de "%s" (%s)',
+                           request.method, route, count, statement[:200], query_fingerprint(statement))
+
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats["db_time"] * 1000:.1f};desc="{stats["queries"]} queries", '
+            f'total;dur={duration * 1000:.1f}'
+        )
+        return response
@@ -0,0 +1,271 @@
+"""
+Particionado mensual de sales e inventory_history y retención de particiones antiguas.
+
+Cada tabla se particiona por rango de fecha en tablas hijas mensuales
+(sales_y2026m01, sales_y2026m02, ...) más una partición default. La
+retención archiva las particiones vencidas en CSV comprimidos y las elimina.
+
+Uso:
+    python partitions.py    # crear particiones futuras y archivar las vencidas
+"""
+import gzip
+import os
+import re
+from datetime import date
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tabla particionada -> columna de fecha usada como clave de partición
+PARTITIONED_TABLES = {
+    'sales': 'sale_date',
+    'inventory_history': 'created_at',
+}
+
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+PARTITION_RETENTION_MONTHS = int(os.getenv('PARTITION_RETENTION_MONTHS', '0'))  # 0 = sin retención
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+
+PARTITION_NAME_RE = re.compile(r'_y(\d{4})m(\d{2})$')
+
+# Variable de sesión activa mientras se reubican filas entre particiones: los
+# triggers de validación (cierre de caja) no las tratan como ventas nuevas
+MAINTENANCE_SETTING = 'illima.partition_maintenance'
+
+def add_months(month_start, months):
+    """Sumar meses a una fecha que cae en día 1"""
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def partition_name(table, month):
+    return f'{table}_y{month.year}m{month.month:02d}'
+
+def is_partitioned(cursor, table):
+    """True si la tabla ya es particionada, False si es una tabla común, None si no existe"""
+    cursor.execute('''
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relname = %s
+    ''', (table,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return row[0] == 'p'
+
+def create_month_partition(cursor, table, month):
+    """Crear la partición de un mes, moviendo las filas que hayan caído en la default"""
+    column = PARTITIONED_TABLES[table]
+    name = partition_name(table, month)
+    start, end = month, add_months(month, 1)
+
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (name,))
+    if cursor.fetchone()[0]:
+        return False
+
+    # Postgres no permite crear una partición si la default tiene filas de
+    # ese rango: se sacan temporalmente y se vuelven a insertar
+    cursor.execute(f'''
+        CREATE TEMP TABLE moved_rows ON COMMIT DROP AS
+        WITH moved AS (
+            DELETE FROM {table}_default
+            WHERE {column} >= %s AND {column} < %s
+            RETURNING *
+        )
+        SELECT * FROM moved
+    ''', (start, end))
+
+    cursor.execute(f'''
+        CREATE TABLE {name} PARTITION OF {table}
+        FOR VALUES FROM (%s) TO (%s)
+    ''', (start, end))
+
+    cursor.execute('SELECT set_config(%s, %s, true)', (MAINTENANCE_SETTING, 'on'))
+    cursor.execute(f'INSERT INTO {table} SELECT * FROM moved_rows')
+    cursor.execute('SELECT set_config(%s, %s, true)', (MAINTENANCE_SETTING, 'off'))
+    cursor.execute('DROP TABLE moved_rows')
+    return True
+
+def ensure_partitions(cursor, table, first_month=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Asegurar la partición default y las mensuales desde first_month hasta N meses adelante"""
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT')
+
+    current = month_start(date.today())
+    month = min(first_month or current, current)
+    created = []
+
+    while month <= add_months(current, months_ahead):
+        if create_month_partition(cursor, table, month):
+            created.append(partition_name(table, month))
+        month = add_months(month, 1)
+
+    return created
+
+def migrate_to_partitioned(cursor, table):
+    """Convertir una tabla común existente en particionada, conservando datos, secuencia y claves"""
+    if is_partitioned(cursor, table) is not False:
+        return False
+
+    column = PARTITIONED_TABLES[table]
+    legacy = f'{table}_legacy'
+
+    cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {column} IS NULL')
+    if cursor.fetchone()[0]:
+        raise Exception(f'{table} tiene filas con {column} NULL; corregirlas antes de migrar')
+
+    # Claves foráneas salientes e índices secundarios, para recrearlos en la tabla nueva
+    cursor.execute('''
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+    ''', (table,))
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute('''
+        SELECT i.relname, pg_get_indexdef(i.oid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass AND NOT x.indisprimary
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.oid)
+    ''', (table,))
+    indexes = cursor.fetchall()
+
+    # Claves foráneas entrantes (ej. supplies_used.sale_id): una tabla
+    # particionada solo admite unicidad que incluya la columna de partición
+    cursor.execute('''
+        SELECT conrelid::regclass::text, conname
+        FROM pg_constraint
+        WHERE confrelid = %s::regclass AND contype = 'f'
+    ''', (table,))
+    for referencing_table, conname in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {referencing_table} DROP CONSTRAINT {conname}')
+
+    for index_name, _ in indexes:
+        cursor.execute(f'DROP INDEX {index_name}')
+
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+    cursor.execute(f'ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey')
+
+    cursor.execute(f'''
+        CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS)
+        PARTITION BY RANGE ({column})
+    ''')
+    cursor.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL')
+    cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, {column})')
+
+    # La columna id sigue usando la misma secuencia
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', (legacy, 'id'))
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+
+    cursor.execute(f'SELECT MIN({column}) FROM {legacy}')
+    oldest = cursor.fetchone()[0]
+    ensure_partitions(cursor, table, month_start(oldest) if oldest else None)
+
+    cursor.execute(f'INSERT INTO {table} SELECT * FROM {legacy}')
+
+    for conname, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {conname} {definition}')
+
+    for _, definition in indexes:
+        cursor.execute(definition)
+
+    cursor.execute(f'DROP TABLE {legacy}')
+    return True
+
+def list_month_partitions(cursor, table):
+    """Particiones mensuales de una tabla como [(nombre, mes)] ordenadas por mes"""
+    cursor.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    ''', (table,))
+
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME_RE.search(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+def export_csv_gz(cursor, query, path):
+    """Copiar el resultado de una consulta a un CSV comprimido (escritura atómica)"""
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV HEADER', f)
+    os.replace(tmp_path, path)
+
+def archive_old_partitions(cursor, table, retention_months=PARTITION_RETENTION_MONTHS, archive_dir=ARCHIVE_DIR):
+    """Archivar en CSV comprimido y eliminar las particiones anteriores al período de retención"""
+    if retention_months <= 0:
+        return []
+
+    cutoff = add_months(month_start(date.today()), -retention_months)
+
+    # El historial solo se puede archivar si ya hay snapshots que lo cubren;
+    # si no, las consultas de stock a una fecha perderían movimientos
+    snapshot_horizon = None
+    if table == 'inventory_history':
+        cursor.execute('SELECT MIN(last_at)::date FROM (SELECT MAX(snapshot_at) AS last_at FROM inventory_snapshots GROUP BY location_id, supply_id) s')
+        snapshot_horizon = cursor.fetchone()[0]
+        if not snapshot_horizon:
+            return []
+
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+
+    for name, month in list_month_partitions(cursor, table):
+        end = add_months(month, 1)
+        if end > cutoff or (snapshot_horizon and end > snapshot_horizon):
+            continue
+
+        path = os.path.join(archive_dir, f'{name}.csv.gz')
+        export_csv_gz(cursor, f'SELECT * FROM {name}', path)
+
+        cursor.execute(f'SELECT COUNT(*) FROM {name}')
+        row_count = cursor.fetchone()[0]
+
+        if table == 'sales':
+            export_csv_gz(cursor, f'SELECT * FROM supplies_used WHERE sale_id IN (SELECT id FROM {name})',
+                          os.path.join(archive_dir, f'supplies_used_{name}.csv.gz'))
+            cursor.execute(f'DELETE FROM supplies_used WHERE sale_id IN (SELECT id FROM {name})')
+
+        cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
+
+        cursor.execute('''
+            INSERT INTO partition_archives (table_name, partition_name, range_start, range_end, row_count, archive_path)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (table, name, month, end, row_count, path))
+        archived.append(name)
+
+    return archived
+
+def maintain_partitions(conn):
+    """Crear las particiones de los próximos meses y archivar las vencidas"""
+    cursor = conn.cursor()
+    result = {}
+
+    for table in PARTITIONED_TABLES:
+        created = ensure_partitions(cursor, table)
+        archived = archive_old_partitions(cursor, table)
+        conn.commit()
+        result[table] = {'created': created, 'archived': archived}
+
+    cursor.close()
+    return result
+
+if __name__ == '__main__':
+    db_url = os.getenv('DATABASE_URL', 'postgresql://localhost:5432/illima_db')
+    conn = psycopg2.connect(db_url)
+
+    for table, changes in maintain_partitions(conn).items():
+        print(f"{table}: {len(changes['created'])} particiones creadas, {len(changes['archived'])} archivadas")
+
+    conn.close()
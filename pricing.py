@@ -0,0 +1,270 @@
+"""
+Motor de descuentos y lista de precios: reglas activas compiladas en memoria,
+precio vigente de cada producto y precio de un carrito completo en una sola
+pasada.
+
+Las reglas activas de la tabla discounts se leen una vez y se compilan
+(montos en Decimal, alcance como conjuntos, franja horaria ya parseada). Al
+crear, modificar o desactivar un descuento la caché se invalida; además se
+recarga cada DISCOUNT_CACHE_TTL segundos, que acota cuánto tarda en verse un
+cambio hecho desde otro worker. Calcular el precio de un carrito no consulta
+la BD.
+
+Tipos de regla:
+- percentage: discount_value % sobre las líneas alcanzadas.
+- fixed: discount_value por unidad alcanzada (sin superar el total de la línea).
+- n_for_m: cada buy_quantity unidades alcanzadas se pagan pay_quantity; las
+  unidades gratis son las más baratas.
+
+Condiciones: min_amount (subtotal del carrito), product_ids / category_ids
+(alcance; sin ninguno alcanza todo el carrito), start_time / end_time (happy
+hour, puede cruzar la medianoche) y weekdays (ISO, 1 = lunes). Las reglas
+automatic se aplican solas cuando se cumplen; las demás solo si se eligen.
+Las combinables se acumulan en orden de prioridad, cada una sobre lo que
+dejaron las anteriores; una no combinable compite sola y se queda la opción
+con mayor descuento.
+
+Los precios de productos tienen historial en product_prices, cada uno con su
+fecha de vigencia (effective_from). ProductPriceCache guarda el vigente y los
+programados; products.price queda como copia del vigente, que apply_due_prices
+actualiza cuando un precio programado entra en vigencia.
+"""
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, time as time_of_day
+from decimal import Decimal, ROUND_HALF_UP
+
+CENT = Decimal('0.01')
+
+# Segundos que una regla o un precio cacheado puede quedar desactualizado respecto de otro proceso
+DISCOUNT_CACHE_TTL = float(os.getenv('DISCOUNT_CACHE_TTL', '60'))
+PRICE_CACHE_TTL = float(os.getenv('PRICE_CACHE_TTL', '60'))
+
+def _decimal(value):
+    return Decimal(str(value)) if value is not None else Decimal(0)
+
+def _time(value):
+    if value is None or isinstance(value, time_of_day):
+        return value
+    return time_of_day.fromisoformat(str(value))
+
+def compile_rule(row):
+    """Regla lista para evaluar a partir de una fila de discounts"""
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'type': row['discount_type'],
+        'value': _decimal(row['discount_value']),
+        'min_amount': _decimal(row.get('min_amount')),
+        'automatic': bool(row.get('automatic')),
+        'combinable': row.get('combinable') is not False,
+        'priority': row.get('priority') or 0,
+        'product_ids': frozenset(row['product_ids']) if row.get('product_ids') else None,
+        'category_ids': frozenset(row['category_ids']) if row.get('category_ids') else None,
+        'start_time': _time(row.get('start_time')),
+        'end_time': _time(row.get('end_time')),
+        'weekdays': frozenset(row['weekdays']) if row.get('weekdays') else None,
+        'buy_quantity': row.get('buy_quantity'),
+        'pay_quantity': row.get('pay_quantity'),
+    }
+
+def rule_active_at(rule, moment):
+    """La regla vale en ese día y hora"""
+    if rule['weekdays'] and moment.isoweekday() not in rule['weekdays']:
+        return False
+    start, end = rule['start_time'], rule['end_time']
+    if start is None or end is None:
+        return True
+    now = moment.time()
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+def _in_scope(rule, line):
+    if rule['product_ids'] is None and rule['category_ids'] is None:
+        return True
+    return ((rule['product_ids'] is not None and line['product_id'] in rule['product_ids'])
+            or (rule['category_ids'] is not None and line.get('category_id') in rule['category_ids']))
+
+def _rule_discounts(rule, lines, remaining):
+    """Descuento de la regla en cada línea, sin superar lo que queda por pagar de cada una"""
+    eligible = [i for i, line in enumerate(lines) if _in_scope(rule, line) and remaining[i] > 0]
+    amounts = {}
+    if rule['type'] == 'percentage':
+        for i in eligible:
+            amounts[i] = remaining[i] * rule['value'] / 100
+    elif rule['type'] == 'fixed':
+        for i in eligible:
+            amounts[i] = min(rule['value'] * lines[i]['quantity'], remaining[i])
+    elif rule['type'] == 'n_for_m':
+        buy, pay = rule['buy_quantity'] or 0, rule['pay_quantity'] or 0
+        if buy > pay >= 0:
+            units = sum(int(lines[i]['quantity']) for i in eligible)
+            free = units // buy * (buy - pay)
+            for i in sorted(eligible, key=lambda i: lines[i]['unit_price']):
+                if free <= 0:
+                    break
+                taken = min(free, int(lines[i]['quantity']))
+                amounts[i] = min(taken * lines[i]['unit_price'], remaining[i])
+                free -= taken
+    return {i: amount for i, amount in amounts.items() if amount > 0}
+
+def _apply_rules(rules, lines, subtotals):
+    remaining = list(subtotals)
+    per_line = [Decimal(0)] * len(lines)
+    line_rules = [[] for _ in lines]
+    applied = []
+    for rule in rules:
+        amounts = _rule_discounts(rule, lines, remaining)
+        if not amounts:
+            continue
+        for i, amount in amounts.items():
+            remaining[i] -= amount
+            per_line[i] += amount
+            line_rules[i].append({'id': rule['id'], 'name': rule['name'], 'amount': amount})
+        applied.append({'id': rule['id'], 'name': rule['name'], 'amount': sum(amounts.values())})
+    return per_line, applied, line_rules
+
+def price_cart(rules, lines, moment, selected_ids=()):
+    """Subtotal, descuento y total del carrito y de cada línea.
+
+    lines: [{product_id, category_id, quantity, unit_price}]. Se evalúan las
+    reglas automáticas más las elegidas (selected_ids) que se cumplan en
+    moment; no consulta la BD. Cada línea lleva en applied las reglas que la
+    descontaron, con el importe de cada una en esa línea.
+    """
+    lines = [dict(line, quantity=_decimal(line['quantity']), unit_price=_decimal(line['unit_price']))
+             for line in lines]
+    subtotals = [line['quantity'] * line['unit_price'] for line in lines]
+    cart_subtotal = sum(subtotals, Decimal(0))
+
+    selected = set(selected_ids)
+    candidates = sorted(
+        (rule for rule in rules
+         if (rule['automatic'] or rule['id'] in selected)
+         and cart_subtotal >= rule['min_amount']
+         and rule_active_at(rule, moment)),
+        key=lambda rule: (-rule['priority'], rule['id']))
+
+    options = [[rule for rule in candidates if rule['combinable']]]
+    options += [[rule] for rule in candidates if not rule['combinable']]
+    per_line, applied, line_rules = max((_apply_rules(option, lines, subtotals) for option in options),
+                                        key=lambda result: sum(result[0]))
+
+    priced = []
+    for line, subtotal, discount, rules_applied in zip(lines, subtotals, per_line, line_rules):
+        discount = discount.quantize(CENT, rounding=ROUND_HALF_UP)
+        priced.append(dict(line, subtotal=subtotal, discount=discount, total=subtotal - discount,
+                           applied=[dict(rule, amount=rule['amount'].quantize(CENT, rounding=ROUND_HALF_UP))
+                                    for rule in rules_applied]))
+    discount = sum((line['discount'] for line in priced), Decimal(0))
+    return {
+        'lines': priced,
+        'subtotal': cart_subtotal,
+        'discount': discount,
+        'total': cart_subtotal - discount,
+        'applied': [dict(rule, amount=rule['amount'].quantize(CENT, rounding=ROUND_HALF_UP)) for rule in applied],
+    }
+
+class ReloadingCache:
+    """Datos cargados con loader() y armados con build(); se recargan al invalidar o tras ttl segundos"""
+
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._data = None
+        self._loaded_at = 0.0
+
+    def build(self, rows):
+        return rows
+
+    def get(self):
+        with self.lock:
+            if self._data is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._data = self.build(self.loader())
+                self._loaded_at = time.monotonic()
+            return self._data
+
+    def invalidate(self):
+        with self.lock:
+            self._data = None
+
+class DiscountRuleCache(ReloadingCache):
+    """Descuentos activos en memoria: las filas tal como las devuelve el loader y las reglas compiladas"""
+
+    def __init__(self, loader, ttl=DISCOUNT_CACHE_TTL):
+        super().__init__(loader, ttl)
+
+    def build(self, rows):
+        return rows, [compile_rule(row) for row in rows]
+
+    def rows(self):
+        """Filas de los descuentos activos"""
+        return self.get()[0]
+
+    def rules(self):
+        """Reglas compiladas para price_cart"""
+        return self.get()[1]
+
+class ProductPriceCache(ReloadingCache):
+    """Productos con su precio vigente y los programados a futuro.
+
+    loader() devuelve filas (product_id, name, category_id, effective_from,
+    price) ordenadas por producto y fecha, desde el precio vigente en adelante;
+    effective_from en None es un producto sin lista, con el precio de products.
+    Como los precios futuros ya están cargados, un cambio programado entra en
+    vigencia a su hora sin recargar. Un producto que no está (recién creado en
+    otro worker) fuerza una recarga, como mucho una por segundo.
+    """
+
+    def __init__(self, loader, ttl=PRICE_CACHE_TTL):
+        super().__init__(loader, ttl)
+
+    def build(self, rows):
+        products = {}
+        for row in rows:
+            product = products.setdefault(row['product_id'], {
+                'product_id': row['product_id'], 'name': row['name'], 'category_id': row['category_id'],
+                'starts': [], 'prices': []})
+            if row['price'] is not None:
+                # Sin lista de precios rige products.price desde siempre
+                product['starts'].append(row['effective_from'] or datetime.min)
+                product['prices'].append(Decimal(row['price']))
+        return products
+
+    def product(self, product_id):
+        """Nombre, categoría y lista de precios de un producto, o None si no existe"""
+        products = self.get()
+        if product_id not in products and time.monotonic() - self._loaded_at > 1:
+            self.invalidate()
+            products = self.get()
+        return products.get(product_id)
+
+    def price_at(self, product_id, moment):
+        """Precio vigente en moment (0 si el producto no tiene precio cargado)"""
+        product = self.product(product_id)
+        if product is None:
+            return None
+        position = bisect_right(product['starts'], moment)
+        return product['prices'][position - 1] if position else Decimal(0)
+
+def apply_due_prices(cursor, product_ids=None):
+    """Copiar a products.price los precios que ya entraron en vigencia (de los productos indicados o de todos);
+    devuelve los ids cambiados"""
+    cursor.execute('''
+        UPDATE products p
+        SET price = due.price, updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT DISTINCT ON (product_id) product_id, price
+            FROM product_prices
+            WHERE effective_from <= LOCALTIMESTAMP
+              AND (%(products)s::integer[] IS NULL OR product_id = ANY(%(products)s::integer[]))
+            ORDER BY product_id, effective_from DESC
+        ) due
+        WHERE p.id = due.product_id AND p.price IS DISTINCT FROM due.price
+        RETURNING p.id
+    ''', {'products': product_ids})
+    return [row['id'] for row in cursor.fetchall()]
@@ -0,0 +1,132 @@
+"""
+Recetas anidadas: preparaciones intermedias y lista de materiales aplanada.
+
+Una preparación (ej. la base de brownie hecha en casa) rinde yield_quantity
+unidades a partir de insumos y de otras preparaciones. Las recetas de productos
+pueden usar insumos o preparaciones.
+
+Al guardar una preparación o una receta se aplana todo en dos tablas:
+preparation_bom (insumos por unidad de cada preparación) y product_bom
+(insumos por unidad de cada producto). La venta solo lee product_bom: una
+consulta de un nivel, sin expandir recetas en cada venta.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+class RecipeCycleError(Exception):
+    """Una preparación se usa a sí misma, directa o indirectamente"""
+
+def flatten_preparations(yields, items, names=None):
+    """Insumos por unidad de cada preparación.
+
+    yields: {preparation_id: rendimiento}; items: [(preparation_id, supply_id,
+    component_preparation_id, cantidad)] con uno de los dos ids en None.
+    Devuelve {preparation_id: {supply_id: cantidad}}; lanza RecipeCycleError
+    con el camino del ciclo si lo hay.
+    """
+    names = names or {}
+    components = defaultdict(list)
+    for preparation_id, supply_id, component_id, quantity in items:
+        components[preparation_id].append((supply_id, component_id, Decimal(quantity)))
+
+    flattened = {}
+    visiting = []
+
+    def visit(preparation_id):
+        if preparation_id in flattened:
+            return flattened[preparation_id]
+        if preparation_id in visiting:
+            cycle = visiting[visiting.index(preparation_id):] + [preparation_id]
+            raise RecipeCycleError('Receta circular: ' + ' → '.join(names.get(p, str(p)) for p in cycle))
+
+        visiting.append(preparation_id)
+        totals = defaultdict(Decimal)
+        for supply_id, component_id, quantity in components[preparation_id]:
+            if supply_id is not None:
+                totals[supply_id] += quantity
+            else:
+                for raw_id, raw_quantity in visit(component_id).items():
+                    totals[raw_id] += quantity * raw_quantity
+        visiting.pop()
+
+        batch_yield = Decimal(yields[preparation_id])
+        flattened[preparation_id] = {supply_id: total / batch_yield for supply_id, total in totals.items()}
+        return flattened[preparation_id]
+
+    for preparation_id in yields:
+        visit(preparation_id)
+    return flattened
+
+def dependent_preparations(items, preparation_ids):
+    """Las preparaciones indicadas más todas las que las usan (directa o indirectamente)"""
+    used_by = defaultdict(set)
+    for preparation_id, _, component_id, _ in items:
+        if component_id is not None:
+            used_by[component_id].add(preparation_id)
+
+    found = set(preparation_ids)
+    pending = list(preparation_ids)
+    while pending:
+        for parent in used_by[pending.pop()]:
+            if parent not in found:
+                found.add(parent)
+                pending.append(parent)
+    return found
+
+def rebuild_preparation_bom(cursor):
+    """Aplanar todas las preparaciones en preparation_bom; devuelve los ítems leídos"""
+    cursor.execute('SELECT id, name, yield_quantity FROM preparations')
+    preparations = cursor.fetchall()
+    cursor.execute('''
+        SELECT preparation_id, supply_id, component_preparation_id, quantity
+        FROM preparation_items
+    ''')
+    items = [(row['preparation_id'], row['supply_id'], row['component_preparation_id'], row['quantity'])
+             for row in cursor.fetchall()]
+
+    flattened = flatten_preparations(
+        {row['id']: row['yield_quantity'] for row in preparations}, items,
+        {row['id']: row['name'] for row in preparations})
+
+    rows = [(preparation_id, supply_id, quantity)
+            for preparation_id, supplies in flattened.items()
+            for supply_id, quantity in supplies.items()]
+    cursor.execute('DELETE FROM preparation_bom')
+    cursor.execute('''
+        INSERT INTO preparation_bom (preparation_id, supply_id, quantity)
+        SELECT * FROM unnest(%s::integer[], %s::integer[], %s::numeric[])
+    ''', ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]))
+    return items
+
+def rebuild_product_bom(cursor, product_ids):
+    """Reescribir product_bom de los productos indicados a partir de sus recetas y preparation_bom"""
+    if not product_ids:
+        return
+    cursor.execute('DELETE FROM product_bom WHERE product_id = ANY(%s)', (list(product_ids),))
+    cursor.execute('''
+        INSERT INTO product_bom (product_id, supply_id, quantity)
+        SELECT product_id, supply_id, SUM(quantity)
+        FROM (
+            SELECT ps.product_id, ps.supply_id, ps.quantity
+            FROM product_supplies ps
+            WHERE ps.product_id = ANY(%(products)s) AND ps.supply_id IS NOT NULL
+            UNION ALL
+            SELECT ps.product_id, pb.supply_id, ps.quantity * pb.quantity
+            FROM product_supplies ps
+            JOIN preparation_bom pb ON pb.preparation_id = ps.preparation_id
+            WHERE ps.product_id = ANY(%(products)s)
+        ) lines
+        GROUP BY product_id, supply_id
+    ''', {'products': list(product_ids)})
+
+def rebuild_after_preparation_change(cursor, preparation_id):
+    """Reaplanar tras modificar una preparación; devuelve los productos cuya lista de materiales cambió"""
+    items = rebuild_preparation_bom(cursor)
+    affected = dependent_preparations(items, [preparation_id])
+
+    cursor.execute('''
+        SELECT DISTINCT product_id FROM product_supplies WHERE preparation_id = ANY(%s)
+    ''', (list(affected),))
+    product_ids = [row['product_id'] for row in cursor.fetchall()]
+    rebuild_product_bom(cursor, product_ids)
+    return product_ids
@@ -0,0 +1,100 @@
+"""
+Lecturas de reportes en una réplica de Postgres.
+
+Las rutas de reportes piden get_db('replica'): si hay REPLICA_DATABASE_URL y
+la réplica responde con un atraso de a lo sumo REPLICA_MAX_LAG_SECONDS, la
+conexión va a la réplica; si no, al primario. En ambos casos la sesión es de
+solo lectura, así que una ruta marcada como réplica no puede escribir por
+error aunque termine en el primario.
+
+El atraso se mide como máximo una vez cada REPLICA_CHECK_SECONDS; una réplica
+caída o atrasada no se vuelve a probar hasta pasado ese intervalo, para que
+las peticiones no esperen el timeout de conexión una por una.
+
+Atraso: 0 si la réplica recibe WAL por streaming y ya aplicó todo lo
+recibido (un primario sin escrituras no la hace parecer atrasada); si no,
+el tiempo desde la última transacción aplicada. Ver pg_stat_wal_receiver
+requiere que el usuario tenga pg_read_all_stats (o ser superusuario); sin
+eso la réplica solo se usa mientras haya transacciones recientes.
+"""
+import logging
+import os
+import time
+
+from instrumentation import metrics
+
+logger = logging.getLogger('illima.replication')
+
+REPLICA_DATABASE_URL = os.getenv('REPLICA_DATABASE_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '30'))
+REPLICA_CHECK_SECONDS = float(os.getenv('REPLICA_CHECK_SECONDS', '5'))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', '2'))
+
+REPLICATION_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+'''
+
+def replication_lag(conn):
+    """Segundos de atraso de la réplica (None si nunca aplicó una transacción)"""
+    cursor = conn.cursor()
+    cursor.execute(REPLICATION_LAG_SQL)
+    lag = cursor.fetchone()[0]
+    cursor.close()
+    # La consulta de control no deja una transacción abierta en la conexión que se entrega
+    conn.rollback()
+    return float(lag) if lag is not None else None
+
+class ReplicaRouter:
+    """Elige la réplica mientras responda y esté al día; connect(dsn) abre la conexión"""
+
+    def __init__(self, dsn, connect, max_lag=REPLICA_MAX_LAG_SECONDS, check_interval=REPLICA_CHECK_SECONDS):
+        self.dsn = dsn
+        self._connect = connect
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.last_lag = None
+        self._checked_until = 0.0
+        self._skip_until = 0.0
+
+    def _skip(self, now, reason, detail):
+        self._skip_until = now + self.check_interval
+        self._checked_until = 0.0
+        metrics.observe_replica_routing('primary', reason)
+        logger.warning('Réplica no disponible (%s): lecturas al primario por %ss', detail, self.check_interval)
+
+    def connect(self):
+        """Conexión a la réplica, o None si no hay, no responde o está más atrasada de lo tolerado"""
+        if not self.dsn:
+            return None
+        now = time.monotonic()
+        if now < self._skip_until:
+            metrics.observe_replica_routing('primary', 'skipped')
+            return None
+
+        try:
+            conn = self._connect(self.dsn)
+        except Exception as e:
+            self._skip(now, 'unavailable', e)
+            return None
+
+        if now >= self._checked_until:
+            try:
+                lag = replication_lag(conn)
+            except Exception as e:
+                conn.close()
+                self._skip(now, 'unavailable', e)
+                return None
+            self.last_lag = lag
+            if lag is None or lag > self.max_lag:
+                conn.close()
+                self._skip(now, 'stale', f'atraso de {lag:.1f}s' if lag is not None else 'sin transacciones aplicadas')
+                return None
+            self._checked_until = now + self.check_interval
+
+        metrics.observe_replica_routing('replica', 'ok')
+        return conn
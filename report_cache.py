@@ -0,0 +1,122 @@
+"""
+Caché de reportes por período (report_cache).
+
+Cada entrada es el resultado ya generado (JSON o Excel) de un reporte para
+unos parámetros normalizados (tipo, local, fechas...); la clave es el hash
+de esos parámetros, como en report_jobs.
+
+- Período cerrado: termina antes de hoy y todos sus días con ventas tienen
+  cierre de caja. Las ventas de esos días ya no pueden cambiar (trigger de
+  closing.py), así que la entrada no vence (immutable).
+- Período abierto: la entrada vence a los REPORT_CACHE_TTL_SECONDS, y las
+  devoluciones borran las entradas abiertas que incluyen el día de la venta.
+
+Los reportes muestran nombres de productos, insumos y categorías: cada
+entrada guarda la versión de esas tablas (data_versions, ver versioning.py)
+y deja de valer si cambiaron, aunque el período esté cerrado.
+"""
+import hashlib
+import json
+import os
+from datetime import date
+
+from closing import day_closes_between, open_days_filter, open_intervals
+
+REPORT_CACHE_TTL_SECONDS = int(os.getenv('REPORT_CACHE_TTL_SECONDS', '60'))
+
+def install_report_cache(cursor):
+    """Tabla report_cache (idempotente)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_cache (
+            cache_key VARCHAR(64) PRIMARY KEY,
+            report_type VARCHAR(50) NOT NULL,
+            params JSONB NOT NULL,
+            location_id INTEGER REFERENCES locations(id),
+            period_start DATE,
+            period_end DATE,
+            catalog_version BIGINT NOT NULL,
+            immutable BOOLEAN NOT NULL DEFAULT FALSE,
+            expires_at TIMESTAMP,
+            content BYTEA NOT NULL,
+            mimetype VARCHAR(100) NOT NULL,
+            filename VARCHAR(255),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS report_cache_open_idx
+        ON report_cache (location_id, period_start, period_end)
+        WHERE NOT immutable
+    ''')
+
+def report_cache_key(report_type, params):
+    """Clave de una entrada: mismo reporte y mismos parámetros, misma clave"""
+    raw = json.dumps({'report_type': report_type, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def lookup_report(cursor, cache_key, tables):
+    """Versión actual de las tablas del reporte y la entrada guardada, si sigue vigente (o None)"""
+    cursor.execute('''
+        SELECT v.version AS catalog_version, c.content, c.mimetype, c.filename, c.immutable
+        FROM (
+            SELECT COALESCE(MAX(version), 0) AS version
+            FROM data_versions
+            WHERE table_name = ANY(%s)
+        ) v
+        LEFT JOIN report_cache c
+          ON c.cache_key = %s AND c.catalog_version = v.version
+         AND (c.immutable OR c.expires_at > CURRENT_TIMESTAMP)
+    ''', (list(tables), cache_key))
+    row = cursor.fetchone()
+    entry = row if row['content'] is not None else None
+    return row['catalog_version'], entry
+
+def period_is_closed(cursor, location_id, start, end, today=None):
+    """True si el período termina antes de hoy y no tiene ventas en días sin cierre de caja"""
+    today = today or date.today()
+    if end is None or end >= today:
+        return False
+
+    closed = [close['business_date'] for close in day_closes_between(cursor, location_id, start, end)]
+    open_days, open_params = open_days_filter(open_intervals(closed, start, end))
+    cursor.execute(f'''
+        SELECT EXISTS (SELECT 1 FROM sales s WHERE s.location_id = %s AND {open_days}) AS pending
+    ''', [location_id] + open_params)
+    return not cursor.fetchone()['pending']
+
+def store_report(cursor, cache_key, report_type, params, location_id, start, end,
+                 catalog_version, immutable, content, mimetype, filename=None,
+                 ttl_seconds=REPORT_CACHE_TTL_SECONDS):
+    """Guardar (o reemplazar) una entrada; las de períodos abiertos vencen a los ttl_seconds"""
+    cursor.execute('''
+        INSERT INTO report_cache (cache_key, report_type, params, location_id, period_start, period_end,
+                                  catalog_version, immutable, expires_at, content, mimetype, filename)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s,
+                CASE WHEN %s THEN NULL ELSE CURRENT_TIMESTAMP + %s * INTERVAL '1 second' END,
+                %s, %s, %s)
+        ON CONFLICT (cache_key) DO UPDATE
+            SET catalog_version = EXCLUDED.catalog_version, immutable = EXCLUDED.immutable,
+                expires_at = EXCLUDED.expires_at, content = EXCLUDED.content,
+                mimetype = EXCLUDED.mimetype, filename = EXCLUDED.filename,
+                created_at = CURRENT_TIMESTAMP
+    ''', (cache_key, report_type, json.dumps(params, sort_keys=True, default=str), location_id, start, end,
+          catalog_version, immutable, immutable, ttl_seconds, bytes(content), mimetype, filename))
+
+def invalidate_reports(cursor, location_ids, first_day, last_day):
+    """Borrar las entradas abiertas de esos locales cuyo período incluye algún día entre first_day y last_day"""
+    cursor.execute('''
+        DELETE FROM report_cache
+        WHERE NOT immutable
+          AND location_id = ANY(%s)
+          AND (period_start IS NULL OR period_start <= %s)
+          AND (period_end IS NULL OR period_end >= %s)
+    ''', (list(location_ids), last_day, first_day))
+    return cursor.rowcount
+
+def purge_reports(cursor):
+    """Borrar las entradas abiertas vencidas"""
+    cursor.execute('''
+        DELETE FROM report_cache
+        WHERE NOT immutable AND expires_at <= CURRENT_TIMESTAMP
+    ''')
+    return cursor.rowcount
@@ -0,0 +1,373 @@
+"""
+Benchmarks de los caminos críticos (ventas, listados, reportes y exportaciones)
+y prueba de carga concurrente, contra una base de datos descartable.
+
+`run` crea la base indicada en --database (debe contener "bench" en el nombre),
+la llena con scripts/generate_test_data.py, mide cada endpoint con el cliente
+de pruebas de Flask y guarda los resultados en JSON con el commit actual.
+`compare` contrasta dos resultados y termina con código 1 si algún p95
+empeoró más del umbral.
+
+Uso:
+    python scripts/benchmark.py run --server-dsn postgresql://postgres@localhost/postgres
+    python scripts/benchmark.py compare benchmark_results/abc1234.json benchmark_results/def5678.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from benchmark_ledger import percentile
+import generate_test_data
+
+RESULTS_DIR = 'benchmark_results'
+
+SERVER_TIMING_RE = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+# Mezcla de la prueba de carga: (peso, benchmark)
+LOAD_MIX = [
+    (60, 'sale_with_discount'),
+    (15, 'list_all_products'),
+    (15, 'dashboard_stats'),
+    (10, 'sales_by_date'),
+]
+
+class BenchmarkContext:
+    """Ids de los datos generados y elección reproducible de parámetros"""
+
+    def __init__(self, conn, seed):
+        self.random = random.Random(seed)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT DISTINCT product_id FROM product_bom ORDER BY product_id')
+        self.product_ids = [row[0] for row in cursor.fetchall()]
+        # Descartables con stock en el local de la sesión (el principal), así la venta no se rechaza
+        cursor.execute('SELECT supply_id FROM location_stock WHERE location_id = 1 AND stock > 0 ORDER BY supply_id')
+        self.supply_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT id FROM discounts WHERE active ORDER BY id')
+        self.discount_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+
+    def fork(self, seed):
+        """Copia con su propio generador aleatorio, para un hilo de la prueba de carga"""
+        ctx = copy.copy(self)
+        ctx.random = random.Random(seed)
+        return ctx
+
+    def sale_payload(self):
+        return {
+            'product_id': self.random.choice(self.product_ids),
+            'quantity': self.random.randint(1, 3),
+            'discount_id': self.random.choice(self.discount_ids + [None]),
+            'supplies_used': [{'supply_id': self.random.choice(self.supply_ids), 'quantity': 1}]
+        }
+
+    def date_range(self, days):
+        end = datetime.now() - timedelta(days=self.random.randint(0, 300))
+        return (end - timedelta(days=days)).strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+def _sales_report(client, ctx):
+    start, end = ctx.date_range(7)
+    return client.get(f'/api/admin/sales-report?start_date={start}&end_date={end}')
+
+def _sales_by_date(client, ctx):
+    start, end = ctx.date_range(30)
+    return client.get(f'/api/sales-by-date?start_date={start}&end_date={end}')
+
+def _sales_by_product(client, ctx):
+    start, end = ctx.date_range(30)
+    return client.get(f'/api/sales-by-product?start_date={start}&end_date={end}')
+
+def _full_report(client, ctx):
+    month = (datetime.now() - timedelta(days=ctx.random.randint(0, 300))).strftime('%Y-%m')
+    return client.get(f'/api/generate-full-report?month={month}')
+
+# Micro-benchmarks: nombre -> (iteraciones, función(cliente, contexto) que hace la petición)
+BENCHMARKS = {
+    'sale_with_discount': (200, lambda client, ctx: client.post('/api/sale-with-discount', json=ctx.sale_payload())),
+    'list_all_products': (100, lambda client, ctx: client.get('/api/admin/products')),
+    'list_all_products_search': (100, lambda client, ctx: client.get('/api/admin/products?search=caf')),
+    'dashboard_stats': (100, lambda client, ctx: client.get('/api/dashboard-stats')),
+    'sales_report': (50, _sales_report),
+    'sales_by_product': (50, _sales_by_product),
+    'sales_by_date': (50, _sales_by_date),
+    'inventory_report': (50, lambda client, ctx: client.get('/api/inventory-report')),
+    'inventory_forecast': (50, lambda client, ctx: client.get('/api/inventory-forecast')),
+    'product_costs_refresh': (20, lambda client, ctx: client.get('/api/admin/product-costs?refresh=true')),
+    'export_inventory_excel': (20, lambda client, ctx: client.get('/admin/export-csv')),
+    'export_full_report_excel': (20, _full_report),
+}
+
+def summarize(timings):
+    """Estadísticas en milisegundos de una lista de duraciones en segundos"""
+    values = [t * 1000 for t in timings]
+    return {
+        'n': len(values),
+        'mean_ms': round(statistics.mean(values), 3),
+        'p50_ms': round(percentile(values, 50), 3),
+        'p95_ms': round(percentile(values, 95), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'max_ms': round(max(values), 3),
+    }
+
+def login(app):
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    if response.status_code != 302:
+        raise Exception('No se pudo iniciar sesión como admin')
+    return client
+
+def run_micro(app, ctx, names, scale, warmup=3):
+    """Medir cada benchmark en serie; incluye tiempo y queries de BD (header Server-Timing)"""
+    client = login(app)
+    results = {}
+
+    for name in names:
+        iterations, call = BENCHMARKS[name]
+        iterations = max(1, int(iterations * scale))
+
+        for _ in range(warmup):
+            call(client, ctx)
+
+        timings, db_times, queries, errors = [], [], [], 0
+        for _ in range(iterations):
+            start = time.perf_counter()
+            response = call(client, ctx)
+            timings.append(time.perf_counter() - start)
+
+            if response.status_code >= 400:
+                errors += 1
+            match = SERVER_TIMING_RE.search(response.headers.get('Server-Timing', ''))
+            if match:
+                db_times.append(float(match.group(1)))
+                queries.append(int(match.group(2)))
+
+        results[name] = summarize(timings)
+        results[name]['errors'] = errors
+        if db_times:
+            results[name]['db_mean_ms'] = round(statistics.mean(db_times), 3)
+            results[name]['queries_per_request'] = round(statistics.mean(queries), 1)
+
+        print(f"{name:<28}{results[name]['p50_ms']:>10.2f}{results[name]['p95_ms']:>10.2f}"
+              f"{results[name]['p99_ms']:>10.2f}{results[name].get('queries_per_request', 0):>10}{errors:>8}")
+
+    return results
+
+def run_load(app, ctx, concurrency, duration):
+    """Prueba de carga: N hilos con la mezcla LOAD_MIX durante `duration` segundos"""
+    names = [name for _, name in LOAD_MIX]
+    weights = [weight for weight, _ in LOAD_MIX]
+    deadline = time.perf_counter() + duration
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+
+    def worker(seed):
+        client = login(app)
+        worker_ctx = ctx.fork(seed)
+
+        while time.perf_counter() < deadline:
+            name = worker_ctx.random.choices(names, weights)[0]
+            start = time.perf_counter()
+            response = BENCHMARKS[name][1](client, worker_ctx)
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                timings[name].append(elapsed)
+                if response.status_code >= 400:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=worker, args=(ctx.random.random(),)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    all_timings = [t for values in timings.values() for t in values]
+    result = summarize(all_timings) if all_timings else {'n': 0}
+    result.update({
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 2),
+        'throughput_rps': round(len(all_timings) / elapsed, 1),
+        'errors': sum(errors.values()),
+        'by_benchmark': {name: dict(summarize(values), errors=errors[name])
+                         for name, values in timings.items() if values},
+    })
+    return result
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconocido', False
+
+def create_database(server_dsn, name):
+    """Crear (o recrear) la base descartable y devolver su DSN"""
+    if 'bench' not in name:
+        raise SystemExit(f'La base {name} no parece descartable: el nombre debe contener "bench"')
+
+    conn = psycopg2.connect(server_dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)')
+    cursor.execute(f"CREATE DATABASE {name} ENCODING 'UTF8' TEMPLATE template0")
+    cursor.close()
+    conn.close()
+    return make_dsn(server_dsn, dbname=name)
+
+def drop_database(server_dsn, name):
+    conn = psycopg2.connect(server_dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)')
+    cursor.close()
+    conn.close()
+
+def command_run(args):
+    dsn = create_database(args.server_dsn, args.database)
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('SLOW_QUERY_MS', '-1')
+
+    try:
+        from init_db import init_database
+        init_database()
+
+        from app import app
+        app.config['TESTING'] = True
+
+        conn = psycopg2.connect(dsn)
+        start = time.perf_counter()
+        dataset = generate_test_data.generate(conn, args.products, args.supplies, args.supplies_per_product,
+                                              args.years, args.sales_per_day, seed=args.seed,
+                                              locations=args.locations, lots_per_supply=args.lots_per_supply)
+        print(f'Datos generados en {time.perf_counter() - start:.1f}s: {dataset}')
+
+        cursor = conn.cursor()
+        cursor.execute('SHOW server_version')
+        server_version = cursor.fetchone()[0]
+        cursor.close()
+
+        ctx = BenchmarkContext(conn, args.seed)
+        conn.close()
+
+        names = args.only.split(',') if args.only else list(BENCHMARKS)
+        print(f"\n{'benchmark':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'errores':>8}")
+        micro = run_micro(app, ctx, names, args.scale)
+
+        load = None
+        if args.concurrency > 0:
+            load = run_load(app, ctx, args.concurrency, args.duration)
+            print(f"\nCarga ({args.concurrency} hilos, {load['duration_s']}s): {load['throughput_rps']} req/s, "
+                  f"p50 {load.get('p50_ms')} ms, p95 {load.get('p95_ms')} ms, "
+                  f"p99 {load.get('p99_ms')} ms, {load['errors']} errores")
+    finally:
+        if not args.keep:
+            drop_database(args.server_dsn, args.database)
+
+    commit, dirty = git_commit()
+    result = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'postgres': server_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'dataset': dataset,
+        'micro': micro,
+        'load': load,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f'\nResultados guardados en {output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            return print_comparison(json.load(f), result, args.threshold)
+    return 0
+
+def compare_results(base, current, threshold):
+    """Filas (benchmark, p95 base, p95 actual, % de cambio, regresión) de dos resultados"""
+    rows = []
+    sections = [(name, base['micro'].get(name), stats) for name, stats in current['micro'].items()]
+    if base.get('load') and current.get('load'):
+        sections.append(('carga', base['load'], current['load']))
+
+    for name, before, after in sections:
+        if not before or not before.get('p95_ms'):
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        rows.append((name, before['p95_ms'], after['p95_ms'], round(change, 1), change > threshold))
+    return rows
+
+def print_comparison(base, current, threshold):
+    print(f"\nComparación p95: {base['commit']} -> {current['commit']} (umbral {threshold}%)")
+    print(f"{'benchmark':<28}{'base ms':>10}{'actual ms':>11}{'cambio':>9}")
+
+    rows = compare_results(base, current, threshold)
+    for name, before, after, change, regression in rows:
+        print(f"{name:<28}{before:>10.2f}{after:>11.2f}{change:>+8.1f}%{'  REGRESIÓN' if regression else ''}")
+
+    if base.get('load') and current.get('load'):
+        print(f"throughput: {base['load']['throughput_rps']} -> {current['load']['throughput_rps']} req/s")
+
+    return 1 if any(row[4] for row in rows) else 0
+
+def command_compare(args):
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    return print_comparison(base, current, args.threshold)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Generar datos y medir')
+    run.add_argument('--server-dsn', required=True, help='Conexión a una base existente del servidor (ej. postgres)')
+    run.add_argument('--database', default='illima_benchmark', help='Base descartable a crear')
+    run.add_argument('--keep', action='store_true', help='No borrar la base al terminar')
+    generate_test_data.add_arguments(run)
+    run.add_argument('--only', help='Benchmarks separados por coma (por defecto todos)')
+    run.add_argument('--scale', type=float, default=1.0, help='Multiplicador de iteraciones')
+    run.add_argument('--concurrency', type=int, default=8, help='Hilos de la prueba de carga (0 la omite)')
+    run.add_argument('--duration', type=float, default=30, help='Segundos de la prueba de carga')
+    run.add_argument('--output', help=f'Archivo de resultados (por defecto {RESULTS_DIR}/<commit>.json)')
+    run.add_argument('--compare', help='Resultado anterior contra el cual comparar')
+    run.add_argument('--threshold', type=float, default=15, help='% de aumento del p95 considerado regresión')
+
+    compare = commands.add_parser('compare', help='Comparar dos resultados guardados')
+    compare.add_argument('base')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=15)
+
+    args = parser.parse_args()
+    sys.exit(command_run(args) if args.command == 'run' else command_compare(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark de serialización y compresión de una respuesta grande de
+/api/inventory-history (por defecto 50k filas sintéticas, con Decimal y
+datetime como las que devuelve RealDictCursor).
+
+Compara el proveedor JSON por defecto de Flask con FastJSONProvider (fechas
+en formato "http" e "iso") y mide tamaño y tiempo de compresión gzip y
+brotli. No usa la base de datos.
+
+Uso:
+    python scripts/benchmark_json.py --rows 50000 --repeat 5
+"""
+import argparse
+import gzip
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import brotli
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from psycopg2.extras import RealDictRow
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from serialization import BROTLI_QUALITY, GZIP_LEVEL, FastJSONProvider
+
+TYPES = ('venta', 'venta', 'venta', 'descartables', 'restock', 'ajuste', 'merma')
+
+def history_rows(count):
+    """Filas con la forma de get_inventory_history"""
+    start = datetime(2026, 1, 1, 8)
+    rows = []
+    for i in range(count):
+        row = RealDictRow()
+        row.update({
+            'id': i + 1,
+            'name': f'Insumo {i % 300}',
+            'quantity_change': Decimal(-(i % 7) - 1) / 4 if i % 20 else Decimal('40.00'),
+            'type': TYPES[i % len(TYPES)],
+            'description': f'Venta ticket {i // 3}',
+            'reason': None,
+            'created_at': start + timedelta(seconds=i * 37, microseconds=i % 1000),
+            'username': 'caja1',
+        })
+        rows.append(row)
+    return rows
+
+def median_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    rows = history_rows(args.rows)
+    providers = {
+        'flask (json)': DefaultJSONProvider(app),
+        'orjson http': FastJSONProvider(app, datetime_format='http'),
+        'orjson iso': FastJSONProvider(app, datetime_format='iso'),
+    }
+
+    print(f'{args.rows} filas, mediana de {args.repeat} repeticiones\n')
+    print(f'{"codificador":<16}{"ms":>10}{"bytes":>14}')
+    payloads = {}
+    for name, provider in providers.items():
+        elapsed, body = median_ms(lambda: provider.dumps(rows).encode(), args.repeat)
+        payloads[name] = body
+        print(f'{name:<16}{elapsed:>10.1f}{len(body):>14,}')
+
+    print(f'\n{"compresión":<28}{"ms":>10}{"bytes":>14}{"ratio":>8}')
+    for name in ('orjson http', 'orjson iso'):
+        body = payloads[name]
+        for label, compress in ((f'gzip {GZIP_LEVEL}', lambda: gzip.compress(body, compresslevel=GZIP_LEVEL)),
+                                (f'br {BROTLI_QUALITY}', lambda: brotli.compress(body, quality=BROTLI_QUALITY))):
+            elapsed, compressed = median_ms(compress, args.repeat)
+            print(f'{name + " / " + label:<28}{elapsed:>10.1f}{len(compressed):>14,}'
+                  f'{len(body) / len(compressed):>8.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark de consultas de stock a una fecha ("as-of") sobre años de historial.
+
+Compara el cálculo con snapshot + movimientos contra recorrer todo el historial.
+Escribe datos sintéticos: usar SOLO con una base de datos descartable.
+
+Uso:
+    python scripts/benchmark_ledger.py --dsn postgresql://localhost/illima_bench --years 3 --moves-per-day 400
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+REPLAY_QUERY = '''
+    SELECT COALESCE(SUM(quantity_change), 0) AS stock
+    FROM inventory_history
+    WHERE location_id = %(location_id)s AND supply_id = %(supply_id)s AND created_at <= %(at)s
+'''
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def generate_history(cursor, years, moves_per_day):
+    """Insertar movimientos sintéticos repartidos en los últimos N años"""
+    cursor.execute('SELECT id FROM supplies ORDER BY id')
+    supply_ids = [row['id'] for row in cursor.fetchall()]
+    total = int(years * 365 * moves_per_day)
+
+    cursor.execute('''
+        INSERT INTO inventory_history (supply_id, quantity_change, type, description, created_at)
+        SELECT (%(supply_ids)s::integer[])[1 + (g %% array_length(%(supply_ids)s::integer[], 1))],
+               CASE WHEN g %% 20 = 0 THEN 40 ELSE -1 END,
+               CASE WHEN g %% 20 = 0 THEN 'restock' ELSE 'venta' END,
+               'benchmark',
+               NOW() - (random() * %(days)s) * INTERVAL '1 day'
+        FROM generate_series(1, %(total)s) g
+    ''', {'supply_ids': supply_ids, 'days': years * 365, 'total': total})
+    return supply_ids, total
+
+def time_query(cursor, query, params, repeat, location_id):
+    timings = []
+    for at, supply_id in params[:repeat]:
+        start = time.perf_counter()
+        cursor.execute(query, {'at': at, 'supply_id': supply_id, 'location_id': location_id})
+        cursor.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True, help='Base de datos descartable')
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--moves-per-day', type=int, default=400)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--skip-generate', action='store_true', help='Reusar el historial ya generado')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.dsn
+    from app import DEFAULT_LOCATION_ID, LEDGER_STOCK_QUERY, take_inventory_snapshots
+
+    conn = psycopg2.connect(args.dsn)
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    cursor.execute("SELECT to_regclass('supplies') IS NOT NULL AS ready")
+    if not cursor.fetchone()['ready']:
+        from init_db import init_database
+        init_database()
+
+    if not args.skip_generate:
+        start = time.perf_counter()
+        supply_ids, total = generate_history(cursor, args.years, args.moves_per_day)
+        conn.commit()
+        print(f'Historial generado: {total} movimientos en {time.perf_counter() - start:.1f}s')
+
+        start = time.perf_counter()
+        created = take_inventory_snapshots(cursor)
+        conn.commit()
+        print(f'Snapshots diarios: {created} en {time.perf_counter() - start:.1f}s')
+
+    cursor.execute('ANALYZE inventory_history')
+    cursor.execute('ANALYZE inventory_snapshots')
+    cursor.execute('SELECT id FROM supplies ORDER BY id')
+    supply_ids = [row['id'] for row in cursor.fetchall()]
+
+    now = datetime.now()
+    span = timedelta(days=args.years * 365)
+    params = [(now - random.random() * span, random.choice(supply_ids)) for _ in range(args.queries)]
+
+    # Verificar que ambos métodos coinciden antes de medir (el historial generado es del local principal)
+    location_id = DEFAULT_LOCATION_ID
+    for at, supply_id in params[:20]:
+        query_params = {'at': at, 'supply_id': supply_id, 'location_id': location_id}
+        cursor.execute(REPLAY_QUERY, query_params)
+        replay = cursor.fetchone()['stock']
+        cursor.execute(LEDGER_STOCK_QUERY, query_params)
+        assert cursor.fetchone()['stock'] == replay, f'Diferencia en insumo {supply_id} a {at}'
+
+    results = {
+        'snapshot + delta': time_query(cursor, LEDGER_STOCK_QUERY, params, args.queries, location_id),
+        'replay completo': time_query(cursor, REPLAY_QUERY, params, args.queries, location_id),
+    }
+
+    print(f"\n{'método':<20}{'media ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, timings in results.items():
+        print(f'{name:<20}{statistics.mean(timings):>10.2f}{percentile(timings, 50):>10.2f}'
+              f'{percentile(timings, 95):>10.2f}{percentile(timings, 99):>10.2f}')
+
+    cursor.close()
+    conn.close()
+
+if __name__ == '__main__':
+    main()
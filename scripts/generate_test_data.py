@@ -0,0 +1,284 @@
+"""
+Generador de datos sintéticos para benchmarks y pruebas de carga.
+
+Parte de scripts/create_test_data.json (categorías, productos, insumos y
+descuentos de ejemplo) y lo amplía a N productos con recetas, M insumos y
+años de ventas con su historial de inventario. Todo se inserta con sentencias
+set-based, por lo que generar millones de filas toma segundos.
+
+Escribe datos: usar SOLO con una base de datos descartable.
+
+Uso:
+    python scripts/generate_test_data.py --dsn postgresql://localhost/illima_bench --products 200 --years 2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from partitions import PARTITIONED_TABLES, ensure_partitions, month_start
+from recipes import rebuild_product_bom
+
+BASE_DATA_PATH = os.path.join(os.path.dirname(__file__), 'create_test_data.json')
+
+# Usuarios creados por el generador (usuario, contraseña, rol)
+BENCHMARK_USERS = [
+    ('admin', 'admin123', 'administrador'),
+    ('vendedor', 'vendedor123', 'vendedor'),
+]
+
+# Stock inicial de cada insumo sintético, suficiente para años de ventas
+INITIAL_STOCK = 1000000
+
+def load_base_data(cursor, path=BASE_DATA_PATH):
+    """Insertar los datos de ejemplo de create_test_data.json"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    for category in data['categories']:
+        cursor.execute('''
+            INSERT INTO categories (name, description) VALUES (%s, %s)
+            ON CONFLICT (name) DO NOTHING
+        ''', (category['name'], category['description']))
+
+    for discount in data['discounts']:
+        cursor.execute('''
+            INSERT INTO discounts (name, description, discount_type, discount_value)
+            SELECT %s, %s, %s, %s
+            WHERE NOT EXISTS (SELECT 1 FROM discounts WHERE name = %s)
+        ''', (discount['name'], discount['description'], discount['discount_type'],
+              discount['discount_value'], discount['name']))
+
+    for username, password, role in BENCHMARK_USERS:
+        cursor.execute('''
+            INSERT INTO users (username, password, role) VALUES (%s, %s, %s)
+            ON CONFLICT (username) DO NOTHING
+        ''', (username, generate_password_hash(password), role))
+
+    return data
+
+def generate_catalog(cursor, data, products, supplies, supplies_per_product):
+    """Crear insumos y productos sintéticos (variantes de los de ejemplo) con sus recetas"""
+    cursor.execute('''
+        INSERT INTO supplies (name, category_id, unit, min_stock, unit_cost, cost_updated_at)
+        SELECT base.name || ' #' || g, c.id, base.unit, base.min_stock,
+               ROUND((0.05 + random() * 2)::numeric, 4), NOW()
+        FROM generate_series(1, %(supplies)s) g
+        JOIN LATERAL (
+            SELECT * FROM json_to_recordset(%(base)s::json)
+                AS b(name text, category text, unit text, min_stock numeric)
+            OFFSET (g - 1) %% json_array_length(%(base)s::json) LIMIT 1
+        ) base ON true
+        JOIN categories c ON c.name = base.category
+        RETURNING id
+    ''', {'supplies': supplies, 'base': json.dumps(data['supplies'])})
+    supply_ids = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute('''
+        INSERT INTO products (name, category_id, description, price)
+        SELECT base.name || ' #' || g, c.id, base.description,
+               ROUND((base.price * (0.8 + random() * 0.4))::numeric, 2)
+        FROM generate_series(1, %(products)s) g
+        JOIN LATERAL (
+            SELECT * FROM json_to_recordset(%(base)s::json)
+                AS b(name text, category text, description text, price numeric)
+            OFFSET (g - 1) %% json_array_length(%(base)s::json) LIMIT 1
+        ) base ON true
+        JOIN categories c ON c.name = base.category
+        RETURNING id
+    ''', {'products': products, 'base': json.dumps(data['products'])})
+    product_ids = [row[0] for row in cursor.fetchall()]
+
+    # Lista de precios: el precio inicial rige desde antes de las ventas generadas
+    cursor.execute('''
+        INSERT INTO product_prices (product_id, price, effective_from, notes)
+        SELECT id, price, '2000-01-01', 'Precio inicial'
+        FROM products
+        WHERE id = ANY(%s)
+    ''', (product_ids,))
+
+    # Receta: insumos consecutivos (en orden circular) a partir de uno por producto
+    cursor.execute('''
+        INSERT INTO product_supplies (product_id, supply_id, quantity)
+        SELECT p.product_id,
+               (%(supply_ids)s::integer[])[1 + ((p.n * 7 + k) %% %(supply_count)s)],
+               ROUND((0.05 + random() * 0.5)::numeric, 2)
+        FROM unnest(%(product_ids)s::integer[]) WITH ORDINALITY AS p(product_id, n)
+        CROSS JOIN generate_series(0, %(per_product)s - 1) k
+    ''', {'supply_ids': supply_ids, 'supply_count': len(supply_ids),
+          'product_ids': product_ids, 'per_product': min(supplies_per_product, len(supply_ids))})
+    rebuild_product_bom(cursor, product_ids)
+
+    return product_ids, supply_ids
+
+def generate_locations(cursor, locations):
+    """Locales de prueba además del principal; devuelve los ids de todos"""
+    cursor.execute('''
+        INSERT INTO locations (name)
+        SELECT 'Local ' || g FROM generate_series(2, %s) g
+        ON CONFLICT (name) DO NOTHING
+    ''', (locations,))
+    cursor.execute('SELECT id FROM locations ORDER BY id LIMIT %s', (locations,))
+    return [row[0] for row in cursor.fetchall()]
+
+def generate_sales(cursor, product_ids, supply_ids, location_ids, years, sales_per_day):
+    """Ventas repartidas en los últimos N años y entre los locales, con su historial de inventario"""
+    start = date.today() - timedelta(days=int(years * 365))
+
+    # Particiones para todo el rango, así las filas no caen en la default
+    for table in PARTITIONED_TABLES:
+        ensure_partitions(cursor, table, month_start(start))
+
+    cursor.execute('SELECT id FROM users WHERE role = %s LIMIT 1', ('vendedor',))
+    user_id = cursor.fetchone()[0]
+
+    # Stock inicial de cada local como primer movimiento del libro
+    cursor.execute('''
+        INSERT INTO inventory_history (location_id, supply_id, quantity_change, type, description, created_at)
+        SELECT location_id, supply_id, %s, 'restock', 'Stock inicial (datos de prueba)', %s
+        FROM unnest(%s::integer[]) AS location_id
+        CROSS JOIN unnest(%s::integer[]) AS supply_id
+    ''', (INITIAL_STOCK, start, location_ids, supply_ids))
+
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sales')
+    last_sale_id = cursor.fetchone()[0]
+
+    total = int(years * 365 * sales_per_day)
+    cursor.execute('''
+        INSERT INTO sales (user_id, location_id, product_id, quantity, sale_date, unit_price, total_amount,
+                           discount_amount, discount_info)
+        SELECT %(user_id)s, q.location_id, p.id, q.quantity, q.sale_date, p.price, p.price * q.quantity, 0,
+               '{''type'': ''ninguno'', ''value'': 0}'
+        FROM (
+            SELECT (%(location_ids)s::integer[])[1 + floor(random() * %(location_count)s)::integer] AS location_id,
+                   (%(product_ids)s::integer[])[1 + floor(random() * %(product_count)s)::integer] AS product_id,
+                   1 + floor(random() * 3)::integer AS quantity,
+                   %(start)s::timestamp + random() * (NOW() - %(start)s::timestamp) AS sale_date
+            FROM generate_series(1, %(total)s)
+        ) q
+        JOIN products p ON p.id = q.product_id
+    ''', {'user_id': user_id, 'location_ids': location_ids, 'location_count': len(location_ids),
+          'product_ids': product_ids, 'product_count': len(product_ids), 'start': start, 'total': total})
+
+    cursor.execute('''
+        INSERT INTO inventory_history (location_id, supply_id, quantity_change, type, description, user_id, created_at)
+        SELECT s.location_id, pb.supply_id, -(pb.quantity * s.quantity), 'venta', 'Venta ID ' || s.id, s.user_id, s.sale_date
+        FROM sales s
+        JOIN product_bom pb ON pb.product_id = s.product_id
+        WHERE s.sale_date >= %s AND s.id > %s
+    ''', (start, last_sale_id))
+
+    # El stock de cada local queda igual a la suma de su historial (libro conciliado)
+    cursor.execute('''
+        INSERT INTO location_stock (location_id, supply_id, stock, min_stock)
+        SELECT h.location_id, h.supply_id, SUM(h.quantity_change), MAX(s.min_stock)
+        FROM inventory_history h
+        JOIN supplies s ON s.id = h.supply_id
+        WHERE h.supply_id = ANY(%s)
+        GROUP BY h.location_id, h.supply_id
+        ON CONFLICT (location_id, supply_id) DO UPDATE SET stock = EXCLUDED.stock
+    ''', (supply_ids,))
+
+    return total
+
+def generate_lots(cursor, lots_per_supply):
+    """Lotes abiertos por local e insumo con vencimientos en los próximos meses; entre todos
+    cubren la mitad del stock, así la venta siempre descuenta de lotes"""
+    cursor.execute('''
+        INSERT INTO supply_lots (location_id, supply_id, initial_quantity, quantity, received_at, expires_at, notes)
+        SELECT ls.location_id, ls.supply_id, q.quantity, q.quantity,
+               NOW() - random() * INTERVAL '30 days', CURRENT_DATE + floor(random() * 180)::integer,
+               'Lote de prueba'
+        FROM location_stock ls
+        CROSS JOIN LATERAL (SELECT floor(ls.stock / (2 * %(lots)s)) AS quantity) q
+        CROSS JOIN generate_series(1, %(lots)s)
+        WHERE q.quantity > 0
+    ''', {'lots': lots_per_supply})
+    return cursor.rowcount
+
+def generate(conn, products=200, supplies=80, supplies_per_product=3, years=2, sales_per_day=300,
+             snapshots=True, seed=0.42, locations=1, lots_per_supply=0):
+    """Generar el conjunto de datos completo y devolver los conteos"""
+    from app import take_inventory_snapshots
+    from costing import recompute_product_costs
+
+    cursor = conn.cursor()
+
+    # Semilla del random() de Postgres: el mismo seed genera los mismos datos
+    cursor.execute('SELECT setseed(%s)', (seed,))
+    data = load_base_data(cursor)
+    product_ids, supply_ids = generate_catalog(cursor, data, products, supplies, supplies_per_product)
+    location_ids = generate_locations(cursor, locations)
+    sales = generate_sales(cursor, product_ids, supply_ids, location_ids, years, sales_per_day)
+    lots = generate_lots(cursor, lots_per_supply) if lots_per_supply > 0 else 0
+    conn.commit()
+
+    dict_cursor = conn.cursor(cursor_factory=RealDictCursor)
+    recompute_product_costs(dict_cursor)
+    conn.commit()
+
+    if snapshots:
+        take_inventory_snapshots(dict_cursor)
+        conn.commit()
+    dict_cursor.close()
+
+    for table in ('products', 'product_supplies', 'product_bom', 'supplies', 'location_stock', 'sales',
+                  'inventory_history', 'inventory_snapshots', 'supply_lots'):
+        cursor.execute(f'ANALYZE {table}')
+    conn.commit()
+
+    cursor.execute('SELECT COUNT(*) FROM inventory_history')
+    history = cursor.fetchone()[0]
+    cursor.close()
+
+    return {
+        'products': len(product_ids),
+        'supplies': len(supply_ids),
+        'supplies_per_product': supplies_per_product,
+        'locations': len(location_ids),
+        'years': years,
+        'sales': sales,
+        'inventory_history': history,
+        'supply_lots': lots,
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--supplies', type=int, default=80)
+    parser.add_argument('--supplies-per-product', type=int, default=3)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--sales-per-day', type=int, default=300)
+    parser.add_argument('--locations', type=int, default=1, help='Locales entre los que se reparten las ventas')
+    parser.add_argument('--lots-per-supply', type=int, default=0,
+                        help='Lotes abiertos por insumo y local (para medir la venta con FEFO)')
+    parser.add_argument('--seed', type=float, default=0.42, help='Semilla entre -1 y 1')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True, help='Base de datos descartable (ya inicializada o vacía)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.dsn
+    from init_db import init_database
+    init_database()
+
+    conn = psycopg2.connect(args.dsn)
+    start = time.perf_counter()
+    counts = generate(conn, args.products, args.supplies, args.supplies_per_product, args.years,
+                      args.sales_per_day, seed=args.seed, locations=args.locations,
+                      lots_per_supply=args.lots_per_supply)
+    conn.close()
+
+    print(f'Datos generados en {time.perf_counter() - start:.1f}s: {counts}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env bash
+# Réplica de streaming local para probar REPLICA_DATABASE_URL (dos instancias
+# de Postgres en la misma máquina).
+#
+# Copia el primario con pg_basebackup (-R deja configurado primary_conninfo y
+# standby.signal) y arranca la copia en otro puerto. El primario necesita
+# wal_level=replica (el valor por defecto) y una línea "replication" en
+# pg_hba.conf para el usuario de PRIMARY_DSN.
+#
+# Uso:
+#     scripts/local_replica.sh start    # crea la réplica (si no existe) y la arranca
+#     scripts/local_replica.sh stop
+#     scripts/local_replica.sh pause    # detiene la aplicación de WAL para simular atraso
+#     scripts/local_replica.sh resume
+#
+# Variables: PRIMARY_DSN (postgresql://postgres@localhost:5432/postgres),
+# REPLICA_DIR (/tmp/illima-replica), REPLICA_PORT (5433), PG_BIN (carpeta de pg_ctl).
+set -euo pipefail
+
+PRIMARY_DSN=${PRIMARY_DSN:-postgresql://postgres@localhost:5432/postgres}
+REPLICA_DIR=${REPLICA_DIR:-/tmp/illima-replica}
+REPLICA_PORT=${REPLICA_PORT:-5433}
+PG_BIN=${PG_BIN:-$(dirname "$(command -v pg_ctl)")}
+REPLICA_ADMIN_DSN="postgresql://postgres@localhost:${REPLICA_PORT}/postgres"
+
+case "${1:-start}" in
+    start)
+        if [ ! -f "$REPLICA_DIR/standby.signal" ]; then
+            rm -rf "$REPLICA_DIR"
+            "$PG_BIN/pg_basebackup" -d "$PRIMARY_DSN" -D "$REPLICA_DIR" -R -X stream -c fast
+            chmod 700 "$REPLICA_DIR"
+        fi
+        "$PG_BIN/pg_ctl" -D "$REPLICA_DIR" -l "$REPLICA_DIR/replica.log" -w \
+            -o "-p $REPLICA_PORT -k $REPLICA_DIR -c listen_addresses=localhost" start
+        echo "Réplica en el puerto $REPLICA_PORT"
+        echo "REPLICA_DATABASE_URL=postgresql://postgres@localhost:${REPLICA_PORT}/illima_db"
+        ;;
+    stop)
+        "$PG_BIN/pg_ctl" -D "$REPLICA_DIR" -m fast stop
+        ;;
+    pause)
+        "$PG_BIN/psql" "$REPLICA_ADMIN_DSN" -c 'SELECT pg_wal_replay_pause()'
+        ;;
+    resume)
+        "$PG_BIN/psql" "$REPLICA_ADMIN_DSN" -c 'SELECT pg_wal_replay_resume()'
+        ;;
+    *)
+        echo "Uso: $0 start|stop|pause|resume" >&2
+        exit 1
+        ;;
+esac
@@ -0,0 +1,313 @@
+"""
+Prueba de estrés de concurrencia sobre el stock de insumos.
+
+Muchos clientes en paralelo registran ventas (/api/sale), ventas con
+descartables (/api/sale-with-discount con supplies_used) y reposiciones
+(/api/admin/supply/<id>, con un delta o leyendo el stock y su versión y
+guardando stock + cantidad, como lo hace la interfaz) sobre pocos insumos
+compartidos. Con --locations N los clientes se reparten entre N locales, cada
+uno con su propio stock. Al terminar se verifican tres invariantes por local e
+insumo:
+
+  1. Libro: stock final = stock inicial + suma de movimientos de inventory_history.
+  2. Ningún insumo con stock negativo.
+  3. Sin actualizaciones perdidas: stock final = stock inicial - lo descontado por
+     las ventas confirmadas + lo repuesto por las reposiciones confirmadas.
+
+También informa el throughput y cuántas operaciones fallaron por deadlock
+(40P01) o por error de serialización (40001). Termina con código 1 si alguna
+invariante no se cumple.
+
+Uso:
+    python scripts/stress_test.py --server-dsn postgresql://postgres@localhost/postgres --clients 16 --duration 20
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from benchmark import create_database, drop_database, login
+import generate_test_data
+
+# Mezcla de operaciones: (peso, operación)
+OPERATION_MIX = [
+    (50, 'sale'),
+    (30, 'sale_disposables'),
+    (20, 'restock'),
+]
+
+def classify_error(response):
+    """Clasificar una respuesta fallida por el mensaje de error de Postgres"""
+    if response.status_code == 400:
+        return 'stock_insuficiente'
+    if response.status_code == 409:
+        return 'conflicto'
+    message = ((response.get_json(silent=True) or {}).get('error') or '').lower()
+    if 'deadlock' in message:
+        return 'deadlock'
+    if 'could not serialize' in message:
+        return 'serializacion'
+    return 'otro_error'
+
+def prepare_data(conn, products, supplies, supplies_per_product, initial_stock, locations=1):
+    """Catálogo chico (mucha contención) con el mismo stock inicial en cada insumo de cada local"""
+    cursor = conn.cursor()
+    data = generate_test_data.load_base_data(cursor)
+    product_ids, supply_ids = generate_test_data.generate_catalog(cursor, data, products, supplies, supplies_per_product)
+    location_ids = generate_test_data.generate_locations(cursor, locations)
+
+    cursor.execute('''
+        INSERT INTO inventory_history (location_id, supply_id, quantity_change, type, description)
+        SELECT location_id, supply_id, %s, 'restock', 'Stock inicial (prueba de estrés)'
+        FROM unnest(%s::integer[]) AS location_id
+        CROSS JOIN unnest(%s::integer[]) AS supply_id
+    ''', (initial_stock, location_ids, supply_ids))
+    cursor.execute('''
+        INSERT INTO location_stock (location_id, supply_id, stock)
+        SELECT location_id, supply_id, %s
+        FROM unnest(%s::integer[]) AS location_id
+        CROSS JOIN unnest(%s::integer[]) AS supply_id
+        ON CONFLICT (location_id, supply_id) DO UPDATE SET stock = EXCLUDED.stock
+    ''', (initial_stock, location_ids, supply_ids))
+
+    cursor.execute('''
+        SELECT product_id, supply_id, quantity FROM product_bom
+        WHERE product_id = ANY(%s)
+    ''', (product_ids,))
+    recipes = defaultdict(list)
+    for product_id, supply_id, quantity in cursor.fetchall():
+        recipes[product_id].append((supply_id, quantity))
+
+    conn.commit()
+    cursor.close()
+    return product_ids, supply_ids, location_ids, recipes
+
+class StressRun:
+    """Estado compartido entre los clientes: lo confirmado por cada operación exitosa"""
+
+    def __init__(self, app, product_ids, supply_ids, location_ids, recipes, restock_amount):
+        self.app = app
+        self.product_ids = product_ids
+        self.supply_ids = supply_ids
+        self.location_ids = location_ids
+        self.recipes = recipes
+        self.restock_amount = Decimal(restock_amount)
+        self.lock = threading.Lock()
+        self.expected_change = defaultdict(Decimal)
+        self.outcomes = Counter()
+        self.error_samples = {}
+        self.sale_ids = []
+
+    def _confirm(self, operation, location_id, changes, sale_id=None):
+        with self.lock:
+            self.outcomes[(operation, 'ok')] += 1
+            for supply_id, change in changes:
+                self.expected_change[(location_id, supply_id)] += change
+            if sale_id:
+                self.sale_ids.append(sale_id)
+
+    def _fail(self, operation, response):
+        outcome = classify_error(response)
+        with self.lock:
+            self.outcomes[(operation, outcome)] += 1
+            if outcome == 'otro_error':
+                self.error_samples.setdefault(operation, response.get_data(as_text=True)[:200])
+
+    def sale(self, client, rng, location_id, disposables):
+        product_id = rng.choice(self.product_ids)
+        quantity = rng.randint(1, 3)
+        changes = [(supply_id, -qty * quantity) for supply_id, qty in self.recipes[product_id]]
+
+        if disposables:
+            supplies_used = [{'supply_id': supply_id, 'quantity': 1} for supply_id in rng.sample(self.supply_ids, 2)]
+            changes += [(used['supply_id'], Decimal(-1)) for used in supplies_used]
+            response = client.post('/api/sale-with-discount', json={
+                'product_id': product_id, 'quantity': quantity, 'supplies_used': supplies_used,
+                'location_id': location_id
+            })
+        else:
+            response = client.post('/api/sale', json={
+                'product_id': product_id, 'quantity': quantity, 'location_id': location_id
+            })
+
+        operation = 'sale_disposables' if disposables else 'sale'
+        if response.status_code == 200:
+            self._confirm(operation, location_id, changes, response.get_json()['sale_id'])
+        else:
+            self._fail(operation, response)
+
+    def restock(self, client, rng, location_id):
+        """Reponer con un delta, o como el formulario: leer stock y versión y guardar
+        stock + cantidad con expected_version (si otra operación cambió el stock, 409)"""
+        supply_id = rng.choice(self.supply_ids)
+        payload = {'notes': 'Reposición (prueba de estrés)', 'location_id': location_id}
+        if rng.random() < 0.5:
+            payload['delta'] = float(self.restock_amount)
+        else:
+            supplies = client.get(f'/api/supplies?location_id={location_id}').get_json()
+            current = next(s for s in supplies if s['id'] == supply_id)
+            payload['stock'] = float(Decimal(str(current['stock'])) + self.restock_amount)
+            payload['expected_version'] = current['version']
+
+        response = client.put(f'/api/admin/supply/{supply_id}', json=payload)
+        if response.status_code == 200 and response.get_json().get('success'):
+            self._confirm('restock', location_id, [(supply_id, self.restock_amount)])
+        else:
+            self._fail('restock', response)
+
+    def client_loop(self, seed, location_id, deadline):
+        rng = random.Random(seed)
+        client = login(self.app)
+        operations = [op for _, op in OPERATION_MIX]
+        weights = [weight for weight, _ in OPERATION_MIX]
+
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            if operation == 'restock':
+                self.restock(client, rng, location_id)
+            else:
+                self.sale(client, rng, location_id, disposables=operation == 'sale_disposables')
+
+def check_invariants(cursor, supply_ids, location_ids, initial_stock, history_start_id, expected_change, sale_ids):
+    """Verificar libro, stock no negativo y actualizaciones perdidas por local; devuelve las violaciones"""
+    cursor.execute('''
+        SELECT ls.location_id, s.id, s.name, ls.stock,
+               COALESCE((SELECT SUM(h.quantity_change) FROM inventory_history h
+                         WHERE h.location_id = ls.location_id AND h.supply_id = s.id
+                           AND h.id > %s), 0) AS history_change
+        FROM location_stock ls
+        JOIN supplies s ON s.id = ls.supply_id
+        WHERE s.id = ANY(%s) AND ls.location_id = ANY(%s)
+        ORDER BY ls.location_id, s.id
+    ''', (history_start_id, supply_ids, location_ids))
+
+    violations = defaultdict(list)
+    for row in cursor.fetchall():
+        ledger_stock = initial_stock + row['history_change']
+        expected_stock = initial_stock + expected_change.get((row['location_id'], row['id']), 0)
+        label = f"local {row['location_id']} / {row['name']}"
+
+        if row['stock'] != ledger_stock:
+            violations['libro'].append(f"{label}: stock {row['stock']}, historial {ledger_stock}")
+        if row['stock'] < 0:
+            violations['stock_negativo'].append(f"{label}: {row['stock']}")
+        if row['stock'] != expected_stock:
+            violations['actualizaciones_perdidas'].append(
+                f"{label}: stock {row['stock']}, esperado {expected_stock}")
+
+    # Toda venta confirmada al cliente debe existir
+    cursor.execute('SELECT COUNT(*) AS found FROM sales WHERE id = ANY(%s)', (sale_ids,))
+    missing = len(sale_ids) - cursor.fetchone()['found']
+    if missing:
+        violations['actualizaciones_perdidas'].append(f'{missing} ventas confirmadas que no existen')
+
+    return violations
+
+def deadlock_count(cursor):
+    cursor.execute('SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()')
+    return cursor.fetchone()['deadlocks']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server-dsn', required=True, help='Conexión a una base existente del servidor (ej. postgres)')
+    parser.add_argument('--database', default='illima_stress_bench', help='Base descartable a crear')
+    parser.add_argument('--keep', action='store_true', help='No borrar la base al terminar')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--products', type=int, default=12)
+    parser.add_argument('--supplies', type=int, default=4, help='Pocos insumos = más contención')
+    parser.add_argument('--supplies-per-product', type=int, default=2)
+    parser.add_argument('--locations', type=int, default=1, help='Locales entre los que se reparten los clientes')
+    parser.add_argument('--initial-stock', type=Decimal, default=Decimal('100'))
+    parser.add_argument('--restock-amount', type=Decimal, default=Decimal('25'))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    dsn = create_database(args.server_dsn, args.database)
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('SLOW_QUERY_MS', '-1')
+
+    try:
+        from init_db import init_database
+        init_database()
+
+        from app import app
+        app.config['TESTING'] = True
+
+        conn = psycopg2.connect(dsn)
+        product_ids, supply_ids, location_ids, recipes = prepare_data(
+            conn, args.products, args.supplies, args.supplies_per_product, args.initial_stock, args.locations)
+
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute('''
+            SELECT COALESCE(MAX(id), 0) AS last_id FROM inventory_history
+            WHERE description = 'Stock inicial (prueba de estrés)'
+        ''')
+        history_start_id = cursor.fetchone()['last_id']
+        deadlocks_before = deadlock_count(cursor)
+        conn.commit()
+
+        run = StressRun(app, product_ids, supply_ids, location_ids, recipes, args.restock_amount)
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=run.client_loop,
+                                    args=(args.seed + i, location_ids[i % len(location_ids)], deadline))
+                   for i in range(args.clients)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Pasar al historial lo que quedó en inventory_outbox, como lo hace el worker
+        from app import flush_inventory_outbox
+        while flush_inventory_outbox(cursor):
+            pass
+        conn.commit()
+
+        deadlocks = deadlock_count(cursor) - deadlocks_before
+        violations = check_invariants(cursor, supply_ids, location_ids, args.initial_stock, history_start_id,
+                                      run.expected_change, run.sale_ids)
+        conn.commit()
+        cursor.close()
+        conn.close()
+    finally:
+        if not args.keep:
+            drop_database(args.server_dsn, args.database)
+
+    total = sum(run.outcomes.values())
+    print(f'\n{args.clients} clientes en {len(location_ids)} locales, {elapsed:.1f}s: {total} operaciones, {total / elapsed:.1f} ops/s')
+    print(f"{'operación':<20}{'resultado':<22}{'cantidad':>10}")
+    for (operation, outcome), count in sorted(run.outcomes.items()):
+        print(f'{operation:<20}{outcome:<22}{count:>10}')
+
+    for operation, sample in run.error_samples.items():
+        print(f'Ejemplo de otro_error en {operation}: {sample}')
+
+    failures = Counter()
+    for (_, outcome), count in run.outcomes.items():
+        failures[outcome] += count
+    print(f"\nDeadlocks (pg_stat_database): {deadlocks}; errores de serialización: {failures['serializacion']}")
+
+    print('\nInvariantes:')
+    for name in ('libro', 'stock_negativo', 'actualizaciones_perdidas'):
+        problems = violations.get(name, [])
+        print(f"  {name:<26}{'OK' if not problems else f'FALLA ({len(problems)})'}")
+        for problem in problems[:10]:
+            print(f'      {problem}')
+
+    sys.exit(1 if violations else 0)
+
+if __name__ == '__main__':
+    main()
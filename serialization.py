@@ -0,0 +1,131 @@
+"""
+Serialización JSON rápida y compresión de las respuestas.
+
+FastJSONProvider reemplaza al proveedor JSON de Flask por orjson, que
+serializa en C los dict (incluidas las filas RealDictRow), listas, números,
+fechas y arreglos de numpy. Política de tipos:
+- Decimal sale como texto ("12.50"), igual que con el proveedor de Flask: no
+  se pierde precisión y los clientes existentes no cambian.
+- Fechas según JSON_DATETIME_FORMAT: "http" (por defecto, el formato de
+  siempre: "Mon, 19 Oct 2026 02:34:07 GMT") o "iso" ("2026-10-19T02:34:07"),
+  que orjson escribe sin pasar por Python y es bastante más rápido en listados
+  grandes.
+- Las claves no se ordenan: salen en el orden de las columnas del SELECT.
+
+init_compression comprime con brotli o gzip (según Accept-Encoding) las
+respuestas de texto y JSON de al menos COMPRESS_MIN_SIZE bytes. No toca los
+archivos enviados con send_file (Excel, reportes) ni respuestas ya
+comprimidas.
+"""
+import gzip
+import os
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+
+import brotli
+import orjson
+from flask.json.provider import JSONProvider
+
+JSON_DATETIME_FORMAT = os.getenv('JSON_DATETIME_FORMAT', 'http')
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+# Calidad 4-5 comprime casi como gzip 9 a una fracción del costo; 11 es para archivos estáticos
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '4'))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'image/svg+xml')
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def http_datetime(value):
+    """Mismo texto que werkzeug.http.http_date (lo que usa Flask), sin pasar por email.utils"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        hour, minute, second = value.hour, value.minute, value.second
+    else:
+        hour = minute = second = 0
+    return (f'{_DAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} '
+            f'{hour:02d}:{minute:02d}:{second:02d} GMT')
+
+def _default(value):
+    """Tipos que orjson no serializa solo (o que se le pasan para formatearlos)"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return http_datetime(value)
+    if isinstance(value, time):
+        return value.isoformat()
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def json_options(datetime_format=JSON_DATETIME_FORMAT):
+    """Opciones de orjson; las claves no texto (ids enteros) se aceptan como en el json de Python"""
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if datetime_format == 'http':
+        options |= orjson.OPT_PASSTHROUGH_DATETIME
+    return options
+
+def dumps_bytes(obj, datetime_format=JSON_DATETIME_FORMAT):
+    """JSON en bytes, con la política de tipos de la aplicación"""
+    return orjson.dumps(obj, default=_default, option=json_options(datetime_format))
+
+class FastJSONProvider(JSONProvider):
+    """Proveedor JSON de Flask basado en orjson"""
+
+    def __init__(self, app, datetime_format=JSON_DATETIME_FORMAT):
+        super().__init__(app)
+        self.options = json_options(datetime_format)
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=self.options), mimetype='application/json')
+
+def choose_encoding(accept_encodings):
+    """Mejor codificación aceptada por el cliente entre br y gzip (None si ninguna)"""
+    return accept_encodings.best_match(['br', 'gzip'])
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+def _compressible(response):
+    mimetype = response.mimetype or ''
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+def init_compression(app):
+    """Comprimir las respuestas según Accept-Encoding"""
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers or not _compressible(response)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # El cuerpo ya no es byte a byte el mismo: un ETag fuerte pasa a débil
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
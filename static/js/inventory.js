@@ -1,10 +1,12 @@
 let currentSupplyId = null
+let currentVersion = null
 const showModal = null
 const closeModal = null
 const fetchAPI = null
 
-function editSupply(supplyId) {
+function editSupply(supplyId, version) {
   currentSupplyId = supplyId
+  currentVersion = version
   showModal("supplyModal")
 }
 
@@ -21,6 +23,7 @@ async function saveSupply() {
       method: "PUT",
       body: JSON.stringify({
         stock: newStock,
+        expected_version: currentVersion,
         notes: notes,
       }),
     })
@@ -31,6 +34,12 @@ async function saveSupply() {
       location.reload()
     }
   } catch (error) {
+    // 409: alguien vendió o ajustó este insumo mientras se editaba
+    if (error.status === 409) {
+      alert("El stock cambió mientras lo editabas. Se recargará con el valor actual.")
+      location.reload()
+      return
+    }
     alert("Error al actualizar: " + error.message)
   }
 }
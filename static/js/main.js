@@ -26,7 +26,9 @@ async function fetchAPI(url, options = {}) {
     })
 
     if (!response.ok) {
-      throw new Error(`Error: ${response.statusText}`)
+      const error = new Error(`Error: ${response.statusText}`)
+      error.status = response.status
+      throw error
     }
 
     return await response.json()
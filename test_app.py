@@ -17,6 +17,46 @@ def auth_headers():
     # This would be populated with test user credentials
     return {'Authorization': 'Bearer test-token'}
 
+class FakeCursor:
+    """In-memory cursor (and connection): each execute returns the next prepared result, the last one repeats"""
+    
+    def __init__(self, *results):
+        self.results = list(results) or [[]]
+        self.rows = []
+        self.statements = []
+        self.params = []
+        self.rowcount = 0
+        self.closed = False
+    
+    def execute(self, query, vars=None):
+        self.statements.append(query)
+        self.params.append(vars)
+        self.rows = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        self.rowcount = len(self.rows)
+    
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+    
+    def fetchall(self):
+        return self.rows
+    
+    def commit(self):
+        self.statements.append('COMMIT')
+    
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+    
+    def cursor(self, cursor_factory=None):
+        return self
+    
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def fake_cursor():
+    """Build fake cursors from the results of each statement"""
+    return FakeCursor
+
 class TestAuthentication:
     """Test authentication endpoints"""
     
@@ -88,6 +128,29 @@ class TestReports:
         response = client.get('/api/admin/sales-report')
         assert response.status_code in [200, 302]
     
+    def test_sales_report_totals_with_null_discount(self, client, monkeypatch, fake_cursor):
+        """Test totals come from the SQL aggregate (NULL discounts count as zero) and not from the listed rows"""
+        from datetime import date, datetime
+        from decimal import Decimal
+        sale = {'id': 9, 'sale_date': datetime(2026, 10, 1, 10), 'product_name': 'Cafe', 'quantity': 1,
+                'unit_price': Decimal('5.00'), 'total_amount': Decimal('5.00'), 'discount_amount': None,
+                'discount_info': None, 'refunded_quantity': 0, 'refunded_amount': Decimal('0'), 'seller': 'cajero1'}
+        totals = {'total_sales': Decimal('5.00'), 'total_discounts': Decimal('0'), 'total_refunds': Decimal('0'),
+                  'sales_count': 1}
+        cursor = fake_cursor([{'role': 'administrador'}], [sale], [], [totals])
+        monkeypatch.setattr('app.get_db', lambda role='primary': cursor)
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+            session['location_id'] = 1
+        response = client.get('/api/admin/sales-report?start_date=2026-10-01&end_date=2026-10-02')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['sales'][0]['discount_amount'] is None
+        assert data['totals'] == {'total_sales': '5.00', 'total_discounts': '0', 'total_refunds': '0',
+                                  'sales_count': 1}
+        assert 'COALESCE(s.discount_amount, 0)' in cursor.statements[-1]
+        assert cursor.params[-1] == [1, [], 1, date(2026, 10, 1), date(2026, 10, 3)]
+    
     def test_get_sales_by_product(self, client):
         """Test sales by product report"""
         response = client.get('/api/sales-by-product')
@@ -98,6 +161,700 @@ class TestReports:
         response = client.get('/api/sales-by-date')
         assert response.status_code in [200, 302]
 
+class TestReportJobs:
+    """Test background report job endpoints"""
+    
+    def test_submit_report_job(self, client):
+        """Test submitting a report job"""
+        response = client.post('/api/report-jobs', json={'report_type': 'reporte_completo'})
+        assert response.status_code in [202, 200, 302]
+    
+    def test_get_report_job(self, client):
+        """Test polling a report job"""
+        response = client.get('/api/report-jobs/1')
+        assert response.status_code in [200, 404, 302]
+    
+    def test_download_report_job(self, client):
+        """Test downloading a report artifact"""
+        response = client.get('/api/report-jobs/1/download')
+        assert response.status_code in [200, 404, 409, 410, 302]
+    
+    def test_worker_survives_failing_task(self, monkeypatch, fake_cursor):
+        """Test a periodic task that raises is rolled back and the worker still claims jobs"""
+        import worker
+        def fail(conn):
+            raise RuntimeError('could not obtain lock on relation "sales"')
+        jobs = iter([{'id': 4, 'report_type': 'reporte_completo'}, None])
+        ran = []
+        conn = fake_cursor()
+        monkeypatch.setattr(worker, 'PERIODIC_TASKS', [(0, fail)])
+        monkeypatch.setattr(worker, 'get_db', lambda: conn)
+        monkeypatch.setattr(worker, 'claim_job', lambda conn: next(jobs))
+        monkeypatch.setattr(worker, 'run_job', lambda conn, job: ran.append(job['id']))
+        worker.main(once=True)
+        assert ran == [4]
+        assert conn.statements == ['ROLLBACK', 'ROLLBACK'] and conn.closed
+    
+    def job(self, **fields):
+        return dict({'id': 4, 'status': 'done', 'report_type': 'reporte_completo', 'job_location_id': '1',
+                     'is_admin': False, 'requested': True}, **fields)
+    
+    def test_job_visible_to_requesters_only(self, fake_cursor):
+        """Test a job is hidden from other users and other locations, and admin-only types need an administrator"""
+        from flask import session
+        from app import fetch_report_job
+        with app.test_request_context('/api/report-jobs/4'):
+            session['user_id'] = 2
+            session['location_id'] = 1
+            cursor = fake_cursor([self.job()])
+            job, error = fetch_report_job(cursor, 4, 'j.id, j.status')
+            assert job['id'] == 4 and error is None
+            assert cursor.params == [(2, 4)]
+            assert fetch_report_job(fake_cursor([self.job(requested=False)]), 4, 'j.id')[1] == \
+                ('Trabajo no encontrado', 404)
+            assert fetch_report_job(fake_cursor([]), 4, 'j.id')[1] == ('Trabajo no encontrado', 404)
+            assert fetch_report_job(fake_cursor([self.job(job_location_id='2')]), 4, 'j.id')[1] == \
+                ('Trabajo no encontrado', 404)
+            assert fetch_report_job(fake_cursor([self.job(report_type='costos')]), 4, 'j.id')[1] == \
+                ('Acceso denegado', 403)
+    
+    def test_admin_sees_every_job(self, fake_cursor):
+        """Test an administrator reads jobs requested by others, at any location and of any type"""
+        from flask import session
+        from app import fetch_report_job
+        with app.test_request_context('/api/report-jobs/4'):
+            session['user_id'] = 1
+            job = self.job(report_type='costos', job_location_id='2', is_admin=True, requested=False)
+            assert fetch_report_job(fake_cursor([job]), 4, 'j.id') == (job, None)
+
+class TestInventoryLedger:
+    """Test point-in-time inventory endpoints"""
+    
+    def test_inventory_as_of(self, client):
+        """Test stock at a past date"""
+        response = client.get('/api/inventory/as-of?at=2024-01-01T00:00')
+        assert response.status_code in [200, 302]
+    
+    def test_inventory_reconcile(self, client):
+        """Test ledger reconciliation"""
+        response = client.get('/api/admin/inventory/reconcile')
+        assert response.status_code in [200, 302]
+
+class TestInventoryOutbox:
+    """Test write-behind inventory history"""
+    
+    def test_movements_go_to_outbox(self, fake_cursor):
+        """Test stock movements are appended to the outbox instead of the partitioned history"""
+        from decimal import Decimal
+        from app import apply_stock_movements
+        cursor = fake_cursor([{'supply_id': 1, 'stock': Decimal('10'), 'name': 'Leche', 'unit': 'l'}])
+        apply_stock_movements(cursor, 1, [(1, -2, 'venta', 'Venta 1')], user_id=1)
+        assert any('INSERT INTO inventory_outbox' in query for query in cursor.statements)
+        assert not any('INSERT INTO inventory_history' in query for query in cursor.statements)
+    
+    def test_worker_flushes_until_empty(self, monkeypatch, fake_cursor):
+        """Test the worker commits one batch per transaction until a partial batch"""
+        import worker
+        batches = iter([worker.INVENTORY_FLUSH_BATCH, 3])
+        monkeypatch.setattr(worker, 'flush_inventory_outbox', lambda cursor: next(batches))
+        conn = fake_cursor()
+        worker.flush_inventory_movements(conn)
+        assert conn.statements == ['COMMIT', 'COMMIT']
+    
+    def test_worker_survives_flush_error(self, monkeypatch, fake_cursor):
+        """Test a failing flush is rolled back and logged instead of stopping the worker"""
+        import worker
+        def fail(cursor):
+            raise RuntimeError('violates foreign key constraint')
+        monkeypatch.setattr(worker, 'flush_inventory_outbox', fail)
+        conn = fake_cursor()
+        worker.flush_inventory_movements(conn)
+        assert conn.statements == ['ROLLBACK']
+
+class TestEventFeed:
+    """Test the change-event outbox and feed"""
+    
+    def test_offset_parsing(self):
+        """Test offsets round-trip and malformed ones are rejected"""
+        from events import format_offset, parse_offset
+        assert parse_offset(format_offset(812, 41)) == (812, 41)
+        assert parse_offset(None) == (0, 0)
+        with pytest.raises(ValueError):
+            parse_offset('41')
+    
+    def test_feed_resumes_from_horizon(self, fake_cursor):
+        """Test an exhausted feed continues from the oldest running transaction"""
+        from events import read_events
+        rows = [{'horizon': '900', 'txid': '850', 'id': 7, 'event_type': 'sale.created',
+                 'aggregate_id': 3, 'location_id': 1, 'payload': {}, 'created_at': None}]
+        page = read_events(fake_cursor(rows), after='800-2', limit=10)
+        assert [event['offset'] for event in page['events']] == ['850-7']
+        assert page['next_offset'] == '900-0' and not page['has_more']
+        empty = read_events(fake_cursor([{'horizon': '900', 'id': None}]), after='950-3')
+        assert empty['next_offset'] == '950-3'
+    
+    def test_feed_requires_auth(self, client):
+        """Test the feed is not public"""
+        response = client.get('/api/admin/events')
+        assert response.status_code in [302, 401]
+
+class TestSaleRefunds:
+    """Test sale voids and partial refunds"""
+    
+    def test_refund_cannot_exceed_remaining_units(self, fake_cursor):
+        """Test refunding more units than are left on the line is rejected before any write"""
+        from datetime import datetime
+        from decimal import Decimal
+        from app import refund_sales
+        cursor = fake_cursor([{'id': 7, 'sale_date': datetime(2026, 10, 19), 'ticket_id': None, 'product_id': 1,
+                                 'location_id': 1, 'quantity': 3, 'refunded_quantity': 2,
+                                 'total_amount': Decimal('15.00'), 'refunded_amount': Decimal('10.00'),
+                                 'requested': True}])
+        with pytest.raises(ValueError):
+            refund_sales(cursor, quantities={7: 2})
+        assert len(cursor.statements) == 1
+    
+    def test_refund_restocks_refunded_units(self, monkeypatch, fake_cursor):
+        """Test a partial refund restocks the recipe of the refunded units only, and disposables wait for the whole ticket"""
+        from datetime import datetime
+        from decimal import Decimal
+        import app as app_module
+        line = {'sale_date': datetime(2026, 10, 19, 9), 'ticket_id': 5, 'location_id': 1, 'refunded_quantity': 0,
+                'refunded_amount': Decimal('0'), 'requested': True}
+        lines = [dict(line, id=7, product_id=1, quantity=3, total_amount=Decimal('15.00')),
+                 dict(line, id=8, product_id=2, quantity=1, total_amount=Decimal('7.00'))]
+        movements = []
+        monkeypatch.setattr(app_module, 'apply_stock_movements',
+                            lambda cursor, location_id, items, user_id=None: movements.append((location_id, items)))
+        monkeypatch.setattr(app_module, 'record_event', lambda *args, **kwargs: None)
+        monkeypatch.setattr(app_module, 'invalidate_reports', lambda *args: 0)
+        
+        # Only line 7 was requested; line 8 is locked because it shares the ticket
+        cursor = fake_cursor([lines[0], dict(lines[1], requested=False)], [{'business_date': None}], [],
+                             [{'location_id': 1, 'supply_id': 1, 'quantity': Decimal('0.036')}])
+        result = app_module.refund_sales(cursor, quantities={7: 2}, user_id=1)
+        assert result == [{'sale_id': 7, 'ticket_id': 5, 'quantity': 2, 'amount': Decimal('10.00'), 'voided': False}]
+        product_ids, location_ids, quantities, voided_sales, voided_locations = cursor.params[3]
+        assert (product_ids, location_ids, quantities) == ([1], [1], [2])
+        assert voided_sales == [] and voided_locations == []
+        assert movements == [(1, [(1, Decimal('0.036'), 'devolucion', 'Devolución venta ID 7')])]
+        
+        cursor = fake_cursor(lines, [{'business_date': None}], [], [])
+        app_module.refund_sales(cursor, ticket_ids=[5], user_id=1)
+        product_ids, location_ids, quantities, voided_sales, voided_locations = cursor.params[3]
+        assert (product_ids, quantities) == ([1, 2], [3, 1])
+        assert voided_sales == [7, 8] and voided_locations == [1, 1]
+    
+    def test_refund_requires_target(self, fake_cursor):
+        """Test a refund needs at least one sale or ticket"""
+        from app import refund_sales
+        with pytest.raises(ValueError):
+            refund_sales(fake_cursor())
+    
+    def test_refund_routes_require_auth(self, client):
+        """Test refunds and bulk voids are not public"""
+        assert client.post('/api/sales/refund', json={'sale_id': 1}).status_code in [302, 401]
+        assert client.post('/api/admin/sales/void', json={'sale_ids': [1]}).status_code in [302, 401]
+
+class TestDayClose:
+    """Test end-of-day close and snapshot-backed daily reports"""
+    
+    def test_open_intervals_skip_closed_days(self):
+        """Test only days without a close are left to compute from raw sales"""
+        from datetime import date
+        from closing import open_intervals
+        closed = [date(2026, 10, 2), date(2026, 10, 3), date(2026, 10, 5)]
+        assert open_intervals(closed, date(2026, 10, 1), date(2026, 10, 5)) == [
+            (date(2026, 10, 1), date(2026, 10, 2)), (date(2026, 10, 4), date(2026, 10, 5))]
+        assert open_intervals(closed) == [(None, date(2026, 10, 2)), (date(2026, 10, 4), date(2026, 10, 5)),
+                                          (date(2026, 10, 6), None)]
+    
+    def test_open_days_filter(self):
+        """Test open intervals become plain range conditions"""
+        from datetime import date
+        from closing import open_days_filter
+        sql, params = open_days_filter([(None, date(2026, 10, 2)), (date(2026, 10, 4), None)])
+        assert sql == '((s.sale_date < %s) OR (s.sale_date >= %s))'
+        assert params == [date(2026, 10, 2), date(2026, 10, 4)]
+        assert open_days_filter([])[0] == '(FALSE)'
+    
+    def test_day_close_requires_admin(self, client):
+        """Test closing the till is not public"""
+        response = client.post('/api/admin/day-close', json={})
+        assert response.status_code in [302, 401]
+
+class TestReportCache:
+    """Test the closed-period report cache"""
+    
+    def test_cache_key_ignores_param_order(self):
+        """Test equal parameters share a key and any difference changes it"""
+        from datetime import date
+        from report_cache import report_cache_key
+        params = {'location_id': 1, 'start_date': date(2026, 9, 1), 'end_date': date(2026, 9, 30)}
+        key = report_cache_key('ventas_por_fecha', params)
+        assert key == report_cache_key('ventas_por_fecha', dict(reversed(list(params.items()))))
+        assert key != report_cache_key('ventas_por_producto', params)
+        assert key != report_cache_key('ventas_por_fecha', dict(params, location_id=2))
+    
+    def test_period_closed_only_when_past_and_closed(self, fake_cursor):
+        """Test a period is immutable only if it ended and its sales days are closed"""
+        from datetime import date
+        from report_cache import period_is_closed
+        today = date(2026, 10, 19)
+        cursor = fake_cursor([{'business_date': date(2026, 9, 1)}], [{'pending': False}])
+        assert not period_is_closed(cursor, 1, date(2026, 10, 1), today, today=today)
+        assert not period_is_closed(cursor, 1, date(2026, 9, 1), None, today=today)
+        assert cursor.statements == []
+        assert period_is_closed(cursor, 1, date(2026, 9, 1), date(2026, 9, 30), today=today)
+        assert not period_is_closed(fake_cursor([], [{'pending': True}]), 1, date(2026, 9, 1), date(2026, 9, 30),
+                                    today=today)
+    
+    def test_cached_report_stores_closed_period(self, monkeypatch, fake_cursor):
+        """Test a miss on a closed period is built on the replica and stored as immutable on the primary"""
+        from datetime import date
+        from app import cached_report
+        replica = fake_cursor([{'catalog_version': 3, 'content': None, 'mimetype': None, 'filename': None,
+                                'immutable': None}], [{'business_date': date(2025, 9, 1)}], [{'pending': False}])
+        primary = fake_cursor()
+        monkeypatch.setattr('app.get_db', lambda role='primary': replica if role == 'replica' else primary)
+        params = {'location_id': 1, 'start_date': date(2025, 9, 1), 'end_date': date(2025, 9, 30)}
+        with app.test_request_context():
+            response = cached_report('ventas_por_fecha', params, date(2025, 9, 1), date(2025, 9, 30), ('products',),
+                                     lambda cursor: (b'[]', 'application/json', None))
+        assert response.headers['X-Report-Cache'] == 'closed'
+        assert response.get_data() == b'[]'
+        catalog_version, immutable = primary.params[0][6:8]
+        assert (catalog_version, immutable) == (3, True)
+        assert primary.statements[-1] == 'COMMIT'
+        assert replica.closed and primary.closed
+    
+    def test_cached_report_hit_skips_build(self, monkeypatch, fake_cursor):
+        """Test a stored entry is returned as is, without building or writing to the primary"""
+        from app import cached_report
+        replica = fake_cursor([{'catalog_version': 3, 'content': b'[1]', 'mimetype': 'application/json',
+                                'filename': None, 'immutable': True}])
+        def get_db(role='primary'):
+            assert role == 'replica'
+            return replica
+        monkeypatch.setattr('app.get_db', get_db)
+        with app.test_request_context():
+            response = cached_report('ventas_por_fecha', {'location_id': 1}, None, None, ('products',), None)
+        assert response.headers['X-Report-Cache'] == 'hit'
+        assert response.get_data() == b'[1]'
+        assert len(replica.statements) == 1 and replica.closed
+    
+    def test_cached_report_closes_replica_on_error(self, monkeypatch, fake_cursor):
+        """Test a failing build still closes the replica connection and stores nothing"""
+        from datetime import date
+        from app import cached_report
+        replica = fake_cursor([{'catalog_version': 3, 'content': None, 'mimetype': None, 'filename': None,
+                                'immutable': None}], [], [{'pending': True}])
+        def get_db(role='primary'):
+            assert role == 'replica'
+            return replica
+        def build(cursor):
+            raise RuntimeError('canceling statement due to statement timeout')
+        monkeypatch.setattr('app.get_db', get_db)
+        with app.test_request_context(), pytest.raises(RuntimeError):
+            cached_report('ventas_por_fecha', {'location_id': 1}, date(2025, 9, 1), date(2025, 9, 30),
+                          ('products',), build)
+        assert replica.closed
+    
+    def test_month_bounds_crosses_year(self):
+        """Test the full report month runs up to the first day of the next month"""
+        from datetime import date
+        from app import month_bounds
+        assert month_bounds('2025-12') == (date(2025, 12, 1), date(2026, 1, 1))
+        assert month_bounds('2026-02') == (date(2026, 2, 1), date(2026, 3, 1))
+
+class TestLocations:
+    """Test multi-location endpoints"""
+    
+    def test_get_locations(self, client):
+        """Test list of locations"""
+        response = client.get('/api/locations')
+        assert response.status_code in [200, 302]
+    
+    def test_locations_summary_requires_auth(self, client):
+        """Test cross-location rollups require admin"""
+        response = client.get('/api/admin/locations/summary')
+        assert response.status_code in [302, 403]
+    
+    def test_current_location_override(self):
+        """Test only admins or unassigned users can pick another location"""
+        from app import current_location_id
+        with app.test_request_context('/api/supplies?location_id=3'):
+            from flask import session
+            session['role'] = 'vendedor'
+            session['location_id'] = 2
+            assert current_location_id() == 2
+            session['role'] = 'administrador'
+            assert current_location_id() == 3
+
+class TestCosting:
+    """Test recipe costing engine"""
+    
+    def test_compute_product_costs(self):
+        """Test sparse recipe matrix times cost vector"""
+        import numpy as np
+        from costing import compute_product_costs
+        result = compute_product_costs(
+            np.array([20, 10]), np.array([5.0, 0.0]),
+            np.array([10, 10, 20]), np.array([7, 3, 3]), np.array([2.0, 0.5, 1.0]),
+            np.array([3, 7]), np.array([4.0, 0.0]))
+        assert result['product_ids'].tolist() == [10, 20]
+        assert result['costs'].tolist() == [2.0, 4.0]
+        assert result['margins'].tolist() == [-2.0, 1.0]
+        assert result['missing_costs'].tolist() == [1, 0]
+    
+    def test_product_costs_requires_auth(self, client):
+        """Test product costs require admin"""
+        response = client.get('/api/admin/product-costs')
+        assert response.status_code in [302, 403]
+
+class TestRecipes:
+    """Test nested recipe flattening"""
+    
+    def test_flatten_preparations(self):
+        """Test sub-preparations expand to raw supplies per unit"""
+        from decimal import Decimal
+        from recipes import flatten_preparations
+        flattened = flatten_preparations(
+            {1: 10, 2: 2},
+            [(1, 100, None, 500), (1, 101, None, 4), (2, None, 1, 5), (2, 100, None, 20)])
+        assert flattened[1] == {100: Decimal(50), 101: Decimal('0.4')}
+        assert flattened[2] == {100: Decimal(135), 101: Decimal(1)}
+    
+    def test_recipe_cycle_detected(self):
+        """Test circular preparations are rejected"""
+        from recipes import flatten_preparations, RecipeCycleError
+        with pytest.raises(RecipeCycleError):
+            flatten_preparations({1: 1, 2: 1}, [(1, None, 2, 1), (2, None, 1, 1)])
+
+class TestProduction:
+    """Test production run endpoints"""
+    
+    def test_production_run_requires_auth(self, client):
+        """Test production runs require admin"""
+        response = client.post('/api/admin/production-runs', json={'preparation_id': 1})
+        assert response.status_code in [302, 403]
+    
+    def test_production_report_type(self):
+        """Test production report takes a date range"""
+        from app import normalize_report_params
+        with app.test_request_context('/api/report-jobs'):
+            params = normalize_report_params('produccion', {'start_date': '2025-01-01', 'end_date': '2025-01-31'})
+        assert params['start_date'] == '2025-01-01'
+        assert params['end_date'] == '2025-01-31'
+
+class TestWaste:
+    """Test waste logging endpoints"""
+    
+    def test_log_waste_requires_auth(self, client):
+        """Test waste logging requires login"""
+        response = client.post('/api/waste', json={'entries': [{'supply_id': 1, 'quantity': 1, 'reason': 'vencido'}]})
+        assert response.status_code == 302
+    
+    def test_waste_analytics_requires_auth(self, client):
+        """Test loss dashboard requires admin"""
+        response = client.get('/api/admin/waste')
+        assert response.status_code in [302, 403]
+
+class TestLots:
+    """Test lot and expiry endpoints"""
+    
+    def test_expiring_lots_requires_auth(self, client):
+        """Test expiring lots require login"""
+        response = client.get('/api/lots/expiring?days=3')
+        assert response.status_code == 302
+    
+    def test_receive_lot_requires_auth(self, client):
+        """Test lot receipt requires admin"""
+        response = client.post('/api/admin/lots', json={'supply_id': 1, 'quantity': 5})
+        assert response.status_code in [302, 403]
+
+class TestReceipts:
+    """Test goods receipt endpoints"""
+    
+    def test_receipt_requires_auth(self, client):
+        """Test goods receipts require admin"""
+        response = client.post('/api/admin/receipts', json={'supplier_id': 1, 'lines': [{'supply_id': 1, 'quantity': 5}]})
+        assert response.status_code in [302, 403]
+    
+    def test_get_suppliers(self, client):
+        """Test getting suppliers list"""
+        response = client.get('/api/admin/suppliers')
+        assert response.status_code in [200, 302]
+
+class TestStockAdjustments:
+    """Test relative stock adjustments"""
+    
+    def test_adjust_requires_auth(self, client):
+        """Test bulk adjustments require admin"""
+        response = client.post('/api/admin/supplies/adjust', json={'adjustments': [{'supply_id': 1, 'delta': 2}]})
+        assert response.status_code in [302, 403]
+    
+    def test_malformed_adjustments_rejected(self, client, monkeypatch, fake_cursor):
+        """Test entries that are not objects or lack supply_id, delta and stock get a 400 before any write"""
+        cursor = fake_cursor([{'role': 'administrador'}])
+        monkeypatch.setattr('app.get_db', lambda role='primary': cursor)
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        for adjustments in ([5], [{'delta': 2}], [{'supply_id': 1}], {'supply_id': 1, 'delta': 2}):
+            response = client.post('/api/admin/supplies/adjust', json={'adjustments': adjustments})
+            assert response.status_code == 400
+        assert not any('location_stock' in query for query in cursor.statements)
+    
+    def test_adjust_stock_requires_supply_id(self, fake_cursor):
+        """Test an adjustment without supply_id is a validation error, not a KeyError"""
+        from app import adjust_stock
+        with pytest.raises(ValueError):
+            adjust_stock(fake_cursor(), 1, [{'delta': 2}])
+    
+    def test_conflict_error_keeps_details(self):
+        """Test version conflicts carry the current stock"""
+        from app import StockConflictError
+        error = StockConflictError([{'supply_id': 1, 'stock': 5, 'version': 3, 'expected_version': 2}])
+        assert error.conflicts[0]['version'] == 3
+
+class TestPricing:
+    """Test the in-memory discount engine"""
+    
+    def rule(self, **fields):
+        from pricing import compile_rule
+        row = {'id': 1, 'name': 'regla', 'discount_type': 'percentage', 'discount_value': 10, 'automatic': True}
+        row.update(fields)
+        return compile_rule(row)
+    
+    def test_n_for_m_frees_cheapest_units(self):
+        """Test 3x2 gives away the cheapest unit of the cart"""
+        from datetime import datetime
+        from pricing import price_cart
+        rules = [self.rule(discount_type='n_for_m', discount_value=0, buy_quantity=3, pay_quantity=2)]
+        lines = [{'product_id': 1, 'quantity': 2, 'unit_price': 1000}, {'product_id': 2, 'quantity': 1, 'unit_price': 400}]
+        result = price_cart(rules, lines, datetime(2026, 1, 5, 12))
+        assert result['discount'] == 400
+        assert result['lines'][1]['total'] == 0
+    
+    def test_exclusive_rule_competes_with_stacked_rules(self):
+        """Test a non-combinable rule only wins when it beats the stacked ones"""
+        from datetime import datetime
+        from pricing import price_cart
+        rules = [self.rule(id=1), self.rule(id=2, discount_value=5),
+                 self.rule(id=3, discount_type='fixed', discount_value=200, combinable=False)]
+        lines = [{'product_id': 1, 'quantity': 1, 'unit_price': 1000}]
+        result = price_cart(rules, lines, datetime(2026, 1, 5, 12))
+        assert [rule['id'] for rule in result['applied']] == [3]
+        assert result['total'] == 800
+    
+    def test_lines_record_only_rules_that_applied(self):
+        """Test each line lists the rules that discounted it and undiscounted lines list none"""
+        from datetime import datetime
+        from pricing import price_cart
+        rules = [self.rule(id=1, product_ids=[1]), self.rule(id=2, discount_type='fixed', discount_value=50)]
+        lines = [{'product_id': 1, 'quantity': 1, 'unit_price': 1000}, {'product_id': 2, 'quantity': 1, 'unit_price': 40}]
+        result = price_cart(rules, lines, datetime(2026, 1, 5, 12))
+        assert [(rule['id'], rule['amount']) for rule in result['lines'][0]['applied']] == [(1, 100), (2, 50)]
+        assert [rule['id'] for rule in result['lines'][1]['applied']] == [2]
+        result = price_cart([self.rule(id=1, product_ids=[1])], lines, datetime(2026, 1, 5, 12))
+        assert result['lines'][1]['applied'] == []
+    
+    def test_happy_hour_across_midnight(self):
+        """Test time windows that wrap past midnight"""
+        from datetime import datetime
+        from pricing import rule_active_at
+        rule = self.rule(start_time='22:00', end_time='02:00', weekdays=[5, 6])
+        assert rule_active_at(rule, datetime(2026, 1, 9, 23, 30))
+        assert not rule_active_at(rule, datetime(2026, 1, 9, 12, 0))
+        assert not rule_active_at(rule, datetime(2026, 1, 5, 23, 30))
+
+class TestProductPrices:
+    """Test the cached product price list"""
+    
+    def test_price_follows_effective_dates(self):
+        """Test scheduled prices apply from their effective date without reloading"""
+        from datetime import datetime
+        from pricing import ProductPriceCache
+        rows = [{'product_id': 1, 'name': 'Torta', 'category_id': 2, 'effective_from': datetime(2026, 1, 1), 'price': 100},
+                {'product_id': 1, 'name': 'Torta', 'category_id': 2, 'effective_from': datetime(2026, 3, 1), 'price': 120},
+                {'product_id': 2, 'name': 'Café', 'category_id': 1, 'effective_from': None, 'price': 50}]
+        loads = []
+        cache = ProductPriceCache(lambda: loads.append(1) or rows, ttl=60)
+        assert cache.price_at(1, datetime(2026, 2, 15)) == 100
+        assert cache.price_at(1, datetime(2026, 3, 2)) == 120
+        assert cache.price_at(2, datetime(2026, 3, 2)) == 50
+        assert len(loads) == 1
+    
+    def test_product_prices_requires_auth(self, client):
+        """Test price history requires admin"""
+        response = client.get('/api/admin/product/1/prices')
+        assert response.status_code in [302, 403]
+    
+    def test_invalid_price_rejected(self, client, monkeypatch, fake_cursor):
+        """Test a non-numeric, negative or missing price gets a 400 before any write"""
+        cursor = fake_cursor([{'role': 'administrador'}])
+        monkeypatch.setattr('app.get_db', lambda role='primary': cursor)
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        for body in ({'price': 'abc'}, {'price': -1}, {'price': 'NaN'}, {}):
+            response = client.post('/api/admin/product/1/prices', json=body)
+            assert response.status_code == 400
+            assert response.get_json() == {'error': 'Precio inválido'}
+        assert not any('product_prices' in query for query in cursor.statements)
+
+class TestSerialization:
+    """Test fast JSON encoding and response compression"""
+    
+    def test_json_keeps_decimal_and_date_format(self):
+        """Test Decimal and datetime encode like Flask's default provider"""
+        from datetime import datetime
+        from decimal import Decimal
+        from flask.json.provider import DefaultJSONProvider
+        from serialization import FastJSONProvider
+        row = {'stock': Decimal('12.50'), 'updated_at': datetime(2026, 10, 19, 2, 34, 7), 'id': 3}
+        assert FastJSONProvider(app).loads(FastJSONProvider(app).dumps(row)) == \
+            DefaultJSONProvider(app).loads(DefaultJSONProvider(app).dumps(row))
+    
+    def test_choose_encoding(self):
+        """Test Accept-Encoding negotiation prefers brotli and honors q=0"""
+        from werkzeug.http import parse_accept_header
+        from serialization import choose_encoding
+        assert choose_encoding(parse_accept_header('gzip, deflate, br')) == 'br'
+        assert choose_encoding(parse_accept_header('gzip, br;q=0')) == 'gzip'
+        assert choose_encoding(parse_accept_header('identity')) is None
+
+class TestConditionalGet:
+    """Test data versions and ETags for reference-data endpoints"""
+    
+    def test_notifications_invalidate_before_new_version(self):
+        """Test a change notification invalidates registered caches and bumps only its key"""
+        from versioning import DataVersions, stock_key
+        versions = DataVersions(connect=None)
+        seen = []
+        versions.on_change('discounts', lambda: seen.append(dict(versions._versions)))
+        versions.apply(['discounts:41', stock_key(2) + ':42', 'invalid'])
+        assert seen == [{}]
+        assert versions._versions == {'discounts': 41, 'location_stock/2': 42}
+    
+    def test_etag_depends_on_versions_and_variant(self):
+        """Test ETags change with table versions, path and location"""
+        from versioning import compute_etag
+        etag = compute_etag((1, 7), '/api/supplies?', 'cajero', 1)
+        assert etag == compute_etag((1, 7), '/api/supplies?', 'cajero', 1)
+        assert etag != compute_etag((1, 8), '/api/supplies?', 'cajero', 1)
+        assert etag != compute_etag((1, 7), '/api/supplies?', 'cajero', 2)
+
+class TestReplicaRouting:
+    """Test read-replica selection for report endpoints"""
+    
+    def test_stale_replica_falls_back_until_next_check(self, fake_cursor):
+        """Test a lagging replica is skipped without reconnecting until the check interval passes"""
+        from replication import ReplicaRouter
+        opened = []
+        def connect(dsn):
+            opened.append(fake_cursor([(120,)]))
+            return opened[-1]
+        router = ReplicaRouter('postgresql://replica/illima_db', connect, max_lag=30, check_interval=60)
+        assert router.connect() is None
+        assert router.connect() is None
+        assert len(opened) == 1 and opened[0].closed
+        assert router.last_lag == 120
+    
+    def test_replica_used_when_fresh_or_unconfigured(self, fake_cursor):
+        """Test a fresh replica is returned and no DSN means primary"""
+        from replication import ReplicaRouter
+        replica = fake_cursor([(0.5,)])
+        assert ReplicaRouter('postgresql://replica/illima_db', lambda dsn: replica, max_lag=30).connect() is replica
+        assert ReplicaRouter(None, lambda dsn: replica).connect() is None
+
+class TestPartitions:
+    """Test monthly partition helpers"""
+    
+    def test_add_months_crosses_year(self):
+        """Test month arithmetic across year boundaries"""
+        from datetime import date
+        from partitions import add_months
+        assert add_months(date(2025, 11, 1), 3) == date(2026, 2, 1)
+        assert add_months(date(2025, 1, 1), -1) == date(2024, 12, 1)
+    
+    def test_partition_name(self):
+        """Test partition naming"""
+        from datetime import date
+        from partitions import partition_name
+        assert partition_name('sales', date(2026, 3, 1)) == 'sales_y2026m03'
+
+class TestInstrumentation:
+    """Test performance instrumentation"""
+    
+    def test_metrics_endpoint(self, client, monkeypatch):
+        """Test Prometheus metrics exposition only with the configured bearer token"""
+        monkeypatch.delenv('METRICS_TOKEN', raising=False)
+        assert client.get('/metrics').status_code == 403
+        monkeypatch.setenv('METRICS_TOKEN', 'secreto')
+        assert client.get('/metrics', headers={'Authorization': 'Bearer otro'}).status_code == 403
+        client.get('/login')
+        response = client.get('/metrics', headers={'Authorization': 'Bearer secreto'})
+        assert response.status_code == 200
+        assert b'illima_http_request_duration_seconds_bucket{route="/login"' in response.data
+    
+    def test_normalize_sql(self):
+        """Test SQL normalization groups equal statements"""
+        from instrumentation import normalize_sql
+        assert normalize_sql("SELECT *  FROM t\n WHERE id = %s AND n = 'x'") == 'SELECT * FROM t WHERE id = ? AND n = ?'
+    
+    def test_detect_n_plus_one(self):
+        """Test repeated statements are flagged"""
+        from instrumentation import detect_n_plus_one
+        flagged = detect_n_plus_one({'UPDATE products SET active = ? WHERE id = ?': 8, 'SELECT 1': 1}, threshold=5)
+        assert list(flagged) == ['UPDATE products SET active = ? WHERE id = ?']
+    
+    def test_slow_queries_requires_auth(self, client):
+        """Test slow query report requires login"""
+        response = client.get('/api/admin/slow-queries')
+        assert response.status_code in [302, 401]
+    
+    def test_explain_only_read_only_statements(self):
+        """Test only plain reads are re-run with EXPLAIN ANALYZE"""
+        from instrumentation import is_read_only
+        assert is_read_only('SELECT * FROM supplies WHERE id = %s')
+        assert not is_read_only('SELECT stock FROM supplies WHERE id = %s FOR UPDATE')
+        assert not is_read_only('WITH moved AS (DELETE FROM sales RETURNING *) SELECT * FROM moved')
+    
+    def test_summarize_plan(self):
+        """Test sequential scans with filters are reported"""
+        from instrumentation import summarize_plan
+        plan = [{'Execution Time': 12.5, 'Plan': {'Node Type': 'Hash Join', 'Plans': [
+            {'Node Type': 'Seq Scan', 'Relation Name': 'sales', 'Filter': '(product_id = 3)', 'Rows Removed by Filter': 9000},
+            {'Node Type': 'Index Scan', 'Relation Name': 'products'}
+        ]}}]
+        summary = summarize_plan(plan)
+        assert summary['execution_ms'] == 12.5
+        assert [scan['relation'] for scan in summary['seq_scans']] == ['sales']
+
+class TestBenchmark:
+    """Test benchmark result comparison"""
+    
+    def test_compare_results_flags_regression(self):
+        """Test p95 increases above the threshold are flagged"""
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'scripts'))
+        from benchmark import compare_results
+        base = {'micro': {'sale_with_discount': {'p95_ms': 10.0}, 'list_all_products': {'p95_ms': 8.0}}}
+        current = {'micro': {'sale_with_discount': {'p95_ms': 13.0}, 'list_all_products': {'p95_ms': 8.4}}}
+        rows = {row[0]: row for row in compare_results(base, current, threshold=15)}
+        assert rows['sale_with_discount'][4] is True
+        assert rows['list_all_products'][4] is False
+    
+    def test_stress_error_classification(self):
+        """Test concurrency failures are classified from the error message"""
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'scripts'))
+        from stress_test import classify_error
+        deadlock = app.response_class('{"error": "deadlock detected"}', status=500, mimetype='application/json')
+        insufficient = app.response_class('{"error": "Stock insuficiente"}', status=400, mimetype='application/json')
+        assert classify_error(deadlock) == 'deadlock'
+        assert classify_error(insufficient) == 'stock_insuficiente'
+
 class TestErrorHandling:
     """Test error handling"""
     
@@ -0,0 +1,221 @@
+"""
+Versiones de datos para GET condicionales (ETag / If-None-Match).
+
+Cada escritura en una tabla versionada toma un número de data_version_seq y
+lo publica con NOTIFY en el canal data_versions; un trigger por sentencia lo
+hace desde la BD, así que no depende de qué código escribió. Cada proceso
+mantiene las versiones en memoria con un hilo que hace LISTEN: responder un
+304 no consulta Postgres.
+
+- Tablas de referencia (VERSIONED_TABLES: categorías, insumos, productos,
+  precios, recetas, descuentos): además de notificar guardan la versión en
+  data_versions, que el hilo lee al conectarse. Se escriben poco, así que la
+  fila por tabla no es un cuello de botella y todos los workers coinciden en
+  el ETag.
+- location_stock cambia en cada venta: solo notifica, una clave por local
+  ("location_stock/3"), sin fila en data_versions que serializaría las
+  ventas. Hasta el primer cambio que ve, cada proceso usa una versión base
+  propia (el ETag puede diferir entre workers; nunca coincide por error).
+
+Una notificación puede llegar unos milisegundos después del commit: en ese
+lapso se puede responder 304 con datos recién cambiados. Si el hilo pierde la
+conexión no hay ETag (se responde siempre 200) hasta que reconecta y recarga
+las versiones. Al recibir un cambio se invalidan las cachés en memoria
+registradas para esa tabla (on_change) antes de publicar la versión nueva.
+"""
+import hashlib
+import logging
+import os
+import select
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger('illima.versioning')
+
+CHANNEL = 'data_versions'
+STOCK_TABLE = 'location_stock'
+
+VERSIONED_TABLES = ('categories', 'supplies', 'products', 'product_prices', 'product_supplies', 'discounts')
+
+# Cada cuánto el hilo verifica la conexión si no llegan notificaciones, y espera antes de reconectar
+LISTEN_PING_SECONDS = float(os.getenv('DATA_VERSIONS_PING_SECONDS', '30'))
+LISTEN_RETRY_SECONDS = float(os.getenv('DATA_VERSIONS_RETRY_SECONDS', '5'))
+
+def install_version_triggers(cursor):
+    """Tabla data_versions, secuencia y triggers de las tablas versionadas (idempotente)"""
+    cursor.execute('CREATE SEQUENCE IF NOT EXISTS data_version_seq')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            table_name VARCHAR(63) PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+        DECLARE
+            new_version BIGINT := nextval('data_version_seq');
+        BEGIN
+            INSERT INTO data_versions (table_name, version, updated_at)
+            VALUES (TG_TABLE_NAME, new_version, CURRENT_TIMESTAMP)
+            ON CONFLICT (table_name) DO UPDATE
+                SET version = EXCLUDED.version, updated_at = EXCLUDED.updated_at;
+            PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME || ':' || new_version);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION notify_stock_version() RETURNS trigger AS $$
+        DECLARE
+            new_version BIGINT := nextval('data_version_seq');
+            changed_location INTEGER;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                FOR changed_location IN SELECT DISTINCT location_id FROM old_rows LOOP
+                    PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME || '/' || changed_location || ':' || new_version);
+                END LOOP;
+            ELSE
+                FOR changed_location IN SELECT DISTINCT location_id FROM new_rows LOOP
+                    PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME || '/' || changed_location || ':' || new_version);
+                END LOOP;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    for table in VERSIONED_TABLES:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {table}_data_version ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_data_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()
+        ''')
+
+    # Las tablas de transición tienen que declararse por operación
+    for operation, referencing in (('INSERT', 'NEW TABLE AS new_rows'),
+                                   ('UPDATE', 'NEW TABLE AS new_rows'),
+                                   ('DELETE', 'OLD TABLE AS old_rows')):
+        name = f'{STOCK_TABLE}_{operation.lower()}_version'
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {STOCK_TABLE}')
+        cursor.execute(f'''
+            CREATE TRIGGER {name}
+            AFTER {operation} ON {STOCK_TABLE}
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_stock_version()
+        ''')
+
+def stock_key(location_id):
+    """Clave de versión del stock de un local"""
+    return f'{STOCK_TABLE}/{location_id}'
+
+def parse_notification(payload):
+    """("tabla" o "location_stock/<local>", versión) a partir del payload de la notificación"""
+    key, _, version = payload.rpartition(':')
+    return key, int(version)
+
+def compute_etag(versions, *variant):
+    """ETag de una respuesta: las versiones de sus datos más lo que cambia la respuesta (ruta, local, rol...)"""
+    raw = repr((tuple(versions),) + variant).encode()
+    return hashlib.sha1(raw).hexdigest()[:20]
+
+class DataVersions:
+    """Versiones de las tablas en memoria, al día con LISTEN data_versions.
+
+    connect() devuelve una conexión psycopg2 nueva, dedicada al hilo. El hilo
+    arranca con la primera consulta de versiones (después del fork de cada
+    worker) y reconecta solo.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.lock = threading.Lock()
+        self._versions = {}
+        self._base = None
+        self._connections = 0
+        self._callbacks = defaultdict(list)
+        self._thread = None
+        self._pid = None
+
+    def on_change(self, table, callback):
+        """Llamar callback() (desde el hilo) cada vez que cambia la tabla"""
+        self._callbacks[table].append(callback)
+
+    def versions(self, keys):
+        """Versión de cada clave, o None si el hilo no está conectado"""
+        self._ensure_started()
+        with self.lock:
+            if self._base is None:
+                return None
+            return tuple(self._versions.get(key, 0 if key in VERSIONED_TABLES else self._base) for key in keys)
+
+    def apply(self, payloads):
+        """Registrar las notificaciones recibidas"""
+        for payload in payloads:
+            try:
+                key, version = parse_notification(payload)
+            except ValueError:
+                logger.warning('Notificación de versión inválida: %r', payload)
+                continue
+            # Primero se descartan las cachés: quien vea la versión nueva ya no lee datos viejos
+            for callback in self._callbacks.get(key.split('/')[0], ()):
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Error invalidando caché de %s', key)
+            with self.lock:
+                self._versions[key] = version
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self.lock:
+            if self._pid == pid:
+                return
+            # En un proceso hijo las versiones heredadas no se actualizan: se empieza de nuevo
+            self._versions, self._base, self._pid = {}, None, pid
+            self._thread = threading.Thread(target=self._run, name='data-versions', daemon=True)
+            self._thread.start()
+
+    def _listen(self):
+        conn = self.connect()
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            # LISTEN antes de leer las versiones: ningún cambio queda entre la lectura y la escucha
+            cursor.execute(f'LISTEN {CHANNEL}')
+            cursor.execute('SELECT table_name, version FROM data_versions')
+            versions = dict(cursor.fetchall())
+            # Mientras no hubo conexión se pudieron perder cambios: se descartan las cachés
+            for callbacks in self._callbacks.values():
+                for callback in callbacks:
+                    callback()
+            self._connections += 1
+            with self.lock:
+                self._versions = versions
+                self._base = f'{os.getpid()}.{self._connections}'
+
+            while True:
+                if select.select([conn], [], [], LISTEN_PING_SECONDS) == ([], [], []):
+                    cursor.execute('SELECT 1')
+                else:
+                    conn.poll()
+                if conn.notifies:
+                    payloads = [notify.payload for notify in conn.notifies]
+                    conn.notifies.clear()
+                    self.apply(payloads)
+        finally:
+            with self.lock:
+                self._base = None
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning('Sin LISTEN de versiones (%s); reintento en %ss', e, LISTEN_RETRY_SECONDS)
+            time.sleep(LISTEN_RETRY_SECONDS)
@@ -0,0 +1,275 @@
+"""
+Proceso de trabajos en segundo plano: genera los reportes encolados en report_jobs
+y ejecuta las tareas periódicas (paso de los movimientos de inventory_outbox al
+historial, snapshots diarios, conciliación de inventario, totales entre locales,
+rollup de mermas, precios programados, mantenimiento de particiones y retención
+del outbox de eventos).
+
+Uso:
+    python worker.py          # procesar trabajos continuamente
+    python worker.py --once   # vaciar la cola y salir
+"""
+import os
+import sys
+import time
+import signal
+from datetime import datetime
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import get_db, REPORT_TYPES, REPORTS_DIR, take_inventory_snapshots, reconcile_inventory, \
+    refresh_location_rollups, refresh_loss_rollup, flush_inventory_outbox, INVENTORY_FLUSH_BATCH
+from costing import recompute_product_costs
+from pricing import apply_due_prices
+from partitions import maintain_partitions
+from events import purge_events
+from report_cache import purge_reports
+
+POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '2'))
+JOB_TIMEOUT_MINUTES = int(os.getenv('REPORT_JOB_TIMEOUT_MINUTES', '30'))
+MAX_ATTEMPTS = int(os.getenv('REPORT_JOB_MAX_ATTEMPTS', '3'))
+ARTIFACT_TTL_HOURS = int(os.getenv('REPORT_ARTIFACT_TTL_HOURS', '24'))
+INVENTORY_FLUSH_INTERVAL = float(os.getenv('INVENTORY_FLUSH_INTERVAL', '5'))
+
+running = True
+
+def stop(signum, frame):
+    """Terminar el ciclo después del trabajo actual"""
+    global running
+    running = False
+
+def claim_job(conn):
+    """Tomar el siguiente trabajo pendiente sin bloquear a otros workers"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute('''
+        UPDATE report_jobs
+        SET status = 'procesando', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM report_jobs
+            WHERE status = 'pendiente'
+            ORDER BY created_at, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, report_type, params
+    ''')
+    job = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    return job
+
+def run_job(conn, job):
+    """Generar el archivo del reporte y marcar el trabajo como completado o fallido"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    try:
+        builder = REPORT_TYPES[job['report_type']]['builder']
+        excel_buffer, filename = builder(cursor, job['params'])
+        conn.rollback()
+
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        artifact_path = f"{job['id']}_{filename}"
+        tmp_path = os.path.join(REPORTS_DIR, artifact_path + '.tmp')
+
+        with open(tmp_path, 'wb') as f:
+            f.write(excel_buffer.getvalue())
+        os.replace(tmp_path, os.path.join(REPORTS_DIR, artifact_path))
+
+        cursor.execute('''
+            UPDATE report_jobs
+            SET status = 'completado', artifact_path = %s, artifact_name = %s,
+                error = NULL, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (artifact_path, filename, job['id']))
+        conn.commit()
+        print(f"[{datetime.now():%H:%M:%S}] Reporte {job['id']} ({job['report_type']}) completado")
+    except Exception as e:
+        conn.rollback()
+        cursor.execute('''
+            UPDATE report_jobs
+            SET status = 'fallido', error = %s, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (str(e), job['id']))
+        conn.commit()
+        print(f"[{datetime.now():%H:%M:%S}] Reporte {job['id']} falló: {e}")
+    finally:
+        cursor.close()
+
+def requeue_stale_jobs(conn):
+    """Devolver a la cola los trabajos de un worker que murió a mitad de proceso"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE report_jobs
+        SET status = CASE WHEN attempts >= %s THEN 'fallido' ELSE 'pendiente' END,
+            error = 'Tiempo de proceso excedido'
+        WHERE status = 'procesando'
+          AND started_at < NOW() - %s * INTERVAL '1 minute'
+    ''', (MAX_ATTEMPTS, JOB_TIMEOUT_MINUTES))
+    conn.commit()
+    cursor.close()
+
+def purge_expired_artifacts(conn):
+    """Borrar del disco los reportes generados hace más de ARTIFACT_TTL_HOURS"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute('''
+        UPDATE report_jobs
+        SET status = 'expirado'
+        WHERE status = 'completado'
+          AND finished_at < NOW() - %s * INTERVAL '1 hour'
+        RETURNING artifact_path
+    ''', (ARTIFACT_TTL_HOURS,))
+
+    for job in cursor.fetchall():
+        path = os.path.join(REPORTS_DIR, job['artifact_path'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    conn.commit()
+    cursor.close()
+
+def flush_inventory_movements(conn):
+    """Pasar al historial los movimientos pendientes de inventory_outbox, un lote por transacción.
+
+    Un error se registra y el worker sigue con lo demás; el lote queda en el
+    outbox para la próxima corrida.
+    """
+    cursor = conn.cursor()
+    try:
+        while True:
+            moved = flush_inventory_outbox(cursor)
+            conn.commit()
+            if moved < INVENTORY_FLUSH_BATCH:
+                break
+    except Exception as e:
+        conn.rollback()
+        print(f"[{datetime.now():%H:%M:%S}] Error al pasar movimientos al historial: {e}")
+    finally:
+        cursor.close()
+
+def snapshot_inventory(conn):
+    """Guardar los snapshots diarios de stock que falten"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    created = take_inventory_snapshots(cursor)
+    conn.commit()
+    cursor.close()
+
+    if created:
+        print(f"[{datetime.now():%H:%M:%S}] {created} snapshots de inventario guardados")
+
+def check_inventory_drift(conn):
+    """Conciliar el historial con el stock de cada local y avisar si hay diferencias"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    result = reconcile_inventory(cursor)
+    conn.commit()
+    cursor.close()
+
+    if result['drift_count']:
+        print(f"[{datetime.now():%H:%M:%S}] Conciliación {result['id']}: "
+              f"{result['drift_count']} insumos con diferencias entre historial y stock")
+
+def refresh_rollups(conn):
+    """Refrescar los totales entre locales (vistas materializadas) y el rollup de mermas"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    refresh_location_rollups(cursor)
+    refresh_loss_rollup(cursor)
+    conn.commit()
+    cursor.close()
+
+def apply_scheduled_prices(conn):
+    """Pasar a products.price (y a los márgenes) los precios programados que ya entraron en vigencia"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    changed = apply_due_prices(cursor)
+    if changed:
+        recompute_product_costs(cursor, product_ids=changed)
+    conn.commit()
+    cursor.close()
+
+    if changed:
+        print(f"[{datetime.now():%H:%M:%S}] {len(changed)} precios programados en vigencia")
+
+def recompute_costs(conn):
+    """Recalcular product_costs; los reportes solo leen la tabla"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    updated = recompute_product_costs(cursor)
+    conn.commit()
+    cursor.close()
+
+    if updated:
+        print(f"[{datetime.now():%H:%M:%S}] {updated} costos de productos recalculados")
+
+def purge_old_events(conn):
+    """Borrar del outbox de eventos los que superan EVENT_RETENTION_DAYS"""
+    cursor = conn.cursor()
+    purged = purge_events(cursor)
+    conn.commit()
+    cursor.close()
+
+    if purged:
+        print(f"[{datetime.now():%H:%M:%S}] {purged} eventos vencidos borrados")
+
+def purge_report_cache(conn):
+    """Borrar las entradas vencidas de la caché de reportes"""
+    cursor = conn.cursor()
+    purged = purge_reports(cursor)
+    conn.commit()
+    cursor.close()
+
+    if purged:
+        print(f"[{datetime.now():%H:%M:%S}] {purged} reportes vencidos borrados de la caché")
+
+def maintain_table_partitions(conn):
+    """Crear particiones de los próximos meses y archivar las vencidas"""
+    for table, changes in maintain_partitions(conn).items():
+        if changes['created'] or changes['archived']:
+            print(f"[{datetime.now():%H:%M:%S}] {table}: particiones creadas {changes['created']}, "
+                  f"archivadas {changes['archived']}")
+
+# Tareas periódicas del worker: (intervalo en segundos, función)
+PERIODIC_TASKS = [
+    (INVENTORY_FLUSH_INTERVAL, flush_inventory_movements),
+    (60, requeue_stale_jobs),
+    (3600, purge_expired_artifacts),
+    (300, refresh_rollups),
+    (60, apply_scheduled_prices),
+    (300, recompute_costs),
+    (3600, snapshot_inventory),
+    (86400, check_inventory_drift),
+    (86400, maintain_table_partitions),
+    (86400, purge_old_events),
+    (3600, purge_report_cache),
+]
+
+def main(once=False):
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    conn = get_db()
+    last_run = {}
+
+    while running:
+        now = time.monotonic()
+        for interval, task in PERIODIC_TASKS:
+            if now - last_run.get(task, float('-inf')) >= interval:
+                # Una tarea que falla se reintenta en el próximo intervalo; la cola de reportes sigue
+                try:
+                    task(conn)
+                except Exception as e:
+                    conn.rollback()
+                    print(f"[{datetime.now():%H:%M:%S}] Error en la tarea {task.__name__}: {e}")
+                last_run[task] = now
+
+        job = claim_job(conn)
+        if job:
+            run_job(conn, job)
+            continue
+
+        if once:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    conn.close()
+
+if __name__ == '__main__':
+    main(once='--once' in sys.argv)